@@ -2,15 +2,30 @@
 import io
 import os
 import re
+import csv
+import gzip
+import tempfile
 import datetime
 import json
 import time
 import random
 import html
+import itertools
+import functools
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from yarl import URL
 import cloudscraper
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 import asyncio
+import contextlib
 from playwright.async_api import async_playwright
 
 # 🟢 Pyrogram Imports
@@ -44,20 +59,170 @@ app = Client(
     bot_token=BOT_TOKEN
 )
 
-transaction_lock = asyncio.Lock()
+# ==========================================
+# 🚦 ORDER SCHEDULER (BR / PH / MCC LANES)
+# ==========================================
+LANE_LIMITS = {
+    'BR': int(os.getenv('LANE_BR_CONCURRENCY', 3)),
+    'PH': int(os.getenv('LANE_PH_CONCURRENCY', 3)),
+    'MCC': int(os.getenv('LANE_MCC_CONCURRENCY', 2)),
+}
+
+class OrderScheduler:
+    # Each lane runs orders for different accounts in parallel up to its limit; orders for the same
+    # game_id/zone_id queue behind each other (asyncio.Lock is FIFO). Topups run alone: they wait for
+    # running orders to finish and hold new ones back, because they measure the balance before and after.
+    def __init__(self, limits):
+        self.lanes = {lane: asyncio.Semaphore(limit) for lane, limit in limits.items()}
+        self._accounts = {}  # (game_id, zone_id) -> [lock, holders]
+        self._cond = asyncio.Condition()
+        self._active = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def _shared(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._exclusive_waiting += 1
+            try:
+                await self._cond.wait_for(lambda: not self._exclusive and self._active == 0)
+            finally:
+                self._exclusive_waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def order(self, lane, game_id, zone_id):
+        key = (str(game_id), str(zone_id))
+        entry = self._accounts.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.lanes[lane], self._shared():
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._accounts[key]
+
+
+order_scheduler = OrderScheduler(LANE_LIMITS)
+
+# ==========================================
+# 🧵 THREAD POOLS (BLOCKING HTTP / STORAGE WORK)
+# ==========================================
+HTTP_IO_WORKERS = int(os.getenv('HTTP_IO_WORKERS', 8))
+WORK_WORKERS = int(os.getenv('WORK_WORKERS', 4))
+
+class InstrumentedExecutor:
+    # Named, bounded thread pool that tracks how long jobs wait for a worker
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_queued = 0
+        self._lock = threading.Lock()
+
+    def _call(self, submitted, fn, args, kwargs):
+        wait = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._pool, self._call, time.monotonic(), fn, args, kwargs)
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {
+            'name': self.name,
+            'workers': self.max_workers,
+            'active': self.active,
+            'queued': self.queued,
+            'peak_queued': self.peak_queued,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / done if done else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Outbound HTTP (cloudscraper) gets its own pool so hung requests can't starve storage or exports
+http_executor = InstrumentedExecutor('http-io', HTTP_IO_WORKERS)
+work_executor = InstrumentedExecutor('work', WORK_WORKERS)
 
 # ==========================================
 # 🗄️ LOCAL JSON DATABASE SETUP (NO VIRTUAL WALLET)
 # ==========================================
 DB_FILE = 'database.json'
+DB_JOURNAL_FILE = 'database.journal'
+DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', 0.5))
+DB_COMPACT_INTERVAL = float(os.getenv('DB_COMPACT_INTERVAL', 300))
+DB_COMPACT_OPS = int(os.getenv('DB_COMPACT_OPS', 1000))
+
+# 'json' (journaled database.json) or 'sqlite'
+DB_BACKEND = os.getenv('DB_BACKEND', 'json').lower()
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'database.sqlite3')
+
+# Orders kept per user in the hot store; older ones move to compressed archive segments
+HOT_ORDER_LIMIT = 200
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 60))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_MAX_DELAY = float(os.getenv('ARCHIVE_MAX_DELAY', 24 * 60 * 60))
+
+def default_data():
+    return {
+        "users": [str(OWNER_ID)], 
+        "cookie": "", 
+        "orders": []
+    }
 
 def load_data():
     if not os.path.exists(DB_FILE):
-        return {
-            "users": [str(OWNER_ID)], 
-            "cookie": "", 
-            "orders": []
-        }
+        return default_data()
     try:
         with open(DB_FILE, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -78,53 +243,820 @@ def load_data():
             
         return data
     except Exception:
-        return {
-            "users": [str(OWNER_ID)], 
-            "cookie": "", 
-            "orders": []
-        }
+        return default_data()
+
+def write_json_atomic(path, data, mode=None):
+    # Write to a temp file first so a crash never leaves a half-written database behind.
+    # mode (e.g. 0o600) is applied when the temp file is created, so the data is never readable with looser permissions.
+    tmp_path = f"{path}.tmp"
+    if mode is None:
+        f = open(tmp_path, 'w', encoding='utf-8')
+    else:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        os.fchmod(fd, mode)
+        f = os.fdopen(fd, 'w', encoding='utf-8')
+    with f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 def save_data(data):
     try:
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
+        write_json_atomic(DB_FILE, data)
     except Exception as e:
         print(f"❌ Error saving database: {e}")
 
+
+class Storage(ABC):
+    # Backend interface behind the user, cookie and order helpers below
+    async def start(self): pass
+    async def close(self): pass
+
+    @abstractmethod
+    async def get_users(self): ...
+    # Cheap token that changes whenever the user list may have changed, including edits made outside the bot
+    @abstractmethod
+    async def users_version(self): ...
+    @abstractmethod
+    async def add_user(self, user): ...
+    @abstractmethod
+    async def remove_user(self, user): ...
+
+    @abstractmethod
+    async def get_cookie(self): ...
+    @abstractmethod
+    async def set_cookie(self, cookie_str): ...
+
+    @abstractmethod
+    async def add_order(self, order, region=None): ...
+    # {key: (orders, spent)} for one rollup dimension ('user', 'day', 'region' or 'item')
+    @abstractmethod
+    async def get_rollups(self, dim, keys=None): ...
+    @abstractmethod
+    async def get_history(self, tg_id, limit): ...
+    # Newest-first iterator over a user's orders that is safe to consume in a worker thread
+    @abstractmethod
+    async def iter_history(self, tg_id, since=None, until=None, game_id=None): ...
+    # Orders beyond HOT_ORDER_LIMIT per user, oldest first, waiting to be archived
+    @abstractmethod
+    async def get_overflow(self): ...
+    # Removes a user's hot orders up to and including timestamp `upto`; returns how many went
+    @abstractmethod
+    async def drop_orders(self, tg_id, upto): ...
+
+
+def order_matches(order, since=None, until=None, game_id=None):
+    ts = order.get("timestamp", 0)
+    if since is not None and ts < since: return False
+    if until is not None and ts >= until: return False
+    if game_id is not None and order.get("game_id") != game_id: return False
+    return True
+
+
+ROLLUP_DIMS = ('user', 'day', 'region', 'item')
+
+def rollup_keys(order, region=None):
+    day = datetime.datetime.fromtimestamp(order.get("timestamp", 0), MMT).strftime("%Y-%m-%d")
+    return (
+        ('user', order.get("tg_id")),
+        ('day', day),
+        ('region', region or "Unknown"),
+        ('item', order.get("item_name")),
+    )
+
+
+class JsonStorage(Storage):
+    # Resident copy of database.json. Every mutation is applied in memory and appended
+    # to an append-only journal; the journal is fsynced in batches off the event loop and
+    # periodically folded back into a fresh snapshot (temp file + rename).
+    def __init__(self, db_file, journal_file):
+        self.db_file = db_file
+        self.journal_file = journal_file
+        self.data = None
+        self.orders = {}  # tg_id -> deque of that user's orders, oldest first
+        self._overflowing = set()  # tg_ids holding more than HOT_ORDER_LIMIT orders until the archiver runs
+        self.rollups = {dim: {} for dim in ROLLUP_DIMS}  # dim -> key -> [orders, spent]
+        self.seq = 0
+        self.users_changes = 0
+        self._disk_stat = None
+        self._pending = []
+        self._ops_since_compact = 0
+        self._last_compact = time.monotonic()
+        self._wakeup = None
+        self._io_lock = None
+
+    def load(self):
+        if self.data is not None:
+            return self.data
+
+        data = load_data()
+        self.seq = data.pop("journal_seq", 0)
+
+        user_orders = {}
+        for order in data.pop("orders", []):
+            user_orders.setdefault(order.get("tg_id"), []).append(order)
+        for tg_id, orders in user_orders.items():
+            orders.sort(key=lambda x: x.get("timestamp", 0))
+            self.orders[tg_id] = deque(orders)
+            if len(orders) > HOT_ORDER_LIMIT:
+                self._overflowing.add(tg_id)
+
+        rollups = data.pop("rollups", None)
+        if rollups is None:
+            # Databases written before rollups existed: seed them from the orders still on file
+            for order in self.iter_orders():
+                self._bump_rollups(order, None)
+        else:
+            for dim in ROLLUP_DIMS:
+                self.rollups[dim] = rollups.get(dim, {})
+        self.data = data
+
+        replayed = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line: continue
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break  # Torn tail write from a crash, everything after it is lost anyway
+                    # Entries already folded into the snapshot are skipped (crash between rename and truncate)
+                    if op.get("seq", 0) <= self.seq: continue
+                    self._apply(op)
+                    self.seq = op["seq"]
+                    replayed += 1
+
+        self._disk_stat = self._stat_db_file()
+        self._ops_since_compact = replayed
+        if replayed:
+            print(f"🗄️ Replayed {replayed} journal entries into the database.")
+        return self.data
+
+    def _apply(self, op):
+        data = self.data
+        kind = op["op"]
+
+        if kind == "add_user":
+            if op["user"] not in data["users"]:
+                data["users"].append(op["user"])
+            self.users_changes += 1
+        elif kind == "remove_user":
+            if op["user"] in data["users"]:
+                data["users"].remove(op["user"])
+            self.users_changes += 1
+        elif kind == "set_users":
+            data["users"] = list(op["users"])
+            self.users_changes += 1
+        elif kind == "set_cookie":
+            data["cookie"] = op["cookie"]
+        elif kind == "add_order":
+            order = op["order"]
+            ring = self.orders.get(order["tg_id"])
+            if ring is None:
+                ring = self.orders[order["tg_id"]] = deque()
+            # Orders arrive in time order; the archiver trims the oldest ones off the left
+            ring.append(order)
+            if len(ring) > HOT_ORDER_LIMIT:
+                self._overflowing.add(order["tg_id"])
+            self._bump_rollups(order, op.get("region"))
+        elif kind == "drop_orders":
+            ring = self.orders.get(op["tg_id"])
+            while ring and ring[0].get("timestamp", 0) <= op["upto"]:
+                ring.popleft()
+            if ring is not None and len(ring) <= HOT_ORDER_LIMIT:
+                self._overflowing.discard(op["tg_id"])
+                if not ring:
+                    del self.orders[op["tg_id"]]
+        elif kind == "clear_orders":
+            # Only found in journals written before orders were archived
+            self.orders.pop(op["tg_id"], None)
+            self._overflowing.discard(op["tg_id"])
+
+    def _bump_rollups(self, order, region):
+        for dim, key in rollup_keys(order, region):
+            bucket = self.rollups[dim].get(key)
+            if bucket is None:
+                bucket = self.rollups[dim][key] = [0, 0.0]
+            bucket[0] += 1
+            bucket[1] = round(bucket[1] + order.get("price", 0), 2)
+
+    def record(self, op):
+        self.load()
+        self.seq += 1
+        op["seq"] = self.seq
+        self._apply(op)
+        self._pending.append(json.dumps(op))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _append_journal(self, lines):
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, snapshot):
+        write_json_atomic(self.db_file, snapshot)
+        # Snapshot now covers every journaled entry
+        open(self.journal_file, 'w').close()
+        return self._stat_db_file()
+
+    def _stat_db_file(self):
+        try:
+            st = os.stat(self.db_file)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _read_disk_users(self):
+        with open(self.db_file, 'r', encoding='utf-8') as f:
+            users = json.load(f).get("users", [])
+        if isinstance(users, dict):
+            users = list(users.keys())
+        return [str(u) for u in users]
+
+    def _snapshot(self):
+        # Order dicts are never mutated after insert, so copying the containers is enough
+        return {
+            "users": list(self.data["users"]),
+            "cookie": self.data.get("cookie", ""),
+            "orders": list(self.iter_orders()),
+            "rollups": {dim: {k: list(v) for k, v in buckets.items()} for dim, buckets in self.rollups.items()},
+            "journal_seq": self.seq,
+        }
+
+    async def flush(self):
+        async with self._io_lock:
+            if not self._pending: return
+            batch, self._pending = self._pending, []
+            try:
+                await work_executor.run(self._append_journal, batch)
+                self._ops_since_compact += len(batch)
+            except Exception as e:
+                self._pending = batch + self._pending
+                print(f"❌ Error writing database journal: {e}")
+
+    async def compact(self):
+        async with self._io_lock:
+            # The snapshot already contains pending entries, so they never need to hit the journal
+            snapshot = self._snapshot()
+            batch, self._pending = self._pending, []
+            try:
+                self._disk_stat = await work_executor.run(self._write_snapshot, snapshot)
+                self._ops_since_compact = 0
+                self._last_compact = time.monotonic()
+            except Exception as e:
+                self._pending = batch + self._pending
+                print(f"❌ Error compacting database: {e}")
+
+    def _should_compact(self):
+        if self._ops_since_compact >= DB_COMPACT_OPS: return True
+        return self._ops_since_compact > 0 and time.monotonic() - self._last_compact >= DB_COMPACT_INTERVAL
+
+    async def run_flusher(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=DB_COMPACT_INTERVAL)
+                    # Let writes that land in the same window share one fsync
+                    await asyncio.sleep(DB_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+                if self._should_compact():
+                    await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Database flusher error: {e}")
+
+    async def start(self):
+        self.load()
+        self._wakeup = asyncio.Event()
+        self._io_lock = asyncio.Lock()
+        asyncio.create_task(self.run_flusher())
+
+    async def close(self):
+        if self.data is None: return
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        await self.flush()
+        await self.compact()
+
+    async def get_users(self):
+        return self.load()["users"]
+
+    async def users_version(self):
+        self.load()
+        disk_stat = self._stat_db_file()
+        if disk_stat is not None and disk_stat != self._disk_stat:
+            if self._io_lock is None:
+                self._io_lock = asyncio.Lock()
+            # Re-checked under the I/O lock: compact() replaces the file and records its stat in one critical
+            # section, so our own snapshot is never mistaken for a hand edit
+            async with self._io_lock:
+                disk_stat = self._stat_db_file()
+                if disk_stat is not None and disk_stat != self._disk_stat:
+                    # database.json was edited by hand; its user list wins over the in-memory one
+                    self._disk_stat = disk_stat
+                    try:
+                        disk_users = await work_executor.run(self._read_disk_users)
+                        if disk_users != self.data["users"]:
+                            print("🗄️ database.json changed on disk, reloading allowed users.")
+                            self.record({"op": "set_users", "users": disk_users})
+                    except Exception as e:
+                        print(f"❌ Error reloading users from {self.db_file}: {e}")
+        return self.users_changes
+
+    async def add_user(self, user):
+        if user in self.load()["users"]: return False
+        self.record({"op": "add_user", "user": user})
+        return True
+
+    async def remove_user(self, user):
+        if user not in self.load()["users"]: return False
+        self.record({"op": "remove_user", "user": user})
+        return True
+
+    async def get_cookie(self):
+        return self.load().get("cookie", "")
+
+    async def set_cookie(self, cookie_str):
+        self.record({"op": "set_cookie", "cookie": cookie_str})
+
+    async def add_order(self, order, region=None):
+        self.record({"op": "add_order", "order": order, "region": region})
+
+    async def get_rollups(self, dim, keys=None):
+        self.load()
+        buckets = self.rollups[dim]
+        if keys is None:
+            return {k: tuple(v) for k, v in buckets.items()}
+        return {k: tuple(buckets[k]) for k in keys if k in buckets}
+
+    def iter_orders(self):
+        return itertools.chain.from_iterable(self.orders.values())
+
+    async def get_history(self, tg_id, limit):
+        self.load()
+        ring = self.orders.get(tg_id)
+        if not ring: return []
+        return list(itertools.islice(reversed(ring), limit))
+
+    async def iter_history(self, tg_id, since=None, until=None, game_id=None):
+        self.load()
+        # Copy the ring on the loop so the worker thread never sees it mutate
+        orders = list(self.orders.get(tg_id, ()))
+        return (o for o in reversed(orders) if order_matches(o, since, until, game_id))
+
+    async def get_overflow(self):
+        self.load()
+        overflow = []
+        for tg_id in self._overflowing:
+            ring = self.orders[tg_id]
+            overflow.extend(itertools.islice(ring, len(ring) - HOT_ORDER_LIMIT))
+        return overflow
+
+    async def drop_orders(self, tg_id, upto):
+        self.load()
+        ring = self.orders.get(tg_id, ())
+        dropped = sum(1 for o in ring if o.get("timestamp", 0) <= upto)
+        if dropped:
+            self.record({"op": "drop_orders", "tg_id": tg_id, "upto": upto})
+        return dropped
+
+
+ORDER_COLUMNS = ("tg_id", "game_id", "zone_id", "item_name", "price", "order_id", "status", "date_str", "timestamp")
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tg_id TEXT NOT NULL,
+    game_id TEXT,
+    zone_id TEXT,
+    item_name TEXT,
+    price REAL,
+    order_id TEXT,
+    status TEXT,
+    date_str TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_tg_id_timestamp ON orders (tg_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders (order_id);
+CREATE TABLE IF NOT EXISTS rollups (
+    dim TEXT NOT NULL,
+    key TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    spent REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (dim, key)
+);
+"""
+
+SQLITE_BUMP_ROLLUP = (
+    "INSERT INTO rollups (dim, key, orders, spent) VALUES (?, ?, 1, ?) "
+    "ON CONFLICT (dim, key) DO UPDATE SET orders = orders + 1, spent = ROUND(spent + excluded.spent, 2)"
+)
+
+def migrate_json_to_sqlite(conn, json_file=DB_FILE, journal_file=DB_JOURNAL_FILE):
+    # One-shot import of database.json (plus any unflushed journal) into an empty SQLite database
+    if conn.execute("SELECT 1 FROM settings WHERE key = 'json_migrated'").fetchone():
+        return 0
+
+    json_storage = JsonStorage(json_file, journal_file)
+    data = json_storage.load()
+    orders = list(json_storage.iter_orders())
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (name) VALUES (?)", [(str(u),) for u in data.get("users", [])])
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('cookie', ?)", (data.get("cookie", ""),))
+        conn.executemany(
+            f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+            [tuple(o.get(c, 0 if c == "timestamp" else "") for c in ORDER_COLUMNS) for o in orders]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO rollups (dim, key, orders, spent) VALUES (?, ?, ?, ?)",
+            [(dim, key, v[0], v[1]) for dim, buckets in json_storage.rollups.items() for key, v in buckets.items()]
+        )
+        conn.execute("INSERT INTO settings (key, value) VALUES ('json_migrated', ?)", (str(time.time()),))
+
+    if os.path.exists(json_file):
+        print(f"🗄️ Migrated {len(data.get('users', []))} users and {len(orders)} orders from {json_file} to SQLite.")
+    return len(orders)
+
+
+class SqliteStorage(Storage):
+    # SQLite in WAL mode. Writes go through one dedicated connection thread and reads through
+    # another, so neither blocks the Pyrogram loop and readers never wait behind a write.
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-reader')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _close_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    async def _write(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    async def _read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._reader, fn, *args)
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.executescript(SQLITE_SCHEMA)
+        migrate_json_to_sqlite(conn)
+        if not conn.execute("SELECT 1 FROM rollups LIMIT 1").fetchone():
+            # Databases created before rollups existed: seed them from the stored orders
+            with conn:
+                for row in conn.execute(f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders").fetchall():
+                    order = dict(zip(ORDER_COLUMNS, row))
+                    conn.executemany(SQLITE_BUMP_ROLLUP, [(dim, key, order["price"]) for dim, key in rollup_keys(order)])
+
+    async def start(self):
+        await self._write(self._init_db)
+
+    async def close(self):
+        await self._write(self._close_conn)
+        await self._read(self._close_conn)
+        self._writer.shutdown()
+        self._reader.shutdown()
+
+    def _get_users(self):
+        return [row[0] for row in self._conn().execute("SELECT name FROM users ORDER BY rowid")]
+
+    def _data_version(self):
+        # Changes whenever another connection (our writer thread or an outside tool) commits
+        return self._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def _add_user(self, user):
+        with self._conn() as conn:
+            return conn.execute("INSERT OR IGNORE INTO users (name) VALUES (?)", (user,)).rowcount > 0
+
+    def _remove_user(self, user):
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM users WHERE name = ?", (user,)).rowcount > 0
+
+    def _get_cookie(self):
+        row = self._conn().execute("SELECT value FROM settings WHERE key = 'cookie'").fetchone()
+        return row[0] if row else ""
+
+    def _set_cookie(self, cookie_str):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('cookie', ?)", (cookie_str,))
+
+    def _add_order(self, order, region):
+        with self._conn() as conn:
+            conn.execute(
+                f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+                tuple(order[c] for c in ORDER_COLUMNS)
+            )
+            conn.executemany(SQLITE_BUMP_ROLLUP, [(dim, key, order["price"]) for dim, key in rollup_keys(order, region)])
+
+    def _get_history(self, tg_id, limit):
+        rows = self._conn().execute(
+            f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE tg_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (tg_id, limit)
+        )
+        return [dict(zip(ORDER_COLUMNS, row)) for row in rows]
+
+    def _stream_history(self, tg_id, since, until, game_id):
+        sql = f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE tg_id = ?"
+        params = [tg_id]
+        if since is not None:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND timestamp < ?"
+            params.append(until)
+        if game_id is not None:
+            sql += " AND game_id = ?"
+            params.append(game_id)
+        sql += " ORDER BY timestamp DESC"
+
+        # Own connection, opened in whichever thread consumes the generator
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            for row in conn.execute(sql, params):
+                yield dict(zip(ORDER_COLUMNS, row))
+        finally:
+            conn.close()
+
+    def _get_rollups(self, dim, keys):
+        if keys is None:
+            rows = self._conn().execute("SELECT key, orders, spent FROM rollups WHERE dim = ?", (dim,))
+        else:
+            keys = list(keys)
+            rows = self._conn().execute(
+                f"SELECT key, orders, spent FROM rollups WHERE dim = ? AND key IN ({', '.join('?' * len(keys))})",
+                [dim] + keys
+            )
+        return {key: (orders, spent) for key, orders, spent in rows}
+
+    def _get_overflow(self):
+        conn = self._conn()
+        overflow = []
+        counts = conn.execute(
+            "SELECT tg_id, COUNT(*) FROM orders GROUP BY tg_id HAVING COUNT(*) > ?", (HOT_ORDER_LIMIT,)
+        ).fetchall()
+        for tg_id, count in counts:
+            rows = conn.execute(
+                f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE tg_id = ? ORDER BY timestamp ASC LIMIT ?",
+                (tg_id, count - HOT_ORDER_LIMIT)
+            )
+            overflow.extend(dict(zip(ORDER_COLUMNS, row)) for row in rows)
+        return overflow
+
+    def _drop_orders(self, tg_id, upto):
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM orders WHERE tg_id = ? AND timestamp <= ?", (tg_id, upto)).rowcount
+
+    async def get_users(self): return await self._read(self._get_users)
+    async def users_version(self): return await self._read(self._data_version)
+    async def add_user(self, user): return await self._write(self._add_user, user)
+    async def remove_user(self, user): return await self._write(self._remove_user, user)
+
+    async def get_cookie(self): return await self._read(self._get_cookie)
+    async def set_cookie(self, cookie_str): await self._write(self._set_cookie, cookie_str)
+
+    async def add_order(self, order, region=None): await self._write(self._add_order, order, region)
+    async def get_rollups(self, dim, keys=None): return await self._read(self._get_rollups, dim, keys)
+    async def get_history(self, tg_id, limit): return await self._read(self._get_history, tg_id, limit)
+    async def iter_history(self, tg_id, since=None, until=None, game_id=None):
+        return self._stream_history(tg_id, since, until, game_id)
+    async def get_overflow(self): return await self._read(self._get_overflow)
+    async def drop_orders(self, tg_id, upto): return await self._write(self._drop_orders, tg_id, upto)
+
+
+def create_storage():
+    if DB_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage(DB_FILE, DB_JOURNAL_FILE)
+
+storage = create_storage()
+
+
+class OrderArchive:
+    # Orders that aged out of the hot store, kept forever in immutable gzip JSONL segments partitioned
+    # by month. index.json records each segment's users and date range so reads only open what they need.
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        # watermarks: newest archived timestamp per user; cleared: /clean hides archived orders up to this
+        self.index = {"segments": [], "watermarks": {}, "cleared": {}}
+        self._lock = asyncio.Lock()
+        self._last_archive = time.monotonic()
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self.index.update(json.load(f))
+
+    def _write_segments(self, orders):
+        os.makedirs(self.directory, exist_ok=True)
+        by_month = {}
+        for order in orders:
+            month = datetime.datetime.fromtimestamp(order.get("timestamp", 0), MMT).strftime("%Y-%m")
+            by_month.setdefault(month, []).append(order)
+
+        segments = []
+        for month, group in sorted(by_month.items()):
+            group.sort(key=lambda x: x.get("timestamp", 0))
+            name = f"orders-{month}-{time.time_ns()}.jsonl.gz"
+            path = os.path.join(self.directory, name)
+            with open(f"{path}.tmp", 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                    for order in group:
+                        gz.write((json.dumps(order, ensure_ascii=False) + "\n").encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(f"{path}.tmp", path)
+
+            users = {}
+            for order in group:
+                users[order["tg_id"]] = users.get(order["tg_id"], 0) + 1
+            segments.append({
+                "file": name,
+                "month": month,
+                "min_ts": group[0].get("timestamp", 0),
+                "max_ts": group[-1].get("timestamp", 0),
+                "count": len(group),
+                "users": users,
+            })
+        return segments
+
+    async def _save_index(self, index):
+        await work_executor.run(write_json_atomic, self.index_file, index)
+        self.index = index
+
+    async def archive(self, orders):
+        # Writes orders newer than each user's watermark; returns {tg_id: newest timestamp now safe to drop}
+        async with self._lock:
+            watermarks = self.index["watermarks"]
+            fresh = [o for o in orders if o.get("timestamp", 0) > watermarks.get(o["tg_id"], float('-inf'))]
+            if fresh:
+                segments = await work_executor.run(self._write_segments, fresh)
+                new_watermarks = dict(watermarks)
+                for order in fresh:
+                    new_watermarks[order["tg_id"]] = max(new_watermarks.get(order["tg_id"], 0), order.get("timestamp", 0))
+                await self._save_index({**self.index, "segments": self.index["segments"] + segments, "watermarks": new_watermarks})
+                self._last_archive = time.monotonic()
+
+            archived_upto = {}
+            for order in orders:
+                archived_upto[order["tg_id"]] = max(archived_upto.get(order["tg_id"], 0), order.get("timestamp", 0))
+            return archived_upto
+
+    async def archive_overflow(self):
+        overflow = await storage.get_overflow()
+        if not overflow: return
+
+        watermarks = self.index["watermarks"]
+        # Already in a segment (crash between segment write and drop): just drop them
+        done = [o for o in overflow if o.get("timestamp", 0) <= watermarks.get(o["tg_id"], float('-inf'))]
+        pending = len(overflow) - len(done)
+
+        # Batch small overflows so the archive doesn't fill up with tiny segments
+        if pending >= ARCHIVE_BATCH_SIZE or (pending and time.monotonic() - self._last_archive >= ARCHIVE_MAX_DELAY):
+            archived_upto = await self.archive(overflow)
+            print(f"🗃️ Archived {pending} orders into {self.directory}.")
+        elif done:
+            archived_upto = await self.archive(done)
+        else:
+            return
+
+        for tg_id, upto in archived_upto.items():
+            await storage.drop_orders(tg_id, upto)
+
+    async def run(self):
+        while True:
+            try:
+                await self.archive_overflow()
+            except Exception as e:
+                print(f"❌ Order archiver error: {e}")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    def visible_count(self, tg_id):
+        cleared = self.index["cleared"].get(tg_id)
+        return sum(
+            s["users"].get(tg_id, 0) for s in self.index["segments"]
+            if cleared is None or s["min_ts"] > cleared
+        )
+
+    async def hide(self, tg_id, upto):
+        async with self._lock:
+            cleared = dict(self.index["cleared"])
+            cleared[tg_id] = max(cleared.get(tg_id, 0), upto)
+            await self._save_index({**self.index, "cleared": cleared})
+
+    def iter_orders(self, tg_id, since=None, until=None, game_id=None):
+        # Picks segments from the index on the loop; the returned generator reads them in a worker thread
+        cleared = self.index["cleared"].get(tg_id)
+        segments = [
+            s for s in self.index["segments"]
+            if tg_id in s["users"]
+            and (cleared is None or s["max_ts"] > cleared)
+            and (since is None or s["max_ts"] >= since)
+            and (until is None or s["min_ts"] < until)
+        ]
+        segments.sort(key=lambda s: s["max_ts"], reverse=True)
+        return self._stream(segments, tg_id, since, until, game_id, cleared)
+
+    def _stream(self, segments, tg_id, since, until, game_id, cleared):
+        for segment in segments:
+            with gzip.open(os.path.join(self.directory, segment["file"]), 'rt', encoding='utf-8') as f:
+                orders = [o for o in map(json.loads, f) if o.get("tg_id") == tg_id]
+            for order in reversed(orders):
+                if cleared is not None and order.get("timestamp", 0) <= cleared: continue
+                if order_matches(order, since, until, game_id):
+                    yield order
+
+
+order_archive = OrderArchive(ARCHIVE_DIR)
+
 # --- USER ACCESS CONTROL FUNCTIONS ---
+AUTH_RECHECK_INTERVAL = float(os.getenv('AUTH_RECHECK_INTERVAL', 5))
+
+class AuthIndex:
+    # Allowed IDs and usernames as sets, rebuilt only when the storage reports a change
+    def __init__(self):
+        self.ids = set()
+        self.usernames = set()
+        self.version = None
+        self._checked_at = None
+
+    def rebuild(self, users):
+        ids, usernames = set(), set()
+        for u in users:
+            u = str(u).lower()
+            (ids if u.isdigit() else usernames).add(u)
+        self.ids, self.usernames = ids, usernames
+
+    def add(self, target_str):
+        (self.ids if target_str.isdigit() else self.usernames).add(target_str)
+
+    def discard(self, target_str):
+        (self.ids if target_str.isdigit() else self.usernames).discard(target_str)
+
+    async def refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < AUTH_RECHECK_INTERVAL:
+            return
+        self._checked_at = now
+        version = await storage.users_version()
+        if version != self.version:
+            self.rebuild(await storage.get_users())
+            self.version = version
+
+    async def contains(self, user_id, username=None):
+        await self.refresh()
+        if str(user_id) in self.ids:
+            return True
+        return bool(username) and username.lower() in self.usernames
+
+auth_index = AuthIndex()
+
 async def add_allowed_user(target):
-    data = load_data()
     target_str = str(target).lower().replace('@', '')
-    if target_str not in data["users"]:
-        data["users"].append(target_str)
-        save_data(data)
-        return True
-    return False
+    added = await storage.add_user(target_str)
+    if added: auth_index.add(target_str)
+    return added
 
 async def remove_allowed_user(target):
-    data = load_data()
     target_str = str(target).lower().replace('@', '')
-    if target_str in data["users"]:
-        data["users"].remove(target_str)
-        save_data(data)
-        return True
-    return False
+    removed = await storage.remove_user(target_str)
+    if removed: auth_index.discard(target_str)
+    return removed
 
 async def get_allowed_users():
-    return load_data().get("users", [])
+    return await storage.get_users()
 # --------------------------------------
 
 async def get_main_cookie():
-    return load_data().get("cookie", "")
+    return await storage.get_cookie()
 
 async def update_main_cookie(cookie_str):
-    data = load_data()
-    data["cookie"] = cookie_str
-    save_data(data)
+    await storage.set_cookie(cookie_str)
+    scraper_pool.invalidate(cookie_str)
+    csrf_cache.invalidate()
 
-async def save_order(tg_id, game_id, zone_id, item_name, price, order_id, status="success"):
-    data = load_data()
-    if "orders" not in data: data["orders"] = []
+async def save_order(tg_id, game_id, zone_id, item_name, price, order_id, status="success", region=None):
     now = datetime.datetime.now(MMT)
     
     order_data = {
@@ -138,109 +1070,518 @@ async def save_order(tg_id, game_id, zone_id, item_name, price, order_id, status
         "date_str": now.strftime("%I:%M:%S %p %d.%m.%Y"),
         "timestamp": now.timestamp()
     }
-    data["orders"].append(order_data)
-    
-    # Auto-delete keeping max 200 orders
-    user_orders = [o for o in data["orders"] if o.get("tg_id") == str(tg_id)]
-    other_orders = [o for o in data["orders"] if o.get("tg_id") != str(tg_id)]
-    
-    if len(user_orders) > 200:
-        user_orders.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-        user_orders = user_orders[:200]
-        
-    data["orders"] = other_orders + user_orders
-    save_data(data)
-
-async def get_user_history(tg_id, limit=200):
-    data = load_data()
-    orders = data.get("orders", [])
-    user_orders = [o for o in orders if o.get("tg_id") == str(tg_id)]
-    user_orders.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    return user_orders[:limit]
+    await storage.add_order(order_data, region)
+
+async def get_user_history(tg_id, limit=HOT_ORDER_LIMIT):
+    tg_id = str(tg_id)
+    orders = await storage.get_history(tg_id, limit)
+    if len(orders) < limit:
+        archived = order_archive.iter_orders(tg_id)
+        orders += await work_executor.run(lambda: list(itertools.islice(archived, limit - len(orders))))
+    return orders
+
+async def iter_user_history(tg_id, since=None, until=None, game_id=None):
+    # Hot orders are always newer than archived ones, so chaining keeps newest-first order
+    tg_id = str(tg_id)
+    hot = await storage.iter_history(tg_id, since, until, game_id)
+    return itertools.chain(hot, order_archive.iter_orders(tg_id, since, until, game_id))
 
 async def clear_user_history(tg_id):
-    data = load_data()
-    orders = data.get("orders", [])
-    initial_len = len(orders)
-    data["orders"] = [o for o in orders if o.get("tg_id") != str(tg_id)]
-    save_data(data)
-    return initial_len - len(data["orders"])
+    # Hidden from the user, never deleted: hot orders move to the archive first
+    tg_id = str(tg_id)
+    hot_orders = await work_executor.run(list, await storage.iter_history(tg_id))
+    deleted_count = order_archive.visible_count(tg_id)
+    if hot_orders:
+        archived_upto = await order_archive.archive(hot_orders)
+        deleted_count += await storage.drop_orders(tg_id, archived_upto[tg_id])
+    if deleted_count:
+        await order_archive.hide(tg_id, order_archive.index["watermarks"].get(tg_id, 0))
+    return deleted_count
 
 # ==========================================
 # 🍪 MAIN SCRAPER (OWNER'S COOKIE ONLY)
 # ==========================================
-async def get_main_scraper():
-    raw_cookie = await get_main_cookie()
+# One session per order lane by default, so threaded mode never queues lanes behind the pool
+SCRAPER_POOL_SIZE = int(os.getenv('SCRAPER_POOL_SIZE', sum(LANE_LIMITS.values())))
+SCRAPER_WARM_URL = os.getenv('SCRAPER_WARM_URL', 'https://www.smile.one/')
+SCRAPER_WARM_TIMEOUT = float(os.getenv('SCRAPER_WARM_TIMEOUT', 15))
+
+def parse_cookie_string(raw_cookie):
     cookie_dict = {}
     if raw_cookie:
         for item in raw_cookie.split(';'):
             if '=' in item:
                 k, v = item.strip().split('=', 1)
                 cookie_dict[k] = v
-                
+    return cookie_dict
+
+def build_scraper(raw_cookie):
+    cookie_dict = parse_cookie_string(raw_cookie)
     scraper = cloudscraper.create_scraper(browser={'browser': 'chrome', 'platform': 'windows', 'desktop': True})
     if cookie_dict:
         scraper.cookies.update(cookie_dict)
     return scraper
 
+def prime_scraper(scraper):
+    # Opens the keep-alive connection and solves any Cloudflare challenge before an order needs the session
+    try:
+        scraper.get(SCRAPER_WARM_URL, timeout=SCRAPER_WARM_TIMEOUT)
+    except Exception as e:
+        print(f"⚠️ Scraper warm-up request failed: {e}")
+    return scraper
+
+
+class ScraperPool:
+    # Long-lived cloudscraper sessions (keep-alive connections + Cloudflare state) built for the
+    # current cookie. A session is only ever used by the caller that checked it out, and every session
+    # is tagged with the cookie version it was built for; stale ones are closed instead of reused.
+    def __init__(self, size):
+        self.size = size
+        self.cookie = None
+        self.version = 0
+        self._idle = []  # (version, scraper), most recently used last
+        self._slots = asyncio.Semaphore(size)
+        self._busy = 0
+
+    async def current_cookie(self):
+        if self.cookie is None:
+            self.cookie = await get_main_cookie()
+        return self.cookie
+
+    async def _build(self):
+        # Returns (version, scraper) for the cookie that is current when the build finishes
+        while True:
+            version = self.version
+            cookie = await self.current_cookie()
+            scraper = await http_executor.run(build_scraper, cookie)
+            if version == self.version:
+                return version, scraper
+            scraper.close()
+
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            checkout = self._idle.pop() if self._idle else await self._build()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._busy += 1
+        return checkout
+
+    def release(self, version, scraper):
+        self._busy -= 1
+        if version == self.version and len(self._idle) + self._busy < self.size:
+            self._idle.append((version, scraper))
+        else:
+            scraper.close()
+        self._slots.release()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        version, scraper = await self.acquire()
+        try:
+            yield scraper
+        finally:
+            self.release(version, scraper)
+
+    def invalidate(self, cookie_str):
+        # Cookie changed: sessions checked out right now are closed when they come back
+        self.cookie = cookie_str
+        self.version += 1
+        idle, self._idle = self._idle, []
+        for _, scraper in idle:
+            scraper.close()
+        asyncio.get_running_loop().create_task(self.warm())
+
+    async def warm(self):
+        while len(self._idle) + self._busy < self.size:
+            version, scraper = await self._build()
+            await http_executor.run(prime_scraper, scraper)
+            if version != self.version or len(self._idle) + self._busy >= self.size:
+                scraper.close()
+                return
+            self._idle.append((version, scraper))
+
+
+scraper_pool = ScraperPool(SCRAPER_POOL_SIZE)
+
 # ==========================================
-# 🤖 PLAYWRIGHT AUTO-LOGIN (FACEBOOK) [FULLY ASYNC]
+# 🌐 HTTP TRANSPORT (SMILE.ONE / PIZZOSHOP)
 # ==========================================
-async def auto_login_and_get_cookie():
-    if not FB_EMAIL or not FB_PASS:
-        print("❌ FB_EMAIL and FB_PASS are missing in .env.")
-        return False
-        
-    print("Logging in with Facebook to fetch new Cookie...")
-    try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(
-                headless=True, 
-                args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled']
-            )
-            context = await browser.new_context(
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                viewport={'width': 1280, 'height': 720}
+# 'aiohttp' (native asyncio, cloudscraper only for Cloudflare challenges) or 'cloudscraper' (threads only)
+HTTP_TRANSPORT = os.getenv('HTTP_TRANSPORT', 'aiohttp').lower()
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', 30))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+BROWSER_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+SMILE_BASE_URL = 'https://www.smile.one/'
+
+class HttpResponse:
+    # The parts of requests.Response the handlers use
+    def __init__(self, status_code, text, url):
+        self.status_code = status_code
+        self.text = text
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+def is_cloudflare_challenge(response):
+    if response.status_code not in (403, 503): return False
+    text = response.text[:5000].lower()
+    return 'cloudflare' in text or 'just a moment' in text or 'cf-chl' in text
+
+
+class ThreadedSession:
+    # A pooled cloudscraper session driven from the HTTP executor; every call gets a timeout.
+    # version is set when this object owns the pool checkout (http_session) and can swap it on renew().
+    # requests.Session isn't thread-safe, so overlapped callers (query vs confirm) take turns on it.
+    def __init__(self, scraper, version=None):
+        self.scraper = scraper
+        self.version = version
+        self._turn = asyncio.Lock()
+
+    async def renew(self):
+        # The cookie was replaced: hand back the stale session (the pool closes it) and check out a current one
+        if self.version is None or self.version == scraper_pool.version: return
+        async with self._turn:
+            scraper_pool.release(self.version, self.scraper)
+            self.scraper = None
+            self.version, self.scraper = await scraper_pool.acquire()
+
+    async def _call(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        async with self._turn:
+            call = asyncio.ensure_future(http_executor.run(getattr(self.scraper, method), url, **kwargs))
+            try:
+                return await asyncio.shield(call)
+            finally:
+                # A cancelled caller keeps its turn until the thread is really done with the session
+                if not call.done(): await asyncio.wait([call])
+
+    async def get(self, url, **kwargs):
+        return await self._call('get', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._call('post', url, **kwargs)
+
+
+class AsyncTransport:
+    # One aiohttp ClientSession for the whole bot. Connection limits are enforced by the connector;
+    # the cookie jar is re-seeded from the stored cookie whenever its version changes.
+    def __init__(self, max_connections, max_per_host, timeout):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._session = None
+        self._cookie_version = None
+
+    async def _client(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_per_host, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': BROWSER_USER_AGENT},
             )
+            self._cookie_version = None
+        if self._cookie_version != scraper_pool.version:
+            self._cookie_version = scraper_pool.version
+            cookie_dict = parse_cookie_string(await scraper_pool.current_cookie())
+            self._session.cookie_jar.clear()
+            self._session.cookie_jar.update_cookies(cookie_dict, URL(SMILE_BASE_URL))
+        return self._session
+
+    async def request(self, method, url, params=None, data=None, headers=None, timeout=None):
+        session = await self._client()
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with session.request(method, url, params=params, data=data, headers=headers, **kwargs) as resp:
+            text = await resp.text(errors='replace')
+            return HttpResponse(resp.status, text, str(resp.url))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+http_transport = AsyncTransport(HTTP_MAX_CONNECTIONS, HTTP_MAX_PER_HOST, HTTP_TIMEOUT)
+
+
+class AsyncSession:
+    # Native asyncio requests; a Cloudflare challenge is retried once through a pooled cloudscraper session
+    async def _request(self, method, url, **kwargs):
+        response = await http_transport.request(method, url, **kwargs)
+        if is_cloudflare_challenge(response):
+            async with scraper_pool.session() as scraper:
+                threaded = ThreadedSession(scraper)
+                return await (threaded.get if method == 'GET' else threaded.post)(url, **kwargs)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self._request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request('POST', url, **kwargs)
+
+    async def renew(self):
+        # The shared client re-seeds its cookie jar by itself when the cookie version changes
+        pass
+
+
+@contextlib.asynccontextmanager
+async def http_session():
+    if HTTP_TRANSPORT == 'aiohttp':
+        yield AsyncSession()
+    else:
+        version, scraper = await scraper_pool.acquire()
+        session = ThreadedSession(scraper, version)
+        try:
+            yield session
+        finally:
+            if session.scraper is not None:
+                scraper_pool.release(session.version, session.scraper)
+
+# ==========================================
+# ⏱️ REQUEST PACING (TOKEN BUCKET PER ENDPOINT + REGION)
+# ==========================================
+# Requests per second and burst size per smile.one endpoint; each (endpoint, region) gets its own bucket
+PACE_RATES = {
+    'pay': float(os.getenv('PACE_PAY_RATE', 0.5)),
+    'query': float(os.getenv('PACE_QUERY_RATE', 1)),
+    'checkrole': float(os.getenv('PACE_CHECKROLE_RATE', 1)),
+    'codelist': float(os.getenv('PACE_CODELIST_RATE', 2)),
+}
+PACE_BURST = {'pay': 1, 'query': 2, 'checkrole': 2, 'codelist': 3}
+PACE_JITTER = float(os.getenv('PACE_JITTER', 0.3))
+PACE_MIN_RATE = float(os.getenv('PACE_MIN_RATE', 0.05))
+THROTTLE_STATUSES = (403, 429, 503)
+
+class TokenBucket:
+    # Tokens may go negative: each caller reserves its slot and sleeps until the bucket catches up.
+    # The rate is halved on throttling and creeps back to the configured rate on success (AIMD).
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def tighten(self):
+        self._refill()
+        self.rate = max(PACE_MIN_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def relax(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 10)
+
+
+class Pacer:
+    def __init__(self, rates, bursts):
+        self.rates = rates
+        self.bursts = bursts
+        self.buckets = {}
+
+    def bucket(self, endpoint, region):
+        key = (endpoint, region)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.rates[endpoint], self.bursts[endpoint])
+        return self.buckets[key]
+
+    async def request(self, endpoint, region, call):
+        # call is an un-awaited scraper.get/post coroutine; it only starts once a token is available
+        bucket = self.bucket(endpoint, region)
+        try:
+            await bucket.acquire()
+            if PACE_JITTER: await asyncio.sleep(random.uniform(0, PACE_JITTER))
+        except BaseException:
+            call.close()
+            raise
+        response = await call
+        if response.status_code in THROTTLE_STATUSES or is_cloudflare_challenge(response):
+            bucket.tighten()
+            print(f"⏱️ Throttled on {endpoint}/{region} (HTTP {response.status_code}); pacing at {bucket.rate:.2f} req/s")
+        else:
+            bucket.relax()
+        return response
+
+
+pacer = Pacer(PACE_RATES, PACE_BURST)
+
+# ==========================================
+# 🤖 PLAYWRIGHT AUTO-LOGIN (FACEBOOK) [FULLY ASYNC]
+# ==========================================
+BROWSER_STATE_FILE = os.getenv('BROWSER_STATE_FILE', 'browser_state.json')
+LOGIN_TIMEOUT = int(os.getenv('LOGIN_TIMEOUT', 30)) * 1000
+SMILE_ORDER_URL = "https://www.smile.one/customer/order"
+SMILE_LOGIN_URL = "https://www.smile.one/customer/login"
+
+class LoginBrowser:
+    # One Chromium kept alive for the life of the bot, started on first use. Facebook and smile.one
+    # cookies are persisted as storage_state, so most relogins are a single navigation with no OAuth.
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self._playwright = None
+        self._browser = None
+
+    async def _ensure_browser(self):
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(
+            headless=True, 
+            args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled']
+        )
+        return self._browser
+
+    async def _save_state(self, context):
+        state = await context.storage_state()
+        # Holds live Facebook/smile.one sessions
+        await work_executor.run(write_json_atomic, self.state_file, state, 0o600)
+
+    async def _finish(self, context):
+        cookies = await context.cookies("https://www.smile.one")
+        raw_cookie_str = "; ".join(f"{cookie['name']}={cookie['value']}" for cookie in cookies)
+        await self._save_state(context)
+        await update_main_cookie(raw_cookie_str)
+
+    async def _facebook_login(self, context, page):
+        if "/customer/login" not in page.url:
+            await page.goto(SMILE_LOGIN_URL, wait_until='domcontentloaded')
+        fb_button = page.locator("a.login-btn-facebook, a[href*='facebook.com']").first
+        await fb_button.wait_for(state='visible', timeout=LOGIN_TIMEOUT)
+
+        async with context.expect_page() as popup_info:
+            await fb_button.click()
+        fb_popup = await popup_info.value
+
+        # A remembered Facebook session closes the popup on its own (the form wait then fails) and the
+        # main page lands on the order page; otherwise the form shows up. Only both failing is an error.
+        reached_order = asyncio.ensure_future(page.wait_for_url("**/customer/order**", timeout=LOGIN_TIMEOUT))
+        form_ready = asyncio.ensure_future(fb_popup.wait_for_selector('input[name="email"]', timeout=LOGIN_TIMEOUT))
+        try:
+            done, _ = await asyncio.wait({reached_order, form_ready}, return_when=asyncio.FIRST_COMPLETED)
+            if form_ready in done and form_ready.exception() is not None:
+                await reached_order
+                return
+            if reached_order in done and reached_order.exception() is None:
+                return
+            if form_ready not in done:
+                await form_ready
+        finally:
+            for task in (reached_order, form_ready):
+                if not task.done(): task.cancel()
+            await asyncio.gather(reached_order, form_ready, return_exceptions=True)
+
+        await fb_popup.fill('input[name="email"]', FB_EMAIL)
+        await fb_popup.fill('input[name="pass"]', FB_PASS)
+        await fb_popup.click('button[name="login"], input[name="login"]')
+        await page.wait_for_url("**/customer/order**", timeout=LOGIN_TIMEOUT)
+
+    async def login(self):
+        browser = await self._ensure_browser()
+        state = self.state_file if os.path.exists(self.state_file) else None
+        context = await browser.new_context(
+            user_agent=BROWSER_USER_AGENT,
+            viewport={'width': 1280, 'height': 720},
+            storage_state=state
+        )
+        try:
             page = await context.new_page()
-            
-            await page.goto("https://www.smile.one/customer/login")
-            await asyncio.sleep(5) 
-            
-            async with context.expect_page() as popup_info:
-                await page.locator("a.login-btn-facebook, a[href*='facebook.com']").first.click()
-            
-            fb_popup = await popup_info.value
-            await fb_popup.wait_for_load_state()
-            
-            await asyncio.sleep(2)
-            await fb_popup.fill('input[name="email"]', FB_EMAIL)
-            await asyncio.sleep(1)
-            await fb_popup.fill('input[name="pass"]', FB_PASS)
-            await asyncio.sleep(1)
-            
-            await fb_popup.click('button[name="login"], input[name="login"]')
-            
-            try:
-                await page.wait_for_url("**/customer/order**", timeout=30000)
-                print("✅ Auto-Login successful. Saving Cookie...")
-                
-                cookies = await context.cookies()
-                cookie_dict = {cookie['name']: cookie['value'] for cookie in cookies}
-                raw_cookie_str = "; ".join([f"{k}={v}" for k, v in cookie_dict.items()])
-                
-                await update_main_cookie(raw_cookie_str)
-                await browser.close()
+            await page.goto(SMILE_ORDER_URL, wait_until='domcontentloaded')
+            if "login" not in page.url.lower():
+                print("✅ Session refreshed from saved browser state. Saving Cookie...")
+                await self._finish(context)
                 return True
+
+            if not FB_EMAIL or not FB_PASS:
+                print("❌ FB_EMAIL and FB_PASS are missing in .env.")
+                return False
+            print("Logging in with Facebook to fetch new Cookie...")
+            try:
+                await self._facebook_login(context, page)
             except Exception as wait_e:
                 print(f"❌ Did not reach the Order page. (Possible Facebook Checkpoint): {wait_e}")
-                await browser.close()
                 return False
-            
+            print("✅ Auto-Login successful. Saving Cookie...")
+            await self._finish(context)
+            return True
+        finally:
+            await context.close()
+
+    async def close(self):
+        if self._browser is not None:
+            with contextlib.suppress(Exception): await self._browser.close()
+        if self._playwright is not None:
+            with contextlib.suppress(Exception): await self._playwright.stop()
+        self._browser = self._playwright = None
+
+
+login_browser = LoginBrowser(BROWSER_STATE_FILE)
+
+async def auto_login_and_get_cookie():
+    try:
+        return await login_browser.login()
     except Exception as e:
         print(f"❌ Error during Auto-Login: {e}")
+        # Drop a browser that may be wedged; the next login starts a fresh one
+        await login_browser.close()
         return False
 
+LOGIN_FAILURE_COOLDOWN = float(os.getenv('LOGIN_FAILURE_COOLDOWN', 120))
+LOGIN_FRESH_WINDOW = float(os.getenv('LOGIN_FRESH_WINDOW', 15))
+
+class SessionRenewal:
+    # Single flight: however many orders notice the expired cookie, one login runs and all of them await it.
+    # A login that just succeeded is reused by late reporters; a failed one is not retried until the cooldown ends.
+    def __init__(self):
+        self._flight = None
+        self._succeeded_at = 0.0
+        self._failed_at = 0.0
+
+    @property
+    def in_flight(self):
+        return self._flight is not None and not self._flight.done()
+
+    async def settled(self):
+        # Orders starting while a login runs wait for the new cookie instead of hitting the login page
+        if self.in_flight:
+            with contextlib.suppress(Exception): await asyncio.shield(self._flight)
+
+    async def renew(self):
+        if not self.in_flight:
+            now = time.monotonic()
+            if now - self._succeeded_at < LOGIN_FRESH_WINDOW:
+                return True
+            if now - self._failed_at < LOGIN_FAILURE_COOLDOWN:
+                print(f"⏳ Auto-Login failed {now - self._failed_at:.0f}s ago; cooling down.")
+                return False
+            self._flight = asyncio.ensure_future(self._login())
+        return await asyncio.shield(self._flight)
+
+    async def _login(self):
+        success = await auto_login_and_get_cookie()
+        if success: self._succeeded_at = time.monotonic()
+        else: self._failed_at = time.monotonic()
+        return success
+
+
+session_renewal = SessionRenewal()
+
 # ==========================================
 # 📌 PACKAGES
 # ==========================================
@@ -256,7 +1597,7 @@ BR_PACKAGES = {
     '172': [{'pid': '23', 'price': 122.0, 'name': '172 💎'}],
     '257': [{'pid': '25', 'price': 177.5, 'name': '257 💎'}],
     '343': [{'pid': '13', 'price': 61.5, 'name': '86 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}],
-    '429': [{'pid': '23', 'price': 122.0, 'name': '86 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}],
+    '429': [{'pid': '23', 'price': 122.0, 'name': '172 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}],
     '514': [{'pid': '25', 'price': 177.5, 'name': '257 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}],
     '600': [{'pid': '13', 'price': 61.5, 'name': '86 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}, {'pid': '25', 'price': 177.5, 'name': '257 💎'}],
     '706': [{'pid': '26', 'price': 480.0, 'name': '706 💎'}],
@@ -280,7 +1621,7 @@ BR_PACKAGES = {
     'wp': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp2': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp3': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
-    'wp4': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
+    'wp4': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp5': [{'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '16642', 'price': 76.0, 'name': 'Weekly Pass'}],
 }
 
@@ -297,9 +1638,9 @@ MCC_PACKAGES = {
     '172': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}],
     '257': [{'pid': '23827', 'price': 187.0, 'name': '257 💎'}],
     '343': [{'pid': '23828', 'price': 250.0, 'name': '343 💎'}],
-    '429': [{'pid': '23826', 'price': 122.0, 'name': '172 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}],
+    '429': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}],
     '516': [{'pid': '23829', 'price': 375.0, 'name': '516 💎'}],
-    '600': [{'pid': '23825', 'price': 62.5, 'name': '86 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}, {'pid': '23827', 'price': 177.5, 'name': '257 💎'}],
+    '600': [{'pid': '23825', 'price': 62.5, 'name': '86 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}],
     '706': [{'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
     '878': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
     '963': [{'pid': '23827', 'price': 187.0, 'name': '257 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
@@ -307,7 +1648,7 @@ MCC_PACKAGES = {
     '1135': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
     '1346': [{'pid': '23831', 'price': 937.5, 'name': '1346 💎'}],
     '1412': [{'pid': '23830', 'price': 500.0, 'name': '706 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
-    '1584': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}, {'pid': '23830', 'price': 480.0, 'name': '706 💎'}],
+    '1584': [{'pid': '23826', 'price': 125.0, 'name': '172 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
     '1755': [{'pid': '23825', 'price': 62.5, 'name': '86 💎'}, {'pid': '23827', 'price': 187.0, 'name': '257 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}, {'pid': '23830', 'price': 500.0, 'name': '706 💎'}],
     '1825': [{'pid': '23832', 'price': 1250.0, 'name': '1825 💎'}],
     '2195': [{'pid': '23833', 'price': 1500.0, 'name': '2195 💎'}],
@@ -324,278 +1665,937 @@ MCC_PACKAGES = {
     'wp': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp2': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp3': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
-    'wp4': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
+    'wp4': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
     'wp5': [{'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}, {'pid': '23841', 'price': 76.0, 'name': 'Weekly Pass'}],
 }
 
+# ==========================================
+# 🧮 DIAMOND PLANNER (CHEAPEST COMBINATION FOR ANY AMOUNT)
+# ==========================================
+PLANNER_MAX_DIAMONDS = int(os.getenv('PLANNER_MAX_DIAMONDS', 30000))
+# A planned amount is one paid order per item; anything that needs more is rejected
+PLANNER_MAX_ITEMS = int(os.getenv('PLANNER_MAX_ITEMS', 5))
+
+class DiamondPlanner:
+    # Unbounded knapsack over the single-pid diamond products of a catalog: for every total up to max_amount
+    # keep the cheapest combination (fewest items on equal price). Prices are compared in cents.
+    def __init__(self, packages, max_amount, max_items=PLANNER_MAX_ITEMS):
+        self.items = []
+        for key, items in packages.items():
+            if key.isdigit() and len(items) == 1 and items[0]['name'] == f"{key} 💎":
+                self.items.append((int(key), round(items[0]['price'] * 100), items[0]))
+        self.max_amount = max_amount
+        self.max_items = max_items
+        self._last = [-1] * (max_amount + 1)
+        cost = [None] * (max_amount + 1)
+        count = [0] * (max_amount + 1)
+        cost[0] = 0
+        for total in range(1, max_amount + 1):
+            best = None
+            for index, (amount, price, _) in enumerate(self.items):
+                prev = total - amount
+                if prev < 0 or cost[prev] is None: continue
+                candidate = (cost[prev] + price, count[prev] + 1)
+                if best is None or candidate < best:
+                    best = candidate
+                    self._last[total] = index
+            if best is not None:
+                cost[total], count[total] = best
+        self._cost = cost
+        self._count = count
+
+    def total(self, amount):
+        return self._cost[int(amount)] / 100
+
+    def plan(self, amount):
+        amount = int(amount) if str(amount).isdigit() else 0
+        if amount <= 0 or amount > self.max_amount or self._cost[amount] is None:
+            return None
+        if self._count[amount] > self.max_items:
+            return None
+        items = []
+        while amount:
+            size, _, item = self.items[self._last[amount]]
+            items.append(item)
+            amount -= size
+        items.sort(key=lambda item: int(item['name'].split()[0]))
+        return items
+
+# ==========================================
+# 📦 PRODUCT CATALOG (COMPILED INDEX + HOT RELOAD)
+# ==========================================
+CATALOG_FILE = os.getenv('CATALOG_FILE', 'catalog.json')
+CATALOG_POLL_INTERVAL = float(os.getenv('CATALOG_POLL_INTERVAL', 5))
+
+class CatalogEntry(NamedTuple):
+    region: str
+    items: tuple
+    pids: tuple
+    total: float
+
+def catalog_entry(region, items):
+    items = tuple(items)
+    return CatalogEntry(region, items, tuple(item['pid'] for item in items), round(sum(item['price'] for item in items), 2))
+
+def render_price_list(entries):
+    return "\n".join(f"{key:<5} : ${entry.total:,.2f}" for key, entry in entries)
+
+# Command prefix -> wallet for planned amounts; listed packs ignore it
+PREFIX_REGIONS = {'br': 'BR', 'b': 'BR', 'mlb': 'BR', 'ph': 'PH', 'p': 'PH', 'mlp': 'PH'}
+
+class CompiledCatalog:
+    # Built once per catalog file version and never mutated; a reload swaps in a whole new instance
+    def __init__(self, data):
+        double, br, ph, mcc = data['double'], data['br'], data['ph'], data['mcc']
+        self.planners = MappingProxyType({
+            'BR': DiamondPlanner(br, PLANNER_MAX_DIAMONDS),
+            'PH': DiamondPlanner(ph, PLANNER_MAX_DIAMONDS),
+            'MCC': DiamondPlanner(mcc, PLANNER_MAX_DIAMONDS),
+        })
+        self.explicit = MappingProxyType({
+            region: MappingProxyType({key.lower(): catalog_entry(region, items) for key, items in packages.items()})
+            for region, packages in (('BR', br), ('PH', ph), ('MCC', mcc))
+        })
+        self.bonus = MappingProxyType({key.lower(): catalog_entry('BR', items) for key, items in double.items()})
+        # Lists are rendered from the same resolution the handlers use, so the shown price is the charged price
+        self.lists = MappingProxyType({
+            'BR': (
+                f"🇧🇷 <b>𝘿𝙤𝙪𝙗𝙡𝙚 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
+                f"<code>{render_price_list(self.bonus.items())}</code>\n\n"
+                f"🇧🇷 <b>𝘽𝙧 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
+                f"<code>{render_price_list(self._listed(br, self.resolve_direct))}</code>"
+            ),
+            'PH': (
+                f"🇵🇭 <b>𝙋𝙝 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
+                f"<code>{render_price_list(self._listed(ph, self.resolve_direct))}</code>"
+            ),
+            'MCC': (
+                f"🇧🇷 <b>𝙈𝘾𝘾 𝙋𝘼𝘾𝙆𝘼𝙂𝙀𝙎</b>\n"
+                f"<code>{render_price_list(self._listed(mcc, self.resolve_mcc))}</code>"
+            ),
+        })
+
+    def _listed(self, packages, resolve):
+        for key in packages:
+            entry = resolve(key.lower())
+            if entry is not None:
+                yield key, entry
+
+    def _plan(self, region, item_input):
+        items = self.planners[region].plan(item_input)
+        if items is None: return None
+        return CatalogEntry(region, tuple(items), tuple(item['pid'] for item in items), self.planners[region].total(item_input))
+
+    def resolve(self, region, item_input):
+        # Diamond amounts from the region's planner, passes from its explicit catalog
+        return self._plan(region, item_input) or self.explicit[region].get(item_input)
+
+    def resolve_direct(self, item_input, region=None):
+        # Listed packs buy the same thing whatever the command: bonus, then BR, then PH.
+        # Only amounts no catalog lists are planned, in the br/ph prefix's wallet (msc: BR, else PH)
+        if item_input in self.bonus:
+            return self.bonus[item_input]
+        for listed_region in ('BR', 'PH'):
+            if item_input in self.explicit[listed_region]:
+                return self.explicit[listed_region][item_input]
+        if region is not None:
+            return self._plan(region, item_input)
+        return self._plan('BR', item_input) or self._plan('PH', item_input)
+
+    def resolve_mcc(self, item_input):
+        return self.resolve('MCC', item_input)
+
+
+def default_catalog_data():
+    return {'double': DOUBLE_DIAMOND_PACKAGES, 'br': BR_PACKAGES, 'ph': PH_PACKAGES, 'mcc': MCC_PACKAGES}
+
+def catalog_signature(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+def load_catalog_file(path):
+    if not os.path.exists(path):
+        # First start: seed the file from the built-in packages so prices can be edited without touching psp.py
+        write_json_atomic(path, default_catalog_data())
+    with open(path, 'r', encoding='utf-8') as f:
+        return CompiledCatalog(json.load(f))
+
+class CatalogWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+
+    def load(self):
+        global catalog
+        try:
+            catalog = load_catalog_file(self.path)
+        except Exception as e:
+            print(f"⚠️ Catalog file {self.path} unusable, using built-in packages: {e}")
+        self.signature = catalog_signature(self.path)
+
+    async def run(self):
+        global catalog
+        while True:
+            await asyncio.sleep(CATALOG_POLL_INTERVAL)
+            signature = catalog_signature(self.path)
+            if signature is None or signature == self.signature: continue
+            self.signature = signature
+            try:
+                catalog = await work_executor.run(load_catalog_file, self.path)
+                print(f"📦 Catalog reloaded from {self.path}")
+            except Exception as e:
+                print(f"⚠️ Catalog reload failed, keeping the previous one: {e}")
+
+
+catalog = CompiledCatalog(default_catalog_data())
+catalog_watcher = CatalogWatcher(CATALOG_FILE)
+
+# ==========================================
+# 🔎 PAGE EXTRACTOR (CSRF / BALANCE / LOGIN / REGION)
+# ==========================================
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# One scan over the page picks up every field; bs4 is only used when a field's container is present but the pattern missed
+PAGE_SCAN_RE = re.compile(r"""
+    (?P<meta><meta\b[^>]*?\bname=["']csrf-token["'][^>]*>)
+  | (?P<input><input\b[^>]*?\bname=["']_csrf["'][^>]*>)
+  | Saldo\ PH[\s:]*?</span>\s*<span>\s*(?P<ph>[\d.,]+)
+  | (?:Balance|Saldo)[\s:]*?</p>\s*<p>\s*(?P<br>[\d.,]+)
+  | (?P<cf>cloudflare)
+""", re.I | re.X)
+TAG_VALUE_RE = re.compile(r"""\b(?:content|value)=["']([^"']*)["']""", re.I)
+PIZZO_TABLE_RE = re.compile(r"""<table\b[^>]*\bclass=["'][^"']*\btable-modern\b.*?</table>""", re.I | re.S)
+PIZZO_ROW_RE = re.compile(r'<th\b[^>]*>((?:(?!</tr>).)*?)</th>(?:(?!</tr>).)*?<td\b[^>]*>((?:(?!</tr>).)*?)</td>', re.I | re.S)
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+class PageInfo(NamedTuple):
+    status_code: int
+    csrf_token: Optional[str]
+    br_balance: Optional[float]
+    ph_balance: Optional[float]
+    login_required: bool
+    cloudflare: bool
+
+    @property
+    def blocked(self):
+        return self.status_code in (403, 503) or self.cloudflare
+
+
+def parse_amount(text):
+    try:
+        return float(text.strip().replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+def tag_value(tag):
+    match = TAG_VALUE_RE.search(tag)
+    return match.group(1) if match else None
+
+def extract_page(response):
+    text = response.text
+    meta_token = input_token = br = ph = None
+    cloudflare = False
+    for match in PAGE_SCAN_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == 'meta' and meta_token is None: meta_token = tag_value(match.group('meta'))
+        elif kind == 'input' and input_token is None: input_token = tag_value(match.group('input'))
+        elif kind == 'br' and br is None: br = parse_amount(match.group('br'))
+        elif kind == 'ph' and ph is None: ph = parse_amount(match.group('ph'))
+        elif kind == 'cf': cloudflare = True
+    csrf_token = meta_token or input_token
+
+    need_csrf = not csrf_token and ('_csrf' in text or 'csrf-token' in text)
+    need_br = br is None and 'balance-coins' in text
+    need_ph = ph is None and 'all-balance' in text
+    if need_csrf or need_br or need_ph:
+        soup = BeautifulSoup(text, HTML_PARSER)
+        if need_csrf:
+            meta_tag = soup.find('meta', {'name': 'csrf-token'})
+            csrf_input = soup.find('input', {'name': '_csrf'})
+            csrf_token = (meta_tag and meta_tag.get('content')) or (csrf_input and csrf_input.get('value')) or None
+        main_balance_div = soup.find('div', class_='balance-coins') if need_br else None
+        if main_balance_div:
+            p_tags = main_balance_div.find_all('p')
+            if len(p_tags) >= 2: br = parse_amount(p_tags[1].text)
+        ph_balance_container = soup.find('div', id='all-balance') if need_ph else None
+        if ph_balance_container:
+            span_tags = ph_balance_container.find_all('span')
+            if len(span_tags) >= 2: ph = parse_amount(span_tags[1].text)
+
+    login_required = response.status_code in (401, 419) or 'login' in str(response.url).lower()
+    return PageInfo(response.status_code, csrf_token, br, ph, login_required, cloudflare)
+
+def clean_cell(cell_html):
+    return html.unescape(TAG_RE.sub('', cell_html)).strip()
+
+def extract_pizzo_region(page_html):
+    table = PIZZO_TABLE_RE.search(page_html)
+    if not table: return None
+    rows = PIZZO_ROW_RE.findall(table.group(0))
+    if not rows:
+        soup_table = BeautifulSoup(table.group(0), HTML_PARSER)
+        rows = [(str(r.find('th')), str(r.find('td'))) for r in soup_table.find_all('tr') if r.find('th') and r.find('td')]
+    region = None
+    for th, td in rows:
+        if 'region' in clean_cell(th).lower():
+            region = clean_cell(td)
+    return region
+
+# ==========================================
+# 🔑 CSRF TOKEN CACHE
+# ==========================================
+CSRF_TTL = float(os.getenv('CSRF_TTL', 10 * 60))
+
+class CsrfCache:
+    # csrf-token per (merchant page, cookie version); the page URL already encodes region and merchant
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._tokens = {}
+
+    def get(self, page_url):
+        entry = self._tokens.get((page_url, scraper_pool.version))
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def put(self, page_url, token):
+        self._tokens[(page_url, scraper_pool.version)] = (token, time.monotonic() + self.ttl)
+
+    def invalidate(self, page_url=None):
+        if page_url is None:
+            self._tokens.clear()
+        else:
+            self._tokens.pop((page_url, scraper_pool.version), None)
+
+    def check(self, page_url, response):
+        # Drop the token when a POST made with it comes back as a CSRF / session failure
+        if is_csrf_failure(response):
+            self.invalidate(page_url)
+
+
+csrf_cache = CsrfCache(CSRF_TTL)
+
+def is_csrf_failure(response):
+    if response.status_code in (401, 419) or "login" in response.url.lower():
+        return True
+    try:
+        result = response.json()
+    except Exception:
+        return 'page expired' in response.text[:2000].lower()
+    if not isinstance(result, dict):
+        return False
+    real_error = str(result.get('msg') or result.get('message') or "").lower()
+    return any(word in real_error for word in ('csrf', 'login', 'unauthorized', 'expired'))
+
+async def get_csrf_token(scraper, page_url, headers):
+    # Returns (token, PageInfo of the merchant page). The page is None when the token came from the cache.
+    csrf_token = csrf_cache.get(page_url)
+    if csrf_token:
+        return csrf_token, None
+
+    page = extract_page(await scraper.get(page_url, headers=headers))
+    if page.csrf_token:
+        csrf_cache.put(page_url, page.csrf_token)
+    return page.csrf_token, page
+
+async def post_with_csrf(scraper, page_url, url, data, headers, page_headers=None, pace=None):
+    # POST carrying a (possibly cached) token. When smile.one rejects the token, a fresh one is fetched from
+    # page_url and the request is sent once more; the token that worked stays in csrf_cache for later calls.
+    # pace is (endpoint, region) for requests that go through the pacer.
+    async def send(form):
+        call = scraper.post(url, data=form, headers=headers)
+        return await (pacer.request(pace[0], pace[1], call) if pace else call)
+
+    response = await send(data)
+    if not is_csrf_failure(response):
+        return response
+    csrf_cache.invalidate(page_url)
+    token, page = await get_csrf_token(scraper, page_url, page_headers or headers)
+    if not token or token == data.get('_csrf') or (page is not None and page.login_required):
+        return response  # not a stale token (logged out); the caller handles it
+    response = await send(dict(data, _csrf=token))
+    csrf_cache.check(page_url, response)
+    return response
+
+# ==========================================
+# 🪪 CHECKROLE CACHE (game_id, zone_id → IGN / region)
+# ==========================================
+ROLE_CACHE_SIZE = int(os.getenv('ROLE_CACHE_SIZE', 5000))
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', 6 * 60 * 60))
+ROLE_NEGATIVE_TTL = float(os.getenv('ROLE_NEGATIVE_TTL', 5 * 60))
+
+class RoleInfo(NamedTuple):
+    ig_name: Optional[str]
+    smile_region: str
+    pizzo_region: Optional[str]
+    error: Optional[str]
+    login_required: bool = False
+
+    @property
+    def found(self):
+        return bool(self.ig_name)
+
+
+class RoleCache:
+    # Verified accounts per (game, game_id, zone_id), LRU-bounded; "account not found" is kept for a shorter TTL
+    def __init__(self, size, ttl, negative_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+
+    def get(self, game, game_id, zone_id):
+        key = (game, game_id, zone_id)
+        entry = self._entries.get(key)
+        if entry is None: return None
+        info, expires = entry
+        if time.monotonic() >= expires:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def put(self, game, game_id, zone_id, info):
+        key = (game, game_id, zone_id)
+        self._entries[key] = (info, time.monotonic() + (self.ttl if info.found else self.negative_ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def set_pizzo_region(self, game, game_id, zone_id, region):
+        entry = self._entries.get((game, game_id, zone_id))
+        if entry is not None:
+            info, expires = entry
+            self._entries[(game, game_id, zone_id)] = (info._replace(pizzo_region=region), expires)
+
+
+role_cache = RoleCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL, ROLE_NEGATIVE_TTL)
+
+async def lookup_role(scraper, game, main_url, checkrole_url, headers, csrf_token, game_id, zone_id, region='BR'):
+    # Raises ValueError when checkrole does not answer with JSON
+    info = role_cache.get(game, game_id, zone_id)
+    if info is not None:
+        return info
+
+    role_response_raw = await post_with_csrf(scraper, main_url, checkrole_url, {'user_id': game_id, 'zone_id': zone_id, '_csrf': csrf_token}, headers, pace=('checkrole', region))
+    if is_csrf_failure(role_response_raw):
+        # Still rejected after post_with_csrf's fresh-token retry: the cookie itself is logged out
+        return RoleInfo(None, "Unknown", None, "Session expired (login required).", login_required=True)
+    role_result = role_response_raw.json()
+    data = role_result.get('data') if isinstance(role_result.get('data'), dict) else {}
+    ig_name = role_result.get('username') or data.get('username')
+    smile_region = role_result.get('zone') or role_result.get('region') or data.get('zone') or "Unknown"
+
+    if not ig_name or str(ig_name).strip() == "":
+        real_error = str(role_result.get('msg') or role_result.get('message') or "Account not found.")
+        info = RoleInfo(None, smile_region, None, real_error)
+        # Session problems say nothing about the account, so they are never cached
+        if not any(word in real_error.lower() for word in ('login', 'unauthorized', 'csrf', 'expired')):
+            role_cache.put(game, game_id, zone_id, info)
+        return info
+
+    info = RoleInfo(ig_name, smile_region, None, None)
+    role_cache.put(game, game_id, zone_id, info)
+    return info
+
 # ==========================================
 # 2. FUNCTION TO GET REAL BALANCE (ASYNC WRAPPED)
 # ==========================================
 async def get_smile_balance(scraper, headers, balance_url='https://www.smile.one/customer/order'):
     balances = {'br_balance': 0.00, 'ph_balance': 0.00}
     try:
-        response = await asyncio.to_thread(scraper.get, balance_url, headers=headers)
-        br_match = re.search(r'(?i)(?:Balance|Saldo)[\s:]*?<\/p>\s*<p>\s*([\d\.,]+)', response.text)
-        if br_match: balances['br_balance'] = float(br_match.group(1).replace(',', ''))
-        else:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            main_balance_div = soup.find('div', class_='balance-coins')
-            if main_balance_div:
-                p_tags = main_balance_div.find_all('p')
-                if len(p_tags) >= 2: balances['br_balance'] = float(p_tags[1].text.strip().replace(',', ''))
-                    
-        ph_match = re.search(r'(?i)Saldo PH[\s:]*?<\/span>\s*<span>\s*([\d\.,]+)', response.text)
-        if ph_match: balances['ph_balance'] = float(ph_match.group(1).replace(',', ''))
-        else:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            ph_balance_container = soup.find('div', id='all-balance')
-            if ph_balance_container:
-                span_tags = ph_balance_container.find_all('span')
-                if len(span_tags) >= 2: balances['ph_balance'] = float(span_tags[1].text.strip().replace(',', ''))
+        page = extract_page(await scraper.get(balance_url, headers=headers))
+        if page.br_balance is not None: balances['br_balance'] = page.br_balance
+        if page.ph_balance is not None: balances['ph_balance'] = page.ph_balance
     except Exception: pass
     return balances
 
 # ==========================================
-# 3. SMILE.ONE SCRAPER FUNCTION (MLBB) [FULLY ASYNC & FIXED FALSE POSITIVE]
+# 📒 BALANCE LEDGER (BR / PH)
 # ==========================================
-async def process_smile_one_order(game_id, zone_id, product_id, currency_name, seen_order_ids=None):
-    if seen_order_ids is None:
-        seen_order_ids = []
-        
-    scraper = await get_main_scraper()
-
-    if currency_name == 'PH':
-        main_url = 'https://www.smile.one/ph/merchant/mobilelegends'
-        checkrole_url = 'https://www.smile.one/ph/merchant/mobilelegends/checkrole'
-        query_url = 'https://www.smile.one/ph/merchant/mobilelegends/query'
-        pay_url = 'https://www.smile.one/ph/merchant/mobilelegends/pay'
-        order_api_url = 'https://www.smile.one/ph/customer/activationcode/codelist'
-    else:
-        main_url = 'https://www.smile.one/merchant/mobilelegends'
-        checkrole_url = 'https://www.smile.one/merchant/mobilelegends/checkrole'
-        query_url = 'https://www.smile.one/merchant/mobilelegends/query'
-        pay_url = 'https://www.smile.one/merchant/mobilelegends/pay'
-        order_api_url = 'https://www.smile.one/customer/activationcode/codelist'
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'X-Requested-With': 'XMLHttpRequest', 
-        'Referer': main_url, 
-        'Origin': 'https://www.smile.one'
-    }
-
-    try:
-        response = await asyncio.to_thread(scraper.get, main_url, headers=headers)
-        if response.status_code in [403, 503] or "cloudflare" in response.text.lower():
-             return {"status": "error", "message": "Blocked by Cloudflare."}
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        csrf_token = None
-        meta_tag = soup.find('meta', {'name': 'csrf-token'})
-        if meta_tag: csrf_token = meta_tag.get('content')
+LEDGER_RECONCILE_INTERVAL = float(os.getenv('LEDGER_RECONCILE_INTERVAL', 15))
+LEDGER_STALE_AFTER = float(os.getenv('LEDGER_STALE_AFTER', 30))
+LEDGER_DRIFT_TOLERANCE = float(os.getenv('LEDGER_DRIFT_TOLERANCE', 0.01))
+# Reconcile cycles a region may be skipped for in-flight orders before it is reconciled anyway
+LEDGER_MAX_SKIPS = int(os.getenv('LEDGER_MAX_SKIPS', 4))
+BALANCE_URLS = {'BR': 'https://www.smile.one/customer/order', 'PH': 'https://www.smile.one/ph/customer/order'}
+
+async def fetch_region_balance(region):
+    headers = {'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://www.smile.one'}
+    async with http_session() as scraper:
+        page = extract_page(await scraper.get(BALANCE_URLS[region], headers=headers))
+    value = page.br_balance if region == 'BR' else page.ph_balance
+    if page.login_required or value is None:
+        raise RuntimeError(f"{region} balance not found on smile.one (cookie expired?)")
+    return value
+
+
+class BalanceLedger:
+    # Local view of the official balance per region. Seeded from a scrape, debited on every successful pay,
+    # credited on topups, and reconciled against smile.one in the background.
+    def __init__(self, regions=('BR', 'PH')):
+        self.regions = regions
+        self.balances = {}
+        self.synced_at = {}
+        self.drift = {}
+        self._ops = {r: 0 for r in regions}
+        self._busy = {r: 0 for r in regions}
+        self.reserved = {r: 0.0 for r in regions}
+        self._skipped = {r: 0 for r in regions}
+        # Pays not committed yet: POSTs in flight (or answered ambiguously), and the total of POSTs smile.one
+        # accepted whose confirmation is pending. _pay_events counts every pay POST started.
+        self._posting = {r: 0 for r in regions}
+        self._accepted = {r: 0.0 for r in regions}
+        self._pay_events = {r: 0 for r in regions}
+        self._refreshing = {}
+
+    def peek(self, region):
+        return self.balances.get(region)
+
+    def available(self, region):
+        return round(self.balances.get(region, 0.0) - self.reserved[region], 2)
+
+    async def reserve(self, region, amount):
+        # Check-and-hold happens with no await in between, so concurrent orders can't both take the same money.
+        # Returns None when the unreserved balance is too small.
+        await self.get(region)
+        if self.available(region) < amount:
+            return None
+        self.reserved[region] += amount
+        self._busy[region] += 1
+        return Reservation(self, region, amount)
+
+    def age(self, region):
+        synced = self.synced_at.get(region)
+        return None if synced is None else time.monotonic() - synced
+
+    async def get(self, region):
+        # Stale-while-revalidate: a stale value is returned immediately and refreshed in the background
+        if region not in self.balances:
+            await self.refresh(region)
+        elif self.age(region) > LEDGER_STALE_AFTER:
+            self.refresh(region)
+        return self.balances[region]
+
+    def refresh(self, region, force=False):
+        task = self._refreshing.get(region)
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(self._refresh(region, force))
+            task.add_done_callback(self._log_failure)
+            self._refreshing[region] = task
+        return task
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ Balance refresh failed: {task.exception()}")
+
+    async def _refresh(self, region, force=False):
+        # force: adopt the remote value even though orders hold reservations. smile.one has already charged
+        # the pays it accepted that we haven't committed yet, so those are added back (their commit will
+        # debit them); a pay POST in flight makes the remote value ambiguous, so that cycle is skipped.
+        ops = self._ops[region]
+        pay_events = self._pay_events[region]
+        posting = self._posting[region]
+        remote = await fetch_region_balance(region)
+        if region in self.balances:
+            if self._ops[region] != ops:
+                return  # a purchase or topup moved the balance while we were fetching; try again next cycle
+            if self._busy[region]:
+                if not force or posting or self._posting[region] or self._pay_events[region] != pay_events:
+                    return
+                remote = round(remote + self._accepted[region], 2)
+        local = self.balances.get(region)
+        if local is not None and abs(local - remote) > LEDGER_DRIFT_TOLERANCE:
+            self.drift[region] = round(local - remote, 2)
+            print(f"⚠️ {region} balance drift: ledger {local:,.2f} vs smile.one {remote:,.2f}")
+        self.balances[region] = remote
+        self.synced_at[region] = time.monotonic()
+        self._skipped[region] = 0
+
+    def debit(self, region, amount):
+        if region in self.balances:
+            self.balances[region] = round(self.balances[region] - amount, 2)
+        self._ops[region] += 1
+
+    def credit(self, region, amount):
+        if region in self.balances:
+            self.balances[region] = round(self.balances[region] + amount, 2)
+        self._ops[region] += 1
+
+    @contextlib.contextmanager
+    def busy(self, *regions):
+        # The reconciler leaves a region alone while money is moving in it
+        for r in regions: self._busy[r] += 1
+        try:
+            yield
+        finally:
+            for r in regions: self._busy[r] -= 1
+
+    async def reconcile(self):
+        for region in self.regions:
+            force = False
+            if self._busy[region]:
+                # Under steady load the region is never idle; after a few skipped cycles reconcile regardless
+                self._skipped[region] += 1
+                if self._skipped[region] <= LEDGER_MAX_SKIPS: continue
+                force = True
+            try:
+                await self.refresh(region, force)
+            except Exception:
+                pass  # already logged by _log_failure
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+            await self.reconcile()
+
+
+class Reservation:
+    # Escrow for one order line: commit() as each item is paid, leftover is released when the block exits
+    def __init__(self, ledger, region, amount):
+        self.ledger = ledger
+        self.region = region
+        self.remaining = amount
+        self._in_flight = None
+        self._accepted = False
+
+    def sending(self, amount):
+        # A pay POST for `amount` is about to go out
+        self.settle()
+        self._in_flight = amount
+        self._accepted = False
+        self.ledger._posting[self.region] += 1
+        self.ledger._pay_events[self.region] += 1
+
+    def sent(self, accepted):
+        # smile.one answered the POST; an accepted pay is charged there before we confirm and commit it
+        if self._in_flight is None or self._accepted or not accepted: return
+        self._accepted = True
+        self.ledger._posting[self.region] -= 1
+        self.ledger._accepted[self.region] = round(self.ledger._accepted[self.region] + self._in_flight, 2)
+
+    def settle(self):
+        # The in-flight pay was committed or turned out unpaid
+        if self._in_flight is None: return
+        if self._accepted:
+            self.ledger._accepted[self.region] = round(self.ledger._accepted[self.region] - self._in_flight, 2)
         else:
-            csrf_input = soup.find('input', {'name': '_csrf'})
-            if csrf_input: csrf_token = csrf_input.get('value')
+            self.ledger._posting[self.region] -= 1
+        self._in_flight = None
 
-        if not csrf_token: return {"status": "error", "message": "CSRF Token not found. Add a new Cookie using /setcookie."}
+    def commit(self, amount):
+        self.settle()
+        held = min(amount, self.remaining)
+        self.remaining -= held
+        self.ledger.reserved[self.region] -= held
+        self.ledger.debit(self.region, amount)
 
-        check_data = {'user_id': game_id, 'zone_id': zone_id, '_csrf': csrf_token}
-        role_response_raw = await asyncio.to_thread(scraper.post, checkrole_url, data=check_data, headers=headers)
-        try:
-            role_result = role_response_raw.json()
-            ig_name = role_result.get('username') or role_result.get('data', {}).get('username')
-            if not ig_name or str(ig_name).strip() == "":
-                real_error = role_result.get('msg') or role_result.get('message') or "Account not found."
-                return {"status": "error", "message": f"❌ Invalid Account: {real_error}"}
-        except Exception: return {"status": "error", "message": "Check Role API Error: Cannot verify account."}
-
-        query_data = {'user_id': game_id, 'zone_id': zone_id, 'pid': product_id, 'checkrole': '', 'pay_methond': 'smilecoin', 'channel_method': 'smilecoin', '_csrf': csrf_token}
-        query_response_raw = await asyncio.to_thread(scraper.post, query_url, data=query_data, headers=headers)
-        
-        try: query_result = query_response_raw.json()
-        except Exception: return {"status": "error", "message": "Query API Error"}
-            
-        flowid = query_result.get('flowid') or query_result.get('data', {}).get('flowid')
-        
-        if not flowid:
-            real_error = query_result.get('msg') or query_result.get('message') or ""
-            if "login" in str(real_error).lower() or "unauthorized" in str(real_error).lower():
-                print("⚠️ Cookie expired. Starting Auto-Login...")
-                success = await auto_login_and_get_cookie()
-                if success: return {"status": "error", "message": "Session renewed. Please enter the command again."}
-                else: return {"status": "error", "message": "❌ Auto-Login failed. Please provide /setcookie again."}
-            return {"status": "error", "message": f"❌ **Invalid Account/Server:** {real_error}"}
-
-        pay_data = {'_csrf': csrf_token, 'user_id': game_id, 'zone_id': zone_id, 'pay_methond': 'smilecoin', 'product_id': product_id, 'channel_method': 'smilecoin', 'flowid': flowid, 'email': '', 'coupon_id': ''}
-        pay_response_raw = await asyncio.to_thread(scraper.post, pay_url, data=pay_data, headers=headers)
-        
-        is_success = False
-        real_order_id = "Not found"
-        err_text = "Unknown Error"
-        
-        try:
-            pay_json = pay_response_raw.json()
-            code = str(pay_json.get('code', pay_json.get('status', '')))
-            msg = str(pay_json.get('msg', pay_json.get('message', ''))).lower()
-            
-            # Code 200, 0, 1 (သို့) message ထဲမှာ success ပါရင် အောင်မြင်တယ်လို့ ယူဆပါတယ်
-            if code in ['200', '0', '1'] or 'success' in msg or 'sucesso' in msg or 'ok' in msg:
-                is_success = True
-                real_order_id = str(pay_json.get('data', {}).get('order_id', 'Not found'))
-            else:
-                err_text = pay_json.get('msg', 'Insufficient balance or API Error')
-        except Exception:
-            pay_text = pay_response_raw.text.lower()
-            if 'success' in pay_text or 'sucesso' in pay_text or 'ok' in pay_text:
-                is_success = True
-            else:
-                err_text = "Insufficient balance, Timeout or Blocked."
+    def release(self):
+        self.settle()
+        if self.remaining is None: return
+        self.ledger.reserved[self.region] = max(0.0, self.ledger.reserved[self.region] - self.remaining)
+        self.ledger._busy[self.region] -= 1
+        self.remaining = None
 
-        # 🚨 NEW SAFETY NET: ပိုက်ဆံဖြတ်ပြီး Error ပြနေရင်တောင် History ကို ထပ်စစ်ပါမယ် 🚨
-        await asyncio.sleep(2) 
-        try:
-            hist_res_raw = await asyncio.to_thread(scraper.get, order_api_url, params={'type': 'orderlist', 'p': '1', 'pageSize': '5'}, headers=headers)
-            hist_json = hist_res_raw.json()
-            if 'list' in hist_json and len(hist_json['list']) > 0:
-                for order in hist_json['list']:
-                    increment_id = str(order.get('increment_id', ''))
-                    
-                    # အရင်ဝယ်ပြီးသား ID တွေကို ကျော်ပါမယ်
-                    if increment_id in seen_order_ids:
-                        continue
-                        
-                    # အခု ID နဲ့ ကိုက်ပြီး Success ဖြစ်နေရင် အောင်မြင်ပါတယ်
-                    if str(order.get('user_id')) == str(game_id) and str(order.get('server_id')) == str(zone_id):
-                        if str(order.get('order_status', '')).lower() == 'success' or str(order.get('status')) == '1':
-                            is_success = True
-                            real_order_id = increment_id
-                            break
-        except Exception: 
-            pass
+    def __enter__(self):
+        return self
 
-        if is_success:
-            if real_order_id in ["Not found", "", "None"]:
-                real_order_id = f"AUTO_{int(time.time())}"
-            return {"status": "success", "ig_name": ig_name, "order_id": real_order_id}
-        else:
-            return {"status": "error", "message": f"{err_text}"}
+    def __exit__(self, *exc):
+        self.release()
 
-    except Exception as e: return {"status": "error", "message": f"System Error: {str(e)}"}
 
+class PackageProgress:
+    # purchase_package's per-item events for one order line: each confirmed item is committed against the
+    # line's reservation right away, and the events are passed on to the job journal (if any)
+    def __init__(self, reservation, items, journal=None):
+        self.reservation = reservation
+        self.prices = [item['price'] for item in items]
+        self.journal = journal
+        self.started = 0  # pays sent so far; the in-flight item is started - 1
 
-# 🌟 NEW: 3.1 MAGIC CHESS SCRAPER FUNCTION [FULLY ASYNC & FIXED FALSE POSITIVE] 🌟
-async def process_mcc_order(game_id, zone_id, product_id, seen_order_ids=None):
-    if seen_order_ids is None:
-        seen_order_ids = []
-        
-    scraper = await get_main_scraper()
+    async def baseline(self, ids):
+        if self.journal is not None: await self.journal.baseline(ids)
 
-    main_url = 'https://www.smile.one/br/merchant/game/magicchessgogo'
-    checkrole_url = 'https://www.smile.one/br/merchant/game/checkrole'
-    query_url = 'https://www.smile.one/br/merchant/game/query'
-    pay_url = 'https://www.smile.one/br/merchant/game/pay'
-    order_api_url = 'https://www.smile.one/br/customer/activationcode/codelist'
-    
-    headers = {
+    async def paying(self, product_id):
+        self.started += 1
+        self.reservation.sending(self.prices[self.started - 1])
+        if self.journal is not None: await self.journal.paying(product_id)
+
+    async def pay_sent(self, accepted):
+        self.reservation.sent(accepted)
+
+    async def paid(self, result):
+        self.reservation.commit(self.prices[self.started - 1])
+        if self.journal is not None: await self.journal.paid(result)
+
+    async def unpaid(self, result):
+        self.reservation.settle()
+
+
+balance_ledger = BalanceLedger()
+
+# ==========================================
+# 3. SMILE.ONE PURCHASE ENGINE (MLBB BR/PH + MAGIC CHESS) [FULLY ASYNC & FIXED FALSE POSITIVE]
+# ==========================================
+SMILE_MERCHANTS = {
+    'BR': {
+        'region': 'BR',
+        'game': 'mlbb',
+        'main_url': 'https://www.smile.one/merchant/mobilelegends',
+        'checkrole_url': 'https://www.smile.one/merchant/mobilelegends/checkrole',
+        'query_url': 'https://www.smile.one/merchant/mobilelegends/query',
+        'pay_url': 'https://www.smile.one/merchant/mobilelegends/pay',
+        'order_api_url': 'https://www.smile.one/customer/activationcode/codelist',
+    },
+    'PH': {
+        'region': 'PH',
+        'game': 'mlbb',
+        'main_url': 'https://www.smile.one/ph/merchant/mobilelegends',
+        'checkrole_url': 'https://www.smile.one/ph/merchant/mobilelegends/checkrole',
+        'query_url': 'https://www.smile.one/ph/merchant/mobilelegends/query',
+        'pay_url': 'https://www.smile.one/ph/merchant/mobilelegends/pay',
+        'order_api_url': 'https://www.smile.one/ph/customer/activationcode/codelist',
+    },
+    'MCC': {
+        'region': 'MCC',
+        'game': 'mcc',
+        'main_url': 'https://www.smile.one/br/merchant/game/magicchessgogo',
+        'checkrole_url': 'https://www.smile.one/br/merchant/game/checkrole',
+        'query_url': 'https://www.smile.one/br/merchant/game/query',
+        'pay_url': 'https://www.smile.one/br/merchant/game/pay',
+        'order_api_url': 'https://www.smile.one/br/customer/activationcode/codelist',
+    },
+}
+
+def merchant_headers(main_url):
+    return {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'X-Requested-With': 'XMLHttpRequest', 
         'Referer': main_url, 
         'Origin': 'https://www.smile.one'
     }
 
+def parse_pay_response(pay_response_raw):
+    # Returns (is_success, order_id, error_text)
     try:
-        response = await asyncio.to_thread(scraper.get, main_url, headers=headers)
-        if response.status_code in [403, 503] or "cloudflare" in response.text.lower():
-             return {"status": "error", "message": "Blocked by Cloudflare."}
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        csrf_token = None
-        meta_tag = soup.find('meta', {'name': 'csrf-token'})
-        if meta_tag: csrf_token = meta_tag.get('content')
-        else:
-            csrf_input = soup.find('input', {'name': '_csrf'})
-            if csrf_input: csrf_token = csrf_input.get('value')
-
-        if not csrf_token: return {"status": "error", "message": "CSRF Token not found. Add a new Cookie using /setcookie."}
-
-        check_data = {'user_id': game_id, 'zone_id': zone_id, '_csrf': csrf_token}
-        role_response_raw = await asyncio.to_thread(scraper.post, checkrole_url, data=check_data, headers=headers)
-        try:
-            role_result = role_response_raw.json()
-            ig_name = role_result.get('username') or role_result.get('data', {}).get('username')
-            if not ig_name or str(ig_name).strip() == "":
-                return {"status": "error", "message": " Account not found."}
-        except Exception: return {"status": "error", "message": "⚠️ Check Role API Error: Cannot verify account."}
-
-        query_data = {'user_id': game_id, 'zone_id': zone_id, 'pid': product_id, 'checkrole': '', 'pay_methond': 'smilecoin', 'channel_method': 'smilecoin', '_csrf': csrf_token}
-        query_response_raw = await asyncio.to_thread(scraper.post, query_url, data=query_data, headers=headers)
-        
-        try: query_result = query_response_raw.json()
-        except Exception: return {"status": "error", "message": "Query API Error"}
-            
-        flowid = query_result.get('flowid') or query_result.get('data', {}).get('flowid')
-        
-        if not flowid:
-            real_error = query_result.get('msg') or query_result.get('message') or ""
-            if "login" in str(real_error).lower() or "unauthorized" in str(real_error).lower():
-                print("⚠️ Cookie expired. Starting Auto-Login...")
-                success = await auto_login_and_get_cookie()
-                if success: return {"status": "error", "message": "⚠️ Session renewed. Please enter the command again."}
-                else: return {"status": "error", "message": "Auto-Login failed. Please provide /setcookie again."}
-            return {"status": "error", "message": "Invalid account or unable to purchase."}
-
-        pay_data = {'_csrf': csrf_token, 'user_id': game_id, 'zone_id': zone_id, 'pay_methond': 'smilecoin', 'product_id': product_id, 'channel_method': 'smilecoin', 'flowid': flowid, 'email': '', 'coupon_id': ''}
-        pay_response_raw = await asyncio.to_thread(scraper.post, pay_url, data=pay_data, headers=headers)
-        
-        is_success = False
-        real_order_id = "Not found"
-        err_text = "Unknown Error"
-        
+        pay_json = pay_response_raw.json()
+        code = str(pay_json.get('code', pay_json.get('status', '')))
+        msg = str(pay_json.get('msg', pay_json.get('message', ''))).lower()
+    
+        # Code 200, 0, 1 (သို့) message ထဲမှာ success ပါရင် အောင်မြင်တယ်လို့ ယူဆပါတယ်
+        if code in ['200', '0', '1'] or 'success' in msg or 'sucesso' in msg or 'ok' in msg:
+            return True, str(pay_json.get('data', {}).get('order_id', 'Not found')), None
+        return False, "Not found", pay_json.get('msg', 'Insufficient balance or API Error')
+    except Exception:
+        pay_text = pay_response_raw.text.lower()
+        if 'success' in pay_text or 'sucesso' in pay_text or 'ok' in pay_text:
+            return True, "Not found", None
+        return False, "Not found", "Insufficient balance, Timeout or Blocked."
+
+async def query_flowid(scraper, merchant, headers, csrf_token, game_id, zone_id, product_id):
+    # Returns (flowid, None) or (None, error result)
+    query_data = {'user_id': game_id, 'zone_id': zone_id, 'pid': product_id, 'checkrole': '', 'pay_methond': 'smilecoin', 'channel_method': 'smilecoin', '_csrf': csrf_token}
+    query_response_raw = await post_with_csrf(scraper, merchant['main_url'], merchant['query_url'], query_data, headers, pace=('query', merchant['region']))
+
+    try: query_result = query_response_raw.json()
+    except Exception: return None, {"status": "error", "message": "Query API Error"}
+    
+    flowid = query_result.get('flowid') or query_result.get('data', {}).get('flowid')
+    if flowid: return flowid, None
+
+    real_error = query_result.get('msg') or query_result.get('message') or ""
+    if "login" in str(real_error).lower() or "unauthorized" in str(real_error).lower():
+        print("⚠️ Cookie expired. Starting Auto-Login...")
+        success = await session_renewal.renew()
+        # renewed tells purchase_package to fetch a new CSRF token and retry this item on the new cookie
+        if success: return None, {"status": "error", "message": "❌ Session expired again after renewal. Please provide /setcookie again.", "renewed": True}
+        else: return None, {"status": "error", "message": "❌ Auto-Login failed. Please provide /setcookie again."}
+    return None, {"status": "error", "message": f"❌ **Invalid Account/Server:** {real_error}"}
+
+CONFIRM_FIRST_POLL = float(os.getenv('CONFIRM_FIRST_POLL', 0.5))
+CONFIRM_MAX_INTERVAL = float(os.getenv('CONFIRM_MAX_INTERVAL', 3))
+CONFIRM_DEADLINE = float(os.getenv('CONFIRM_DEADLINE', 12))
+CONFIRM_PAGE_SLACK = int(os.getenv('CONFIRM_PAGE_SLACK', 5))
+
+class OrderMatcher:
+    # increment_ids already accounted for, plus how many of our successful pays that came back without
+    # an order id have not been matched to a codelist row yet
+    def __init__(self, seen_ids=()):
+        self.seen = set(str(i) for i in seen_ids)
+        self.unclaimed = 0
+
+    def page_size(self, outstanding=1):
+        return max(5, min(100, self.unclaimed + outstanding + CONFIRM_PAGE_SLACK))
+
+    def match(self, rows, game_id, zone_id):
+        fresh = []
+        for order in rows:
+            increment_id = str(order.get('increment_id', ''))
+            # အရင်ဝယ်ပြီးသား ID တွေကို ကျော်ပါမယ်
+            if not increment_id or increment_id in self.seen:
+                continue
+            # အခု ID နဲ့ ကိုက်ပြီး Success ဖြစ်နေရင် အောင်မြင်ပါတယ်
+            if str(order.get('user_id')) == str(game_id) and str(order.get('server_id')) == str(zone_id):
+                if str(order.get('order_status', '')).lower() == 'success' or str(order.get('status')) == '1':
+                    fresh.append(increment_id)
+        # Rows come newest first; older fresh rows belong to pays we already counted as successful
+        if len(fresh) <= self.unclaimed:
+            return None
+        self.seen.update(fresh)
+        self.unclaimed = max(0, self.unclaimed - (len(fresh) - 1))
+        return fresh[0]
+
+async def fetch_order_rows(scraper, merchant, headers, page_size):
+    hist_res_raw = await pacer.request('codelist', merchant['region'], scraper.get(merchant['order_api_url'], params={'type': 'orderlist', 'p': '1', 'pageSize': str(page_size)}, headers=headers))
+    return hist_res_raw.json().get('list') or []
+
+async def confirm_order(scraper, merchant, headers, game_id, zone_id, ig_name, matcher, pay_outcome):
+    is_success, real_order_id, err_text = pay_outcome
+
+    # Pay returned an order id: nothing to poll for
+    if is_success and real_order_id not in ["Not found", "", "None"]:
+        matcher.seen.add(str(real_order_id))
+        return {"status": "success", "ig_name": ig_name, "order_id": real_order_id}
+
+    # 🚨 NEW SAFETY NET: ပိုက်ဆံဖြတ်ပြီး Error ပြနေရင်တောင် History ကို ထပ်စစ်ပါမယ် 🚨
+    deadline = time.monotonic() + CONFIRM_DEADLINE
+    delay = CONFIRM_FIRST_POLL
+    while True:
+        await asyncio.sleep(delay)
         try:
-            pay_json = pay_response_raw.json()
-            code = str(pay_json.get('code', pay_json.get('status', '')))
-            msg = str(pay_json.get('msg', pay_json.get('message', ''))).lower()
-            
-            if code in ['200', '0', '1'] or 'success' in msg or 'sucesso' in msg or 'ok' in msg:
-                is_success = True
-                real_order_id = str(pay_json.get('data', {}).get('order_id', 'Not found'))
-            else:
-                err_text = pay_json.get('msg', 'Insufficient balance or API Error')
+            found = matcher.match(await fetch_order_rows(scraper, merchant, headers, matcher.page_size()), game_id, zone_id)
+            if found:
+                return {"status": "success", "ig_name": ig_name, "order_id": found}
         except Exception:
-            pay_text = pay_response_raw.text.lower()
-            if 'success' in pay_text or 'sucesso' in pay_text or 'ok' in pay_text:
-                is_success = True
-            else:
-                err_text = "Insufficient balance, Timeout or Blocked."
+            pass
+        delay = min(delay * 2, CONFIRM_MAX_INTERVAL)
+        if time.monotonic() + delay > deadline:
+            break
+
+    if is_success:
+        matcher.unclaimed += 1
+        return {"status": "success", "ig_name": ig_name, "order_id": f"AUTO_{int(time.time())}"}
+    return {"status": "error", "message": f"{err_text or 'Unknown Error'}"}
+
+async def purchase_package(game_id, zone_id, product_ids, region, seen_order_ids=None, progress=None):
+    # Buys every pid for one account: one session, one CSRF token and one checkrole for the whole package.
+    # Item N+1's query runs while item N is being confirmed; its pay waits for that confirmation and the pay bucket.
+    # Returns one result per attempted item; stops after the first failure.
+    # progress (optional) is told about the baseline, each pay before it is sent, and how each sent pay resolved.
+    merchant = SMILE_MERCHANTS[region]
+    main_url = merchant['main_url']
+    matcher = OrderMatcher(seen_order_ids or ())
+    results = []
+    pending = None
+    baseline = None
+
+    async def record(result):
+        # Confirmation outcome of an item whose pay was sent
+        results.append(result)
+        if progress is None: return
+        if result['status'] == 'success': await progress.paid(result)
+        else: await progress.unpaid(result)
+    
+    headers = merchant_headers(main_url)
+    renewed = False
+    await session_renewal.settled()
 
-        # 🚨 NEW SAFETY NET: History ပြန်စစ်ခြင်း 🚨
-        await asyncio.sleep(2) 
+    async with http_session() as scraper:
         try:
-            hist_res_raw = await asyncio.to_thread(scraper.get, order_api_url, params={'type': 'orderlist', 'p': '1', 'pageSize': '5'}, headers=headers)
-            hist_json = hist_res_raw.json()
-            if 'list' in hist_json and len(hist_json['list']) > 0:
-                for order in hist_json['list']:
-                    increment_id = str(order.get('increment_id', ''))
-                    
-                    if increment_id in seen_order_ids:
-                        continue
-                        
-                    if str(order.get('user_id')) == str(game_id) and str(order.get('server_id')) == str(zone_id):
-                        if str(order.get('order_status', '')).lower() == 'success' or str(order.get('status')) == '1':
-                            is_success = True
-                            real_order_id = increment_id
-                            break
-        except Exception: 
-            pass
+            csrf_token, page = await get_csrf_token(scraper, main_url, headers)
+            if page is not None and page.login_required and await session_renewal.renew():
+                renewed = True
+                await scraper.renew()
+                csrf_token, page = await get_csrf_token(scraper, main_url, headers)
+            if page is not None and page.blocked:
+                 return [{"status": "error", "message": "Blocked by Cloudflare."}]
 
-        if is_success:
-            if real_order_id in ["Not found", "", "None"]:
-                real_order_id = f"AUTO_{int(time.time())}"
-            return {"status": "success", "ig_name": ig_name, "order_id": real_order_id}
-        else:
-            return {"status": "error", "message": f"{err_text}"}
+            if not csrf_token: return [{"status": "error", "message": "CSRF Token not found. Add a new Cookie using /setcookie."}]
+
+            try:
+                role = await lookup_role(scraper, merchant['game'], main_url, merchant['checkrole_url'], headers, csrf_token, game_id, zone_id, region)
+                if role.login_required and not renewed and await session_renewal.renew():
+                    # A cached token hid the expired cookie until checkrole: renew like the query path does
+                    renewed = True
+                    await scraper.renew()
+                    csrf_token, page = await get_csrf_token(scraper, main_url, headers)
+                    if not csrf_token: return [{"status": "error", "message": "CSRF Token not found. Add a new Cookie using /setcookie."}]
+                    role = await lookup_role(scraper, merchant['game'], main_url, merchant['checkrole_url'], headers, csrf_token, game_id, zone_id, region)
+            except Exception: return [{"status": "error", "message": "Check Role API Error: Cannot verify account."}]
+            if role.login_required:
+                return [{"status": "error", "message": "❌ Session expired. Please provide /setcookie again."}]
+            if not role.found:
+                return [{"status": "error", "message": f"❌ Invalid Account: {role.error}"}]
+
+            # Orders that exist before our first pay can never be ours; read them while the first query runs
+            baseline = asyncio.ensure_future(fetch_order_rows(scraper, merchant, headers, matcher.page_size(len(product_ids))))
+            for product_id in product_ids:
+                query = asyncio.ensure_future(query_flowid(scraper, merchant, headers, csrf_token, game_id, zone_id, product_id))
+                if pending is not None:
+                    previous = await pending
+                    pending = None
+                    await record(previous)
+                    if previous['status'] != 'success':
+                        query.cancel()
+                        return results
+
+                flowid, error = await query
+                if error and error.get('renewed') and not renewed:
+                    # The cookie was replaced mid-package: carry on with a session and token for the new cookie
+                    renewed = True
+                    if baseline is not None:
+                        baseline.cancel()
+                        await asyncio.gather(baseline, return_exceptions=True)
+                    await scraper.renew()
+                    if baseline is not None:
+                        baseline = asyncio.ensure_future(fetch_order_rows(scraper, merchant, headers, matcher.page_size(len(product_ids))))
+                    csrf_token, page = await get_csrf_token(scraper, main_url, headers)
+                    if csrf_token:
+                        flowid, error = await query_flowid(scraper, merchant, headers, csrf_token, game_id, zone_id, product_id)
+                if error:
+                    if baseline is not None: baseline.cancel()
+                    results.append(error)
+                    return results
+                if baseline is not None:
+                    try: matcher.seen.update(str(o.get('increment_id', '')) for o in await baseline)
+                    except Exception: pass
+                    baseline = None
+                    if progress is not None: await progress.baseline(sorted(matcher.seen))
+
+                # checkrole/query may have swapped a stale token for a fresh one
+                csrf_token = csrf_cache.get(main_url) or csrf_token
+                pay_data = {'_csrf': csrf_token, 'user_id': game_id, 'zone_id': zone_id, 'pay_methond': 'smilecoin', 'product_id': product_id, 'channel_method': 'smilecoin', 'flowid': flowid, 'email': '', 'coupon_id': ''}
+                if progress is not None: await progress.paying(product_id)
+                pay_response_raw = await post_with_csrf(scraper, main_url, merchant['pay_url'], pay_data, headers, pace=('pay', region))
+                pay_outcome = parse_pay_response(pay_response_raw)
+                if progress is not None: await progress.pay_sent(pay_outcome[0])
+                pending = asyncio.ensure_future(confirm_order(
+                    scraper, merchant, headers, game_id, zone_id, role.ig_name, matcher, pay_outcome
+                ))
+
+            if pending is not None:
+                await record(await pending)
+                pending = None
+            return results
 
-    except Exception as e: return {"status": "error", "message": f"System Error: {str(e)}"}
+        except Exception as e:
+            if baseline is not None: baseline.cancel()
+            # A pay that already went through is still confirmed before the error is reported
+            if pending is not None:
+                try: await record(await pending)
+                except Exception: pass
+                if results and results[-1]['status'] != 'success': return results
+            results.append({"status": "error", "message": f"System Error: {str(e)}"})
+            return results
 
 # ==========================================
 # 4. 🛡️ FUNCTION TO CHECK AUTHORIZATION
@@ -604,19 +2604,8 @@ async def is_authorized(message: Message):
     if message.from_user.id == OWNER_ID:
         return True
     
-    users = await get_allowed_users()
-    
-    # Check by User ID
-    if str(message.from_user.id) in users:
-        return True
-        
-    # Check by Username
-    if message.from_user.username:
-        username_lower = message.from_user.username.lower()
-        if username_lower in users:
-            return True
-            
-    return False
+    # Check by User ID, then by Username
+    return await auth_index.contains(message.from_user.id, message.from_user.username)
 
 # ==========================================
 # 5. OWNER COMMANDS (Add, Remove, Users, Cookie)
@@ -673,6 +2662,73 @@ async def list_users_cmd(client, message: Message):
     await message.reply(f"📋 **Allowed Users List:**\n\n{final_text}")
 
 
+@app.on_message((filters.command("stats") | filters.regex(r"(?i)^\.stats\b")) & filters.private)
+async def stats_cmd(client, message: Message):
+    if message.from_user.id != OWNER_ID:
+        return await message.reply("❌ You are not the owner.")
+
+    today = datetime.datetime.now(MMT).date()
+    week_days = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(today.weekday() + 1)]
+    day_buckets = await storage.get_rollups('day', week_days)
+
+    def line(label, bucket):
+        orders, spent = bucket
+        return f"{label:<12}: {orders:>5} orders  ${spent:,.2f}"
+
+    def top(buckets, limit=10):
+        ranked = sorted(buckets.items(), key=lambda kv: kv[1][1], reverse=True)[:limit]
+        return "\n".join(line(str(k), v) for k, v in ranked) or "No orders yet."
+
+    week_total = (sum(b[0] for b in day_buckets.values()), sum(b[1] for b in day_buckets.values()))
+
+    report = (
+        f"📊 <b>Sales Stats</b>\n\n"
+        f"<code>{line('Today', day_buckets.get(week_days[0], (0, 0.0)))}\n"
+        f"{line('This week', week_total)}</code>\n\n"
+        f"🌏 <b>Per Region</b>\n<code>{top(await storage.get_rollups('region'))}</code>\n\n"
+        f"💎 <b>Top Packages</b>\n<code>{top(await storage.get_rollups('item'))}</code>\n\n"
+        f"👤 <b>Top Users</b>\n<code>{top(await storage.get_rollups('user'))}</code>"
+    )
+    await message.reply(report, parse_mode=ParseMode.HTML)
+
+
+@app.on_message((filters.command("iostats") | filters.regex(r"(?i)^\.iostats\b")) & filters.private)
+async def iostats_cmd(client, message: Message):
+    if message.from_user.id != OWNER_ID:
+        return await message.reply("❌ You are not the owner.")
+
+    lines = []
+    for ex in (http_executor, work_executor):
+        s = ex.stats()
+        lines.append(
+            f"{s['name']:<8}: {s['active']}/{s['workers']} busy, {s['queued']} queued (peak {s['peak_queued']})\n"
+            f"          {s['completed']} done, {s['failed']} failed, wait avg {s['avg_wait'] * 1000:.0f}ms max {s['max_wait'] * 1000:.0f}ms"
+        )
+    await message.reply("🧵 <b>I/O Executors</b>\n\n<code>" + "\n\n".join(lines) + "</code>", parse_mode=ParseMode.HTML)
+
+
+@app.on_message((filters.command("priority") | filters.regex(r"(?i)^\.priority\b")) & filters.private)
+async def priority_cmd(client, message: Message):
+    if message.from_user.id != OWNER_ID:
+        return await message.reply("❌ You are not the owner.")
+
+    parts = message.text.split()
+    if len(parts) == 1:
+        weights = "\n".join(f"{k:<16}: x{v}" for k, v in sorted(order_queue.weights.items())) or "Everyone at x1."
+        return await message.reply(
+            f"⚖️ <b>Queue Priorities</b>\n<code>{weights}</code>\n\n"
+            f"⏳ Waiting: {order_queue.waiting()}  |  Running: {order_queue.running}",
+            parse_mode=ParseMode.HTML
+        )
+    if len(parts) != 3 or not parts[2].isdigit():
+        return await message.reply("⚠️ **Usage format:**\n`/priority <ID/Username> <Weight>` (1 = default)")
+
+    key = parts[1].lstrip('@')
+    key = key if key.isdigit() else key.lower()
+    await order_queue.set_weight(key, int(parts[2]))
+    await message.reply(f"✅ Priority for `{parts[1]}` set to x{max(1, int(parts[2]))}.")
+
+
 @app.on_message(filters.command("setcookie"))
 async def set_cookie_command(client, message: Message):
     if not await is_authorized(message): return await message.reply("❌ Only the Owner can set the Cookie.")
@@ -722,13 +2778,12 @@ async def check_balance_command(client, message: Message):
     if not await is_authorized(message): return await message.reply("ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
     
     loading_msg = await message.reply("Fetching Official Balance...")
-    scraper = await get_main_scraper()
-    headers = {'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://www.smile.one'}
     try:
-        balances = await get_smile_balance(scraper, headers, 'https://www.smile.one/customer/order')
+        br_balance, ph_balance = await asyncio.gather(balance_ledger.get('BR'), balance_ledger.get('PH'))
         report = f"💳 **Oғғɪᴄɪᴀʟ Aᴄᴄᴏᴜɴᴛ Bᴀʟᴀɴᴄᴇ:**\n\n"
-        report += f"🇧🇷 ʙʀ-ʙᴀʟᴀɴᴄᴇ  :  ${balances.get('br_balance', 0.00):,.2f}\n"
-        report += f"🇵🇭 ᴘʜ-ʙᴀʟᴀɴᴄᴇ  :  ${balances.get('ph_balance', 0.00):,.2f}"
+        report += f"🇧🇷 ʙʀ-ʙᴀʟᴀɴᴄᴇ  :  ${br_balance:,.2f}\n"
+        report += f"🇵🇭 ᴘʜ-ʙᴀʟᴀɴᴄᴇ  :  ${ph_balance:,.2f}\n"
+        report += f"\n🕒 Updated {int(max(balance_ledger.age('BR'), balance_ledger.age('PH')))}s ago"
         await loading_msg.edit(report)
     except Exception as e:
         await loading_msg.edit(f"❌ Error fetching official balance: {str(e)}")
@@ -736,41 +2791,106 @@ async def check_balance_command(client, message: Message):
 
 # 📜 HISTORY COMMAND (.his / /history) 
 
-@app.on_message(filters.command("history") | filters.regex(r"(?i)^\.his$"))
+EXPORT_FORMATS = ('txt', 'csv', 'jsonl')
+
+def format_order_txt(order):
+    return (
+        f"🆔 Game ID: {order['game_id']}\n"
+        f"🌏 Zone ID: {order['zone_id']}\n"
+        f"💎 Pack: {order['item_name']}\n"
+        f"🆔 Order ID: {order['order_id']}\n"
+        f"📅 Date: {order['date_str']}\n"
+        f"💲 Rate: ${order['price']:,.2f}\n"
+        f"📊 Status: {order['status']}\n"
+        f"────────────────\n"
+    )
+
+def write_history_export(records, fmt, compress, title):
+    # Runs in a worker thread: streams records straight into a temp file on disk.
+    # Not a SpooledTemporaryFile: Pyrogram only uploads real io.IOBase objects
+    spool = tempfile.TemporaryFile()
+    raw = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+    out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    count = 0
+
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(ORDER_COLUMNS)
+        for order in records:
+            writer.writerow([order.get(c, "") for c in ORDER_COLUMNS])
+            count += 1
+    elif fmt == 'jsonl':
+        for order in records:
+            out.write(json.dumps(order, ensure_ascii=False) + "\n")
+            count += 1
+    else:
+        out.write(f"==== {title} ====\n\n")
+        for order in records:
+            out.write(format_order_txt(order))
+            count += 1
+
+    out.flush()
+    out.detach()
+    if compress:
+        raw.close()
+    spool.seek(0)
+    return spool, count
+
+def parse_history_args(args):
+    # /history [txt|csv|jsonl] [gz] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [game=ID]
+    options = {'fmt': 'txt', 'compress': False, 'since': None, 'until': None, 'game_id': None}
+    for arg in args:
+        arg_lower = arg.lower()
+        key, _, value = arg_lower.partition('=')
+        if arg_lower in EXPORT_FORMATS:
+            options['fmt'] = arg_lower
+        elif arg_lower in ('gz', 'gzip'):
+            options['compress'] = True
+        elif key in ('from', 'to') and value:
+            day = datetime.datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=MMT)
+            if key == 'from':
+                options['since'] = day.timestamp()
+            else:
+                options['until'] = (day + datetime.timedelta(days=1)).timestamp()
+        elif key == 'game' and value.isdigit():
+            options['game_id'] = value
+        else:
+            raise ValueError(f"Unknown option '{arg}'")
+    return options
+
+@app.on_message(filters.command("history") | filters.regex(r"(?i)^\.his\b"))
 async def send_order_history(client, message: Message):
     if not await is_authorized(message):
         return await message.reply("ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
 
     tg_id = str(message.from_user.id)
     user_name = message.from_user.username or message.from_user.first_name
-    
-    history_data = await get_user_history(tg_id, limit=200)
-    
-    if not history_data:
-        return await message.reply("📜 **No Order History Found.**")
 
-    response_text = f"==== Order History for @{user_name} ====\n\n"
-    
-    for order in history_data:
-        response_text += (
-            f"🆔 Game ID: {order['game_id']}\n"
-            f"🌏 Zone ID: {order['zone_id']}\n"
-            f"💎 Pack: {order['item_name']}\n"
-            f"🆔 Order ID: {order['order_id']}\n"
-            f"📅 Date: {order['date_str']}\n"
-            f"💲 Rate: ${order['price']:,.2f}\n"
-            f"📊 Status: {order['status']}\n"
-            f"────────────────\n"
+    try:
+        options = parse_history_args(message.text.split()[1:])
+    except ValueError as e:
+        return await message.reply(
+            f"❌ {e}\n⚠️ Usage: `/history [txt|csv|jsonl] [gz] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [game=ID]`"
         )
-    
-    file_obj = io.BytesIO(response_text.encode('utf-8'))
-    file_obj.name = f"History_{tg_id}.txt"
-    
-    await message.reply_document(
-        document=file_obj,
-        caption=f"📜 **Order History**\n👤 User: @{user_name}\n📊 Records: {len(history_data)} (Max: 200)"
+
+    records = await iter_user_history(tg_id, options['since'], options['until'], options['game_id'])
+    file_obj, count = await work_executor.run(
+        write_history_export, records, options['fmt'], options['compress'], f"Order History for @{user_name}"
     )
 
+    try:
+        if count == 0:
+            return await message.reply("📜 **No Order History Found.**")
+
+        file_name = f"History_{tg_id}.{options['fmt']}" + (".gz" if options['compress'] else "")
+        await message.reply_document(
+            document=file_obj,
+            file_name=file_name,
+            caption=f"📜 **Order History**\n👤 User: @{user_name}\n📊 Records: {count}"
+        )
+    finally:
+        file_obj.close()
+
 # 🧹 CLEAN HISTORY COMMAND (.clean / /clean)
 
 @app.on_message(filters.command("clean") | filters.regex(r"(?i)^\.clean$"))
@@ -801,8 +2921,7 @@ async def handle_topup(client, message: Message):
     
     loading_msg = await message.reply(f"Checking Code `{activation_code}`...")
     
-    async with transaction_lock:
-        scraper = await get_main_scraper()
+    async with order_scheduler.exclusive(), http_session() as scraper:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
@@ -828,24 +2947,21 @@ async def handle_topup(client, message: Message):
             req_headers['Referer'] = base_referer
 
             try:
-                res = await asyncio.to_thread(scraper.get, page_url, headers=req_headers)
-                if "login" in res.url.lower(): return "expired", None
-
-                soup = BeautifulSoup(res.text, 'html.parser')
-                csrf_token = soup.find('meta', {'name': 'csrf-token'})
-                csrf_token = csrf_token.get('content') if csrf_token else (soup.find('input', {'name': '_csrf'}).get('value') if soup.find('input', {'name': '_csrf'}) else None)
+                csrf_token, page = await get_csrf_token(scraper, page_url, req_headers)
+                if page is not None and page.login_required: return "expired", None
                 if not csrf_token: return "error", "❌ CSRF Token not obtained."
 
                 ajax_headers = req_headers.copy()
                 ajax_headers.update({'X-Requested-With': 'XMLHttpRequest', 'Origin': base_origin, 'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'})
 
-                check_res_raw = await asyncio.to_thread(scraper.post, check_url, data={'_csrf': csrf_token, 'pin': activation_code}, headers=ajax_headers)
+                check_res_raw = await post_with_csrf(scraper, page_url, check_url, {'_csrf': csrf_token, 'pin': activation_code}, ajax_headers, req_headers)
+                csrf_token = csrf_cache.get(page_url) or csrf_token
                 check_res = check_res_raw.json()
                 code_status = str(check_res.get('code', check_res.get('status', '')))
                 
                 if code_status in ['200', '201', '0', '1'] or 'success' in str(check_res.get('msg', '')).lower():
                     old_bal = await get_smile_balance(scraper, headers, balance_check_url)
-                    pay_res_raw = await asyncio.to_thread(scraper.post, pay_url, data={'_csrf': csrf_token, 'sec': activation_code}, headers=ajax_headers)
+                    pay_res_raw = await post_with_csrf(scraper, page_url, pay_url, {'_csrf': csrf_token, 'sec': activation_code}, ajax_headers, req_headers)
                     pay_res = pay_res_raw.json()
                     pay_status = str(pay_res.get('code', pay_res.get('status', '')))
                     
@@ -862,12 +2978,16 @@ async def handle_topup(client, message: Message):
             except Exception as e:
                 return "error", str(e)
 
-        status, result = await try_redeem('BR')
-        active_region = 'BR'
-        
-        if status in ['invalid', 'fail']: 
-            status, result = await try_redeem('PH')
-            active_region = 'PH'
+        with balance_ledger.busy('BR', 'PH'):
+            status, result = await try_redeem('BR')
+            active_region = 'BR'
+            
+            if status in ['invalid', 'fail']: 
+                status, result = await try_redeem('PH')
+                active_region = 'PH'
+
+            if status == "success" and result > 0:
+                balance_ledger.credit(active_region, result)
 
         if status == "expired":
             await loading_msg.edit("ʏᴏᴜʀ ᴄᴏᴏᴋɪᴇs ɪs ᴇxᴘɪʀᴇᴅ.")
@@ -879,13 +2999,13 @@ async def handle_topup(client, message: Message):
             added_amount = result
             
             if added_amount <= 0:
+                balance_ledger.refresh(active_region)
                 await loading_msg.edit(f"sᴍɪʟᴇ ᴏɴᴇ ʀᴇᴅᴇᴇᴍ ᴄᴏᴅᴇ sᴜᴄᴄᴇss ✅\n(Cannot retrieve exact amount due to System Delay.)")
             else:
                 fmt_amount = int(added_amount) if added_amount % 1 == 0 else added_amount
                 
-                # Retrieve Real Balance After Topup
-                new_bal_dict = await get_smile_balance(scraper, headers, 'https://www.smile.one/ph/customer/order' if active_region == 'PH' else 'https://www.smile.one/customer/order')
-                new_bal = new_bal_dict.get('br_balance' if active_region == 'BR' else 'ph_balance', 0.0)
+                # Balance After Topup (ledger)
+                new_bal = await balance_ledger.get(active_region)
 
                 msg = (
                     f"✅ <b>Code Top-Up Successful</b>\n\n"
@@ -916,161 +3036,474 @@ async def handle_check_role(client, message: Message):
     
     loading_msg = await message.reply("💻")
 
-    scraper = await get_main_scraper()
-    
     main_url = 'https://www.smile.one/merchant/mobilelegends'
     checkrole_url = 'https://www.smile.one/merchant/mobilelegends/checkrole'
     headers = {'X-Requested-With': 'XMLHttpRequest', 'Referer': main_url, 'Origin': 'https://www.smile.one'}
 
-    try:
-        res = await asyncio.to_thread(scraper.get, main_url, headers=headers)
-        soup = BeautifulSoup(res.text, 'html.parser')
-        
-        csrf_token = None
-        meta_tag = soup.find('meta', {'name': 'csrf-token'})
-        if meta_tag: csrf_token = meta_tag.get('content')
-        else:
-            csrf_input = soup.find('input', {'name': '_csrf'})
-            if csrf_input: csrf_token = csrf_input.get('value')
+    async with http_session() as scraper:
+        try:
+            role = role_cache.get('mlbb', game_id, zone_id)
+            if role is None:
+                csrf_token, _ = await get_csrf_token(scraper, main_url, headers)
 
-        if not csrf_token:
-            return await loading_msg.edit("❌ CSRF Token not found. Add a new Cookie using /setcookie.")
+                if not csrf_token:
+                    return await loading_msg.edit("❌ CSRF Token not found. Add a new Cookie using /setcookie.")
 
-        check_data = {'user_id': game_id, 'zone_id': zone_id, '_csrf': csrf_token}
-        role_response_raw = await asyncio.to_thread(scraper.post, checkrole_url, data=check_data, headers=headers)
+                try: 
+                    role = await lookup_role(scraper, 'mlbb', main_url, checkrole_url, headers, csrf_token, game_id, zone_id)
+                except: 
+                    return await loading_msg.edit("❌ Cannot verify. (Smile API Error)")
         
-        try: 
-            role_result = role_response_raw.json()
-        except: 
-            return await loading_msg.edit("❌ Cannot verify. (Smile API Error)")
-            
-        ig_name = role_result.get('username') or role_result.get('data', {}).get('username')
-        
-        if not ig_name or str(ig_name).strip() == "":
-            real_error = role_result.get('msg') or role_result.get('message') or "Account not found."
-            if "login" in str(real_error).lower() or "unauthorized" in str(real_error).lower():
-                return await loading_msg.edit("⚠️ Cookie expired. Please add a new one using `/setcookie`.")
-            return await loading_msg.edit(f"❌ **Invalid Account:**\n{real_error}")
+            if not role.found:
+                real_error = role.error
+                if role.login_required or "login" in str(real_error).lower() or "unauthorized" in str(real_error).lower():
+                    return await loading_msg.edit("⚠️ Cookie expired. Please add a new one using `/setcookie`.")
+                return await loading_msg.edit(f"❌ **Invalid Account:**\n{real_error}")
+
+            ig_name = role.ig_name
+            smile_region = role.smile_region
+
+            pizzo_region = role.pizzo_region or "Unknown"
+            if role.pizzo_region is None:
+                try:
+                    pizzo_headers = {
+                        'authority': 'pizzoshop.com',
+                        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+                        'content-type': 'application/x-www-form-urlencoded',
+                        'origin': 'https://pizzoshop.com',
+                        'referer': 'https://pizzoshop.com/mlchecker',
+                        'user-agent': 'Mozilla/5.0'
+                    }
+                    await scraper.get("https://pizzoshop.com/mlchecker", headers=pizzo_headers, timeout=10)
+                    pizzo_res_raw = await scraper.post("https://pizzoshop.com/mlchecker/check", data={'user_id': game_id, 'zone_id': zone_id}, headers=pizzo_headers, timeout=15)
+                    pizzo_region = extract_pizzo_region(pizzo_res_raw.text) or "Unknown"
+                    if pizzo_region != "Unknown": role_cache.set_pizzo_region('mlbb', game_id, zone_id, pizzo_region)
+                except: pass
+
+            final_region = pizzo_region if pizzo_region != "Unknown" else smile_region
+
+            report = f"ɢᴀᴍᴇ ɪᴅ : {game_id} ({zone_id})\nɪɢɴ ɴᴀᴍᴇ : {ig_name}\nʀᴇɢɪᴏɴ : {final_region}"
+            await loading_msg.edit(report)
 
-        smile_region = role_result.get('zone') or role_result.get('region') or role_result.get('data', {}).get('zone') or "Unknown"
+        except Exception as e:
+            await loading_msg.edit(f"❌ System Error: {str(e)}")
 
-        pizzo_region = "Unknown"
+# ==========================================
+# 🧾 FAIR ORDER QUEUE (ROUND-ROBIN ACROSS USERS)
+# ==========================================
+QUEUE_FEEDBACK_INTERVAL = float(os.getenv('QUEUE_FEEDBACK_INTERVAL', 3))
+QUEUE_FEEDBACK_EDITS = int(os.getenv('QUEUE_FEEDBACK_EDITS', 20))
+PRIORITY_FILE = os.getenv('PRIORITY_FILE', 'priorities.json')
+
+class QueuedJob:
+    def __init__(self, tg_id, lane, account, run, abandon=None):
+        self.tg_id = tg_id
+        self.lane = lane
+        self.account = account  # (game_id, zone_id); only one job per account is handed out at a time
+        self.run = run  # awaited with the job's status message once a worker picks it up
+        self.abandon = abandon  # awaited instead when the job is dropped without running
+        self.status_msg = None
+        self.position = None
+        self.ready = asyncio.Event()
+
+
+class FairOrderQueue:
+    # One job per order line. Every lane has its own ring and as many workers as order_scheduler lets it run,
+    # so a backlog in one lane never ties up workers another lane could use. Within a lane users take turns
+    # (weighted round-robin): on its turn a tg_id gets `weight` jobs dispatched, then goes to the back of the
+    # ring, so a 30-line paste can't hold everyone else up. Jobs for an account that already has an order
+    # running are passed over until it finishes, instead of parking a worker on the account lock.
+    def __init__(self, lanes, priority_file):
+        self.lanes = dict(lanes)  # lane -> workers
+        self.priority_file = priority_file
+        self.weights = {}     # tg_id or lowercase username -> jobs per turn
+        self.usernames = {}   # tg_id -> lowercase username
+        self.running = 0
+        self._queues = {lane: {} for lane in self.lanes}      # lane -> tg_id -> deque of QueuedJob
+        self._rings = {lane: deque() for lane in self.lanes}  # lane -> tg_ids with waiting jobs; the head has the turn
+        self._credit = dict.fromkeys(self.lanes, 0)           # lane -> jobs left in the head's turn
+        self._busy = set()    # accounts with a job running
+        self._changed = asyncio.Condition()
+
+    def load(self):
+        if os.path.exists(self.priority_file):
+            try:
+                with open(self.priority_file, 'r') as f:
+                    self.weights = {str(k): int(v) for k, v in json.load(f).items()}
+            except Exception as e:
+                print(f"❌ Could not read {self.priority_file}: {e}")
+
+    async def set_weight(self, key, weight):
+        if weight <= 1:
+            self.weights.pop(key, None)
+        else:
+            self.weights[key] = weight
+        await work_executor.run(write_json_atomic, self.priority_file, dict(self.weights))
+
+    def weight(self, tg_id):
+        return self.weights.get(tg_id) or self.weights.get(self.usernames.get(tg_id)) or 1
+
+    def waiting(self):
+        return sum(len(q) for queues in self._queues.values() for q in queues.values())
+
+    def _take(self, queues, ring, credit, busy):
+        # Removes and returns the next job in turn order whose account isn't busy, with the head's credit left.
+        # A user whose every waiting job is blocked loses the rest of the turn. (None, credit) if nothing can run.
+        for _ in range(len(ring)):
+            tg_id = ring[0]
+            queue = queues[tg_id]
+            index = next((i for i, job in enumerate(queue) if job.account not in busy), None)
+            if index is None:
+                ring.rotate(-1)
+                credit = 0
+                continue
+            if credit <= 0: credit = self.weight(tg_id)
+            job = queue[index]
+            del queue[index]
+            credit -= 1
+            if not queue:
+                del queues[tg_id]
+                ring.popleft()
+                credit = 0
+            elif credit <= 0:
+                ring.rotate(-1)
+            return job, credit
+        return None, credit
+
+    def dispatch_order(self, lane):
+        # The order a lane's waiting jobs will be handed to workers in, if nothing else arrives
+        queues = {tg_id: deque(q) for tg_id, q in self._queues[lane].items()}
+        ring, credit, order = deque(self._rings[lane]), self._credit[lane], []
+        while ring:
+            job, credit = self._take(queues, ring, credit, ())
+            order.append(job)
+        return order
+
+    def _pop(self, lane):
+        job, self._credit[lane] = self._take(self._queues[lane], self._rings[lane], self._credit[lane], self._busy)
+        return job
+
+    async def submit(self, tg_id, lane, account, run, reply, username=None, accept=None, abandon=None):
+        # reply sends the status message (message.reply for live orders, app.send_message for recovered ones).
+        # accept runs once the status message is out and before any worker can start the job; if either
+        # fails the job is dropped (abandon is awaited) and the error is raised to the caller.
+        if username:
+            self.usernames[tg_id] = username.lower()
+        job = QueuedJob(tg_id, lane, account, run, abandon)
+        async with self._changed:
+            queues = self._queues[lane]
+            if tg_id not in queues:
+                queues[tg_id] = deque()
+                self._rings[lane].append(tg_id)
+            queues[tg_id].append(job)
+            self._changed.notify_all()
         try:
-            pizzo_headers = {
-                'authority': 'pizzoshop.com',
-                'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                'content-type': 'application/x-www-form-urlencoded',
-                'origin': 'https://pizzoshop.com',
-                'referer': 'https://pizzoshop.com/mlchecker',
-                'user-agent': 'Mozilla/5.0'
-            }
-            await asyncio.to_thread(scraper.get, "https://pizzoshop.com/mlchecker", headers=pizzo_headers, timeout=10)
-            pizzo_res_raw = await asyncio.to_thread(scraper.post, "https://pizzoshop.com/mlchecker/check", data={'user_id': game_id, 'zone_id': zone_id}, headers=pizzo_headers, timeout=15)
-            pizzo_soup = BeautifulSoup(pizzo_res_raw.text, 'html.parser')
-            table = pizzo_soup.find('table', class_='table-modern')
-            
-            if table:
-                for row in table.find_all('tr'):
-                    th, td = row.find('th'), row.find('td')
-                    if th and td and ('region id' in th.get_text(strip=True).lower() or 'region' in th.get_text(strip=True).lower()):
-                        pizzo_region = td.get_text(strip=True)
-        except: pass
+            job.position = self.dispatch_order(lane).index(job) + 1
+        except ValueError:
+            job.position = 1  # a worker already took it
+        try:
+            job.status_msg = await reply(f"⏳ Queued: position {job.position}")
+            if accept is not None: await accept(job)
+        except BaseException:
+            job.status_msg = None
+            raise
+        finally:
+            job.ready.set()
+        return job
+
+    async def _worker(self, lane):
+        while True:
+            async with self._changed:
+                job = self._pop(lane)
+                while job is None:
+                    await self._changed.wait()
+                    job = self._pop(lane)
+                self._busy.add(job.account)
+            self.running += 1
+            try:
+                await job.ready.wait()
+                if job.status_msg is None:
+                    if job.abandon is not None: await job.abandon()
+                    continue
+                await job.status_msg.edit("Fetching Official Balance...")
+                await job.run(job.status_msg)
+            except Exception as e:
+                print(f"❌ Order job for {job.tg_id} failed: {e}")
+            finally:
+                self.running -= 1
+                async with self._changed:
+                    self._busy.discard(job.account)
+                    self._changed.notify_all()
+
+    async def run(self):
+        for lane, workers in self.lanes.items():
+            for _ in range(workers):
+                asyncio.create_task(self._worker(lane))
+        # Live queue positions, only for jobs whose position moved and capped per round (Telegram edit limits)
+        while True:
+            await asyncio.sleep(QUEUE_FEEDBACK_INTERVAL)
+            edits = 0
+            waiting = ((position, job) for lane in self.lanes for position, job in enumerate(self.dispatch_order(lane), 1))
+            for position, job in waiting:
+                if edits >= QUEUE_FEEDBACK_EDITS: break
+                if job.position == position or job.status_msg is None: continue
+                job.position = position
+                edits += 1
+                try: await job.status_msg.edit(f"⏳ Queued: position {position}")
+                except Exception: pass
+
+
+order_queue = FairOrderQueue(LANE_LIMITS, PRIORITY_FILE)
 
-        final_region = pizzo_region if pizzo_region != "Unknown" else smile_region
+# ==========================================
+# 💾 DURABLE ORDER JOBS (WRITE-AHEAD LOG + RESTART RECOVERY)
+# ==========================================
+ORDER_JOBS_FILE = os.getenv('ORDER_JOBS_FILE', 'order_jobs.journal')
+ORDER_JOBS_COMPACT_OPS = int(os.getenv('ORDER_JOBS_COMPACT_OPS', 500))
+
+class OrderJournal:
+    # Every order line is written here (fsynced) before it is acknowledged, and every pay is logged before
+    # it is sent. Replaying the log on start gives the jobs that were still open when the process stopped.
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self._ops = 0
+        self._next_id = 0
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: continue  # torn last line
+                self._apply(entry)
+        self._compact(self._snapshot_lines())
+        if self.jobs:
+            print(f"♻️ {len(self.jobs)} unfinished order job(s) found in {self.path}")
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'create':
+            self.jobs[entry['job']['id']] = entry['job']
+        elif op == 'update' and entry['id'] in self.jobs:
+            self.jobs[entry['id']].update(entry['fields'])
+        elif op == 'finish':
+            self.jobs.pop(entry['id'], None)
+
+    def _snapshot_lines(self):
+        return [json.dumps({'op': 'create', 'job': job}, ensure_ascii=False) + '\n' for job in self.jobs.values()]
+
+    def _append(self, line):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self, lines):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def _record(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        async with self._lock:
+            await work_executor.run(self._append, line)
+            self._apply(entry)
+            self._ops += 1
+            if self._ops >= ORDER_JOBS_COMPACT_OPS:
+                self._ops = 0
+                await work_executor.run(self._compact, self._snapshot_lines())
+
+    def new_job(self, kind, region, tg_id, username_display, chat_id, game_id, zone_id, item_input, items, total=None):
+        self._next_id += 1
+        return {
+            'id': f"{time.time_ns()}-{self._next_id}",
+            'kind': kind, 'region': region,
+            'tg_id': tg_id, 'username_display': username_display,
+            'chat_id': chat_id, 'message_id': None,
+            'game_id': game_id, 'zone_id': zone_id,
+            'item_input': item_input, 'items': list(items),
+            'total': total if total is not None else round(sum(item['price'] for item in items), 2),
+            'baseline': [], 'paying': 0, 'paid': [], 'failed': False, 'saved': False,
+            'created': time.time(),
+        }
 
-        report = f"ɢᴀᴍᴇ ɪᴅ : {game_id} ({zone_id})\nɪɢɴ ɴᴀᴍᴇ : {ig_name}\nʀᴇɢɪᴏɴ : {final_region}"
-        await loading_msg.edit(report)
+    async def create(self, job):
+        await self._record({'op': 'create', 'job': job})
 
-    except Exception as e:
-        await loading_msg.edit(f"❌ System Error: {str(e)}")
+    async def update(self, job_id, **fields):
+        await self._record({'op': 'update', 'id': job_id, 'fields': fields})
+
+    async def finish(self, job_id):
+        await self._record({'op': 'finish', 'id': job_id})
+
+
+order_jobs = OrderJournal(ORDER_JOBS_FILE)
+
+
+class JobProgress:
+    # Hooks purchase_package calls so the journal always knows what has been paid
+    def __init__(self, journal, job):
+        self.journal = journal
+        self.job = job
+
+    async def baseline(self, ids):
+        await self.journal.update(self.job['id'], baseline=list(ids))
+
+    async def paying(self, product_id):
+        await self.journal.update(self.job['id'], paying=self.job['paying'] + 1)
+
+    async def paid(self, result):
+        paid = self.job['paid'] + [{'order_id': result['order_id'], 'ig_name': result['ig_name']}]
+        await self.journal.update(self.job['id'], paid=paid)
+
+    async def failed(self):
+        # Nothing from this item on may be bought again by recovery
+        await self.journal.update(self.job['id'], failed=True)
+
+    async def saved(self):
+        await self.journal.update(self.job['id'], saved=True)
+
+
+async def run_order_job(job, loading_msg):
+    items = job['items']
+    total_required_price = job['total'] if 'total' in job else sum(item['price'] for item in items)
+    progress = JobProgress(order_jobs, job)
+    if job['kind'] == 'mcc':
+        await run_mcc_line(job['tg_id'], job['username_display'], job['game_id'], job['zone_id'], job['item_input'], items, total_required_price, loading_msg, progress)
+    else:
+        await run_direct_buy_line(job['tg_id'], job['username_display'], job['game_id'], job['zone_id'], job['item_input'], job['region'], items, total_required_price, loading_msg, progress)
+    await order_jobs.finish(job['id'])
+
+async def submit_order_job(job, reply, username=None):
+    # The job is journaled before the user is told it's queued; message_id is added once the status
+    # message exists. If the reply fails, or the queue drops the job, it's finished so a restart doesn't buy it
+    async def accept(queued):
+        await order_jobs.update(job['id'], message_id=queued.status_msg.id)
+
+    async def abandon():
+        if job['id'] in order_jobs.jobs:
+            print(f"⚠️ Order job {job['id']} dropped before it ran")
+            await order_jobs.finish(job['id'])
+
+    if job['id'] not in order_jobs.jobs:
+        await order_jobs.create(job)
+    try:
+        return await order_queue.submit(
+            job['tg_id'], job['region'], (str(job['game_id']), str(job['zone_id'])),
+            functools.partial(run_order_job, job), reply, username, accept, abandon
+        )
+    except BaseException:
+        await abandon()
+        raise
+
+async def enqueue_order(message, kind, region, tg_id, username_display, game_id, zone_id, item_input, entry):
+    job = order_jobs.new_job(kind, region, tg_id, username_display, message.chat.id, game_id, zone_id, item_input, entry.items, entry.total)
+    await submit_order_job(job, message.reply, message.from_user.username)
+
+async def recover_order_job(job):
+    reply = functools.partial(app.send_message, job['chat_id'])
+    if job['paying'] == 0 and not job.get('failed'):
+        # Nothing was sent to smile.one yet: just run it again
+        await submit_order_job(job, reply)
+        return
+
+    paid = list(job['paid'])
+    # A saved or failed job already ran to its end; only items with no progress record at all are bought again
+    stopped = job.get('failed') or job['saved']
+    unconfirmed = False
+    if not job['saved']:
+        if job['paying'] > len(paid) and not job.get('failed'):
+            # A pay went out without a confirmation on record: look for it in codelist
+            merchant = SMILE_MERCHANTS[job['region']]
+            matcher = OrderMatcher(job['baseline'] + [p['order_id'] for p in paid])
+            ig_name = paid[0]['ig_name'] if paid else "Unknown"
+            async with http_session() as scraper:
+                result = await confirm_order(
+                    scraper, merchant, merchant_headers(merchant['main_url']), job['game_id'], job['zone_id'], ig_name,
+                    matcher, (False, "Not found", "Not confirmed after restart.")
+                )
+            if result['status'] == 'success':
+                paid.append({'order_id': result['order_id'], 'ig_name': result['ig_name']})
+            else:
+                stopped = unconfirmed = True
+
+        if paid:
+            await save_order(
+                tg_id=job['tg_id'],
+                game_id=job['game_id'],
+                zone_id=job['zone_id'],
+                item_name=job['item_input'],
+                price=sum(item['price'] for item in job['items'][:len(paid)]),
+                order_id=", ".join(p['order_id'] for p in paid),
+                status="success",
+                region=job['region']
+            )
+        await order_jobs.update(job['id'], paid=paid, failed=stopped, saved=True)
+
+    remaining = [] if stopped else job['items'][len(paid):]
+    text = (
+        f"♻️ Order recovered after restart\n"
+        f"{job['game_id']} ({job['zone_id']}) {job['item_input']}\n"
+        f"Paid: {len(paid)} / {len(job['items'])}\n"
+        + ("".join(f"{p['order_id']}\n" for p in paid))
+        + ("Remaining items are queued again." if remaining else ("Stopped: last item could not be confirmed." if unconfirmed else ""))
+    )
+    try:
+        if job['message_id']: await app.edit_message_text(job['chat_id'], job['message_id'], text)
+        else: await reply(text)
+    except Exception:
+        await reply(text)
+
+    if remaining:
+        rest = order_jobs.new_job(job['kind'], job['region'], job['tg_id'], job['username_display'], job['chat_id'], job['game_id'], job['zone_id'], job['item_input'], remaining)
+        await submit_order_job(rest, reply)
+    await order_jobs.finish(job['id'])
+
+async def recover_order_jobs():
+    while not app.is_connected:
+        await asyncio.sleep(1)
+    for job in list(order_jobs.jobs.values()):
+        try:
+            await recover_order_job(job)
+        except Exception as e:
+            print(f"❌ Could not recover order job {job['id']}: {e}")
 
 # ==========================================
 # 8. 💎 PURCHASE (OFFICIAL BALANCE SYSTEM)
 # ==========================================
-@app.on_message(filters.regex(r"(?i)^(?:msc|br|ph|mlb|mlp|b|p)\s+\d+"))
-async def handle_direct_buy(client, message: Message):
-    if not await is_authorized(message):
-        return await message.reply(f"ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.❌")
-
+async def run_direct_buy_line(tg_id, username_display, game_id, zone_id, item_input, currency_name, items_to_buy, total_required_price, loading_msg, progress=None):
     try:
-        tg_id = str(message.from_user.id)
-        lines = message.text.strip().split('\n')
-        
-        telegram_user = message.from_user.username
-        username_display = f"@{telegram_user}" if telegram_user else tg_id
-        
-        async with transaction_lock: 
-            for line in lines:
-                line = line.strip()
-                if not line: continue 
-                
-                match = re.search(r"(?i)^(?:(?:msc|br|ph|mlb|mlp|b|p)\s+)?(\d+)\s*(?:[\(]?\s*(\d+)\s*[\)]?)\s+([a-zA-Z0-9_]+)", line)
-                
-                if not match:
-                    await message.reply(f"Invalid format: `{line}`\n(Example: msc 12345678 1234 11 OR br 12345678 (1234) wp)")
-                    continue
-                    
-                game_id = match.group(1)
-                zone_id = match.group(2)
-                item_input = match.group(3).lower() 
-                
-                currency_name = ''
-                active_packages = {}
-                v_bal_key = ''
-
-                if item_input in DOUBLE_DIAMOND_PACKAGES:
-                    currency_name = 'BR'
-                    active_packages = DOUBLE_DIAMOND_PACKAGES
-                    v_bal_key = 'br_balance'
-                elif item_input in BR_PACKAGES:
-                    currency_name = 'BR'
-                    active_packages = BR_PACKAGES
-                    v_bal_key = 'br_balance'
-                elif item_input in PH_PACKAGES:
-                    currency_name = 'PH'
-                    active_packages = PH_PACKAGES
-                    v_bal_key = 'ph_balance'
-                else:
-                    await message.reply(f"❌ No Package found for the selected '{item_input}'.")
-                    continue
-                    
-                items_to_buy = active_packages[item_input]
-                total_required_price = sum(item['price'] for item in items_to_buy)
-                
-                loading_msg = await message.reply(f"Fetching Official Balance...")
-                
-                # Get Initial Official Balance
-                scraper_bal = await get_main_scraper()
-                headers_bal = {'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://www.smile.one'}
-                bal_url = 'https://www.smile.one/ph/customer/order' if currency_name == 'PH' else 'https://www.smile.one/customer/order'
-                
-                initial_bal_dict = await get_smile_balance(scraper_bal, headers_bal, bal_url)
-                current_bal = initial_bal_dict.get(v_bal_key, 0.0)
-                
-                if current_bal < total_required_price:
-                    error_text = (
-                        f"Nᴏᴛ ᴇɴᴏᴜɢʜ ᴍᴏɴᴇʏ ɪɴ Oғғɪᴄɪᴀʟ ᴀᴄᴄᴏᴜɴᴛ.\n"
-                        f"Nᴇᴇᴅ ʙᴀʟᴀɴᴄᴇ: {total_required_price} {currency_name}\n"
-                        f"Cᴜʀʀᴇɴᴛ ʙᴀʟᴀɴᴄᴇ: {current_bal} {currency_name}"
-                    )
-                    await loading_msg.edit(error_text)
-                    continue
-                
+        async with order_scheduler.order(currency_name, game_id, zone_id):
+            # Reserve the package price from the Official Balance (ledger)
+            reservation = await balance_ledger.reserve(currency_name, total_required_price)
+            current_bal = balance_ledger.peek(currency_name)
+            
+            if reservation is None:
+                error_text = (
+                    f"Nᴏᴛ ᴇɴᴏᴜɢʜ ᴍᴏɴᴇʏ ɪɴ Oғғɪᴄɪᴀʟ ᴀᴄᴄᴏᴜɴᴛ.\n"
+                    f"Nᴇᴇᴅ ʙᴀʟᴀɴᴄᴇ: {total_required_price} {currency_name}\n"
+                    f"Cᴜʀʀᴇɴᴛ ʙᴀʟᴀɴᴄᴇ: {balance_ledger.available(currency_name)} {currency_name}"
+                )
+                await loading_msg.edit(error_text)
+                return
+            
+            success_count = 0
+            fail_count = 0
+            total_spent = 0.0
+            order_ids_str = ""
+            ig_name = "Unknown"
+            error_msg = ""
+            first_order = True
+            
+            with reservation:
                 await loading_msg.edit(f"Recharging Diam͟o͟n͟d͟ ● ᥫ᭡")
-                
-                success_count = 0
-                fail_count = 0
-                total_spent = 0.0
-                order_ids_str = ""
-                ig_name = "Unknown"
-                error_msg = ""
-                first_order = True
-                
-                seen_order_ids = []
-                
-                for item in items_to_buy:
-                    result = await process_smile_one_order(game_id, zone_id, item['pid'], currency_name, seen_order_ids)
-                    
+                results = await purchase_package(game_id, zone_id, [item['pid'] for item in items_to_buy], currency_name, progress=PackageProgress(reservation, items_to_buy, progress))
+                for item, result in zip(items_to_buy, results):
                     if result['status'] == 'success':
                         if first_order:
                             ig_name = result['ig_name']
@@ -1080,71 +3513,67 @@ async def handle_direct_buy(client, message: Message):
                         total_spent += item['price']
                         
                         order_id = result['order_id']
-                        seen_order_ids.append(order_id)
                         order_ids_str += f"{order_id}\n" 
-                        
-                        await asyncio.sleep(random.randint(2, 5)) 
                     else:
                         fail_count += 1
                         error_msg = result['message']
+                        if progress is not None: await progress.failed()
                         break 
+            
+            if success_count > 0:
+                now = datetime.datetime.now(MMT)
+                date_str = now.strftime("%m/%d/%Y, %I:%M:%S %p")
                 
-                if success_count > 0:
-                    now = datetime.datetime.now(MMT)
-                    date_str = now.strftime("%m/%d/%Y, %I:%M:%S %p")
-                    
-                    # Get Final Official Balance
-                    final_bal_dict = await get_smile_balance(scraper_bal, headers_bal, bal_url)
-                    new_bal = final_bal_dict.get(v_bal_key, 0.0)
-                    
-                    final_order_ids = order_ids_str.strip().replace('\n', ', ')
-                    
-                    await save_order(
-                        tg_id=tg_id,
-                        game_id=game_id,
-                        zone_id=zone_id,
-                        item_name=item_input,
-                        price=total_spent,
-                        order_id=final_order_ids,
-                        status="success"
-                    )
-                 
-                    safe_ig_name = html.escape(str(ig_name))
-                    safe_username = html.escape(str(username_display))
-                    
-                    report = (
-                        f"<blockquote><code>=== ᴛʀᴀɴsᴀᴄᴛɪᴏɴ ʀᴇᴘᴏʀᴛ ===\n\n"
-                        f"ᴏʀᴅᴇʀ sᴛᴀᴛᴜs : ✅ Sᴜᴄᴄᴇss\n"
-                        f"ɢᴀᴍᴇ ɪᴅ      : {game_id} {zone_id}\n"
-                        f"ɪɢ ɴᴀᴍᴇ      : {safe_ig_name}\n"
-                        f"sᴇʀɪᴀʟ       :\n{order_ids_str.strip()}\n"
-                        f"ɪᴛᴇᴍ         : {item_input} 💎\n"
-                        f"sᴘᴇɴᴛ        : {total_spent:.2f} 🪙\n\n"
-                        f"ᴅᴀᴛᴇ         : {date_str}\n"
-                        f"ᴜsᴇʀɴᴀᴍᴇ     : {safe_username}\n"
-                        f"sᴘᴇɴᴛ        : ${total_spent:.2f}\n"
-                        f"ɪɴɪᴛɪᴀʟ      : ${current_bal:,.2f}\n"
-                        f"ғɪɴᴀʟ        : ${new_bal:,.2f}\n\n"
-                        f"Sᴜᴄᴄᴇss {success_count} / Fᴀɪʟ {fail_count}</code></blockquote>"
-                    )
-
-                    await loading_msg.edit(report, parse_mode=ParseMode.HTML)
-                    
-                    if fail_count > 0:
-                        await message.reply(f"Only partially successful.\nError: {error_msg}")
-                else:
-                    await loading_msg.edit(f"❌ Order failed:\n{error_msg}")
+                # Final Official Balance (ledger)
+                new_bal = balance_ledger.peek(currency_name)
+                
+                final_order_ids = order_ids_str.strip().replace('\n', ', ')
+                
+                await save_order(
+                    tg_id=tg_id,
+                    game_id=game_id,
+                    zone_id=zone_id,
+                    item_name=item_input,
+                    price=total_spent,
+                    order_id=final_order_ids,
+                    status="success",
+                    region=currency_name
+                )
+                if progress is not None: await progress.saved()
+             
+                safe_ig_name = html.escape(str(ig_name))
+                safe_username = html.escape(str(username_display))
+                
+                report = (
+                    f"<blockquote><code>=== ᴛʀᴀɴsᴀᴄᴛɪᴏɴ ʀᴇᴘᴏʀᴛ ===\n\n"
+                    f"ᴏʀᴅᴇʀ sᴛᴀᴛᴜs : ✅ Sᴜᴄᴄᴇss\n"
+                    f"ɢᴀᴍᴇ ɪᴅ      : {game_id} {zone_id}\n"
+                    f"ɪɢ ɴᴀᴍᴇ      : {safe_ig_name}\n"
+                    f"sᴇʀɪᴀʟ       :\n{order_ids_str.strip()}\n"
+                    f"ɪᴛᴇᴍ         : {item_input} 💎\n"
+                    f"sᴘᴇɴᴛ        : {total_spent:.2f} 🪙\n\n"
+                    f"ᴅᴀᴛᴇ         : {date_str}\n"
+                    f"ᴜsᴇʀɴᴀᴍᴇ     : {safe_username}\n"
+                    f"sᴘᴇɴᴛ        : ${total_spent:.2f}\n"
+                    f"ɪɴɪᴛɪᴀʟ      : ${current_bal:,.2f}\n"
+                    f"ғɪɴᴀʟ        : ${new_bal:,.2f}\n\n"
+                    f"Sᴜᴄᴄᴇss {success_count} / Fᴀɪʟ {fail_count}</code></blockquote>"
+                )
 
+                await loading_msg.edit(report, parse_mode=ParseMode.HTML)
+                
+                if fail_count > 0:
+                    await loading_msg.reply(f"Only partially successful.\nError: {error_msg}")
+            else:
+                await loading_msg.edit(f"❌ Order failed:\n{error_msg}")
     except Exception as e:
-        await message.reply(f"System Error: {str(e)}")
+        await loading_msg.reply(f"System Error: {str(e)}")
 
 
-# 🌟 NEW: 8.1 MAGIC CHESS (OFFICIAL BALANCE ဖြင့် ဝယ်ယူခြင်း) 🌟
-
-@app.on_message(filters.regex(r"(?i)^mcc\s+\d+"))
-async def handle_mcc_buy(client, message: Message):
+@app.on_message(filters.regex(r"(?i)^(?:msc|br|ph|mlb|mlp|b|p)\s+\d+"))
+async def handle_direct_buy(client, message: Message):
     if not await is_authorized(message):
-        return await message.reply(f"ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
+        return await message.reply(f"ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.❌")
 
     try:
         tg_id = str(message.from_user.id)
@@ -1153,62 +3582,62 @@ async def handle_mcc_buy(client, message: Message):
         telegram_user = message.from_user.username
         username_display = f"@{telegram_user}" if telegram_user else tg_id
         
-        async with transaction_lock:
-            for line in lines:
-                line = line.strip()
-                if not line: continue 
-                
-                match = re.search(r"(?i)^(?:mcc\s+)?(\d+)\s*(?:[\(]?\s*(\d+)\s*[\)]?)\s+([a-zA-Z0-9_]+)", line)
-                
-                if not match:
-                    await message.reply(f"❌ Invalid format: `{line}`\n(Example: mcc 12345678 1234 86)")
-                    continue
-                    
-                game_id = match.group(1)
-                zone_id = match.group(2)
-                item_input = match.group(3).lower()
-                
-                if item_input not in MCC_PACKAGES:
-                    await message.reply(f"❌ No Magic Chess Package found for '{item_input}'.")
-                    continue
-                    
-                items_to_buy = MCC_PACKAGES[item_input]
-                total_required_price = sum(item['price'] for item in items_to_buy)
-                
-                loading_msg = await message.reply(f"Fetching Official Balance...")
-                
-                # Get Initial Official Balance
-                scraper_bal = await get_main_scraper()
-                headers_bal = {'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://www.smile.one'}
-                bal_url = 'https://www.smile.one/customer/order'
-                
-                initial_bal_dict = await get_smile_balance(scraper_bal, headers_bal, bal_url)
-                current_bal = initial_bal_dict.get('br_balance', 0.0)
+        for line in lines:
+            line = line.strip()
+            if not line: continue 
+            
+            match = re.search(r"(?i)^(?:(msc|br|ph|mlb|mlp|b|p)\s+)?(\d+)\s*(?:[\(]?\s*(\d+)\s*[\)]?)\s+([a-zA-Z0-9_]+)", line)
+            
+            if not match:
+                await message.reply(f"Invalid format: `{line}`\n(Example: msc 12345678 1234 11 OR br 12345678 (1234) wp)")
+                continue
                 
-                if current_bal < total_required_price:
-                    error_text = (
-                        f"Nᴏᴛ ᴇɴᴏᴜɢʜ ᴍᴏɴᴇʏ ɪɴ Oғғɪᴄɪᴀʟ ᴀᴄᴄᴏᴜɴᴛ.\n"
-                        f"Nᴇᴇᴅ ʙᴀʟᴀɴᴄᴇ: {total_required_price} BR\n"
-                        f"Cᴜʀʀᴇɴᴛ ʙᴀʟᴀɴᴄᴇ: {current_bal} BR"
-                    )
-                    await loading_msg.edit(error_text)
-                    continue
+            region = PREFIX_REGIONS.get((match.group(1) or '').lower())
+            game_id = match.group(2)
+            zone_id = match.group(3)
+            item_input = match.group(4).lower() 
+            
+            entry = catalog.resolve_direct(item_input, region)
+            if entry is None:
+                await message.reply(f"❌ No Package found for the selected '{item_input}'.")
+                continue
                 
+            await enqueue_order(message, 'direct', entry.region, tg_id, username_display, game_id, zone_id, item_input, entry)
+
+    except Exception as e:
+        await message.reply(f"System Error: {str(e)}")
+
+
+# 🌟 NEW: 8.1 MAGIC CHESS (OFFICIAL BALANCE ဖြင့် ဝယ်ယူခြင်း) 🌟
+
+async def run_mcc_line(tg_id, username_display, game_id, zone_id, item_input, items_to_buy, total_required_price, loading_msg, progress=None):
+    try:
+        async with order_scheduler.order('MCC', game_id, zone_id):
+            # Reserve the package price from the Official Balance (ledger; MCC is paid from the BR balance)
+            reservation = await balance_ledger.reserve('BR', total_required_price)
+            current_bal = balance_ledger.peek('BR')
+            
+            if reservation is None:
+                error_text = (
+                    f"Nᴏᴛ ᴇɴᴏᴜɢʜ ᴍᴏɴᴇʏ ɪɴ Oғғɪᴄɪᴀʟ ᴀᴄᴄᴏᴜɴᴛ.\n"
+                    f"Nᴇᴇᴅ ʙᴀʟᴀɴᴄᴇ: {total_required_price} BR\n"
+                    f"Cᴜʀʀᴇɴᴛ ʙᴀʟᴀɴᴄᴇ: {balance_ledger.available('BR')} BR"
+                )
+                await loading_msg.edit(error_text)
+                return
+            
+            success_count = 0
+            fail_count = 0
+            total_spent = 0.0
+            order_ids_str = ""
+            ig_name = "Unknown"
+            error_msg = ""
+            first_order = True
+            
+            with reservation:
                 await loading_msg.edit(f"💻")
-                
-                success_count = 0
-                fail_count = 0
-                total_spent = 0.0
-                order_ids_str = ""
-                ig_name = "Unknown"
-                error_msg = ""
-                first_order = True
-                
-                seen_order_ids = []
-                
-                for item in items_to_buy:
-                    result = await process_mcc_order(game_id, zone_id, item['pid'], seen_order_ids)
-                    
+                results = await purchase_package(game_id, zone_id, [item['pid'] for item in items_to_buy], 'MCC', progress=PackageProgress(reservation, items_to_buy, progress))
+                for item, result in zip(items_to_buy, results):
                     if result['status'] == 'success':
                         if first_order:
                             ig_name = result['ig_name']
@@ -1218,62 +3647,97 @@ async def handle_mcc_buy(client, message: Message):
                         total_spent += item['price']
                         
                         order_id = result['order_id']
-                        seen_order_ids.append(order_id)
                         order_ids_str += f"{order_id}\n"
-                        
-                        await asyncio.sleep(random.randint(5, 10)) 
                     else:
                         fail_count += 1
                         error_msg = result['message']
+                        if progress is not None: await progress.failed()
                         break 
+            
+            if success_count > 0:
+                now = datetime.datetime.now(MMT)
+                date_str = now.strftime("%m/%d/%Y, %I:%M:%S %p")
                 
-                if success_count > 0:
-                    now = datetime.datetime.now(MMT)
-                    date_str = now.strftime("%m/%d/%Y, %I:%M:%S %p")
-                    
-                    # Get Final Official Balance
-                    final_bal_dict = await get_smile_balance(scraper_bal, headers_bal, bal_url)
-                    new_bal = final_bal_dict.get('br_balance', 0.0)
-                    
-                    final_order_ids = order_ids_str.strip().replace('\n', ', ')
-                    
-                    await save_order(
-                        tg_id=tg_id,
-                        game_id=game_id,
-                        zone_id=zone_id,
-                        item_name=item_input,
-                        price=total_spent,
-                        order_id=final_order_ids,
-                        status="success"
-                    )
-                 
-                    safe_ig_name = html.escape(str(ig_name))
-                    safe_username = html.escape(str(username_display))
-
-                    report = (
-                        f"<blockquote><code>**MCC {game_id} ({zone_id}) {item_input}**\n"
-                        f"=== ᴛʀᴀɴsᴀᴄᴛɪᴏɴ ʀᴇᴘᴏʀᴛ ===\n\n"
-                        f"ᴏʀᴅᴇʀ sᴛᴀᴛᴜs : ✅ Sᴜᴄᴄᴇss\n"
-                        f"ɢᴀᴍᴇ         : ᴍᴀɢɪᴄ ᴄʜᴇss ɢᴏ ɢᴏ\n"
-                        f"ɢᴀᴍᴇ ɪᴅ      : {game_id} {zone_id}\n"
-                        f"ɪɢ ɴᴀᴍᴇ      : {safe_ig_name}\n"
-                        f"ᴏʀᴅᴇʀ ɪᴅ     :\n{order_ids_str.strip()}\n"
-                        f"ɪᴛᴇᴍ         : {item_input} 💎\n"
-                        f"sᴘᴇɴᴛ        : {total_spent:.2f} 🪙\n\n"
-                        f"ᴅᴀᴛᴇ         : {date_str}\n"
-                        f"ᴜsᴇʀɴᴀᴍᴇ     : {safe_username}\n"
-                        f"sᴘᴇɴᴛ        : ${total_spent:.2f}\n"
-                        f"ɪɴɪᴛɪᴀʟ      : ${current_bal:,.2f}\n"
-                        f"ғɪɴᴀʟ        : ${new_bal:,.2f}\n\n"
-                        f"Sᴜᴄᴄᴇss {success_count} / Fᴀɪʟ {fail_count}</code></blockquote>" 
-                    )
-
-                    await loading_msg.edit(report, parse_mode=ParseMode.HTML)
-                    
-                    if fail_count > 0: 
-                        await message.reply(f"⚠️ Only partially successful.\nError: {error_msg}")
-                else:
-                    await loading_msg.edit(f"Oʀᴅᴇʀ ғᴀɪʟ❌\n{error_msg}")
+                # Final Official Balance (ledger)
+                new_bal = balance_ledger.peek('BR')
+                
+                final_order_ids = order_ids_str.strip().replace('\n', ', ')
+                
+                await save_order(
+                    tg_id=tg_id,
+                    game_id=game_id,
+                    zone_id=zone_id,
+                    item_name=item_input,
+                    price=total_spent,
+                    order_id=final_order_ids,
+                    status="success",
+                    region='MCC'
+                )
+                if progress is not None: await progress.saved()
+             
+                safe_ig_name = html.escape(str(ig_name))
+                safe_username = html.escape(str(username_display))
+
+                report = (
+                    f"<blockquote><code>**MCC {game_id} ({zone_id}) {item_input}**\n"
+                    f"=== ᴛʀᴀɴsᴀᴄᴛɪᴏɴ ʀᴇᴘᴏʀᴛ ===\n\n"
+                    f"ᴏʀᴅᴇʀ sᴛᴀᴛᴜs : ✅ Sᴜᴄᴄᴇss\n"
+                    f"ɢᴀᴍᴇ         : ᴍᴀɢɪᴄ ᴄʜᴇss ɢᴏ ɢᴏ\n"
+                    f"ɢᴀᴍᴇ ɪᴅ      : {game_id} {zone_id}\n"
+                    f"ɪɢ ɴᴀᴍᴇ      : {safe_ig_name}\n"
+                    f"ᴏʀᴅᴇʀ ɪᴅ     :\n{order_ids_str.strip()}\n"
+                    f"ɪᴛᴇᴍ         : {item_input} 💎\n"
+                    f"sᴘᴇɴᴛ        : {total_spent:.2f} 🪙\n\n"
+                    f"ᴅᴀᴛᴇ         : {date_str}\n"
+                    f"ᴜsᴇʀɴᴀᴍᴇ     : {safe_username}\n"
+                    f"sᴘᴇɴᴛ        : ${total_spent:.2f}\n"
+                    f"ɪɴɪᴛɪᴀʟ      : ${current_bal:,.2f}\n"
+                    f"ғɪɴᴀʟ        : ${new_bal:,.2f}\n\n"
+                    f"Sᴜᴄᴄᴇss {success_count} / Fᴀɪʟ {fail_count}</code></blockquote>" 
+                )
+
+                await loading_msg.edit(report, parse_mode=ParseMode.HTML)
+                
+                if fail_count > 0: 
+                    await loading_msg.reply(f"⚠️ Only partially successful.\nError: {error_msg}")
+            else:
+                await loading_msg.edit(f"Oʀᴅᴇʀ ғᴀɪʟ❌\n{error_msg}")
+    except Exception as e:
+        await loading_msg.reply(f"Sʏsᴛᴇᴍ ᴇʀʀᴏʀ: {str(e)}")
+
+
+@app.on_message(filters.regex(r"(?i)^mcc\s+\d+"))
+async def handle_mcc_buy(client, message: Message):
+    if not await is_authorized(message):
+        return await message.reply(f"ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
+
+    try:
+        tg_id = str(message.from_user.id)
+        lines = message.text.strip().split('\n')
+        
+        telegram_user = message.from_user.username
+        username_display = f"@{telegram_user}" if telegram_user else tg_id
+        
+        for line in lines:
+            line = line.strip()
+            if not line: continue 
+            
+            match = re.search(r"(?i)^(?:mcc\s+)?(\d+)\s*(?:[\(]?\s*(\d+)\s*[\)]?)\s+([a-zA-Z0-9_]+)", line)
+            
+            if not match:
+                await message.reply(f"❌ Invalid format: `{line}`\n(Example: mcc 12345678 1234 86)")
+                continue
+                
+            game_id = match.group(1)
+            zone_id = match.group(2)
+            item_input = match.group(3).lower()
+            
+            entry = catalog.resolve_mcc(item_input)
+            if entry is None:
+                await message.reply(f"❌ No Magic Chess Package found for '{item_input}'.")
+                continue
+                
+            await enqueue_order(message, 'mcc', 'MCC', tg_id, username_display, game_id, zone_id, item_input, entry)
 
     except Exception as e:
         await message.reply(f"Sʏsᴛᴇᴍ ᴇʀʀᴏʀ: {str(e)}")
@@ -1286,24 +3750,7 @@ async def show_price_list_br(client, message: Message):
     if not await is_authorized(message):
         return await message.reply("ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
 
-    def generate_list(package_dict):
-        lines = []
-        for key, items in package_dict.items():
-            total_price = sum(item['price'] for item in items)
-            lines.append(f"{key:<5} : ${total_price:,.2f}")
-        return "\n".join(lines)
-
-    br_list = generate_list(BR_PACKAGES)
-    bonus_list = generate_list(DOUBLE_DIAMOND_PACKAGES)
-
-    response_text = (
-        f"🇧🇷 <b>𝘿𝙤𝙪𝙗𝙡𝙚 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
-        f"<code>{bonus_list}</code>\n\n"
-        f"🇧🇷 <b>𝘽𝙧 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
-        f"<code>{br_list}</code>"
-    )
-
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(catalog.lists['BR'], parse_mode=ParseMode.HTML)
 
 
 # 11.1 📜 PH PRICE LIST COMMAND (.listp / /listp)
@@ -1313,21 +3760,7 @@ async def show_price_list_ph(client, message: Message):
     if not await is_authorized(message):
         return await message.reply("ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
 
-    def generate_list(package_dict):
-        lines = []
-        for key, items in package_dict.items():
-            total_price = sum(item['price'] for item in items)
-            lines.append(f"{key:<5} : ${total_price:,.2f}")
-        return "\n".join(lines)
-
-    ph_list = generate_list(PH_PACKAGES)
-
-    response_text = (
-        f"🇵🇭 <b>𝙋𝙝 𝙋𝙖𝙘𝙠𝙖𝙜𝙚𝙨</b>\n"
-        f"<code>{ph_list}</code>"
-    )
-
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(catalog.lists['PH'], parse_mode=ParseMode.HTML)
 
 
 # 11.2 BR MCC PRICE LIST COMMAND (.listmb / /listmb)
@@ -1337,21 +3770,7 @@ async def show_price_list_mcc(client, message: Message):
     if not await is_authorized(message):
         return await message.reply("ɴᴏᴛ ᴀᴜᴛʜᴏʀɪᴢᴇᴅ ᴜsᴇʀ.")
 
-    def generate_list(package_dict):
-        lines = []
-        for key, items in package_dict.items():
-            total_price = sum(item['price'] for item in items)
-            lines.append(f"{key:<5} : ${total_price:,.2f}")
-        return "\n".join(lines)
-
-    mcc_list = generate_list(MCC_PACKAGES)
-
-    response_text = (
-        f"🇧🇷 <b>𝙈𝘾𝘾 𝙋𝘼𝘾𝙆𝘼𝙂𝙀𝙎</b>\n"
-        f"<code>{mcc_list}</code>"
-    )
-
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(catalog.lists['MCC'], parse_mode=ParseMode.HTML)
 
 
 # 🧮 SMART CALCULATOR FUNCTION
@@ -1387,18 +3806,18 @@ async def keep_cookie_alive():
     while True:
         try:
             await asyncio.sleep(2 * 60) 
-            scraper = await get_main_scraper()
             headers = {
                 'User-Agent': 'Mozilla/5.0',
                 'X-Requested-With': 'XMLHttpRequest',
                 'Origin': 'https://www.smile.one'
             }
-            response = await asyncio.to_thread(scraper.get, 'https://www.smile.one/customer/order', headers=headers)
+            async with http_session() as scraper:
+                response = await scraper.get('https://www.smile.one/customer/order', headers=headers)
             if "login" not in response.url.lower() and response.status_code == 200:
                 print(f"[{datetime.datetime.now(MMT).strftime('%I:%M %p')}] 💓 Main Cookie is alive!")
             else:
                 print(f"[{datetime.datetime.now(MMT).strftime('%I:%M %p')}]  Main Cookie expired. Auto-login triggered.")
-                await auto_login_and_get_cookie()
+                await session_renewal.renew()
         except Exception as e:
             pass
 
@@ -1418,7 +3837,9 @@ async def send_help_message(client, message: Message):
         f"<b>💎 𝐌𝐋𝐁Ｂ 𝐃𝐢𝐚𝐦𝐨𝐧𝐝𝐬</b>\n"
         f"<blockquote><code>msc ID (Zone) Pack</code></blockquote>\n"
         f"Ex: <code>msc 12345678 12345 172</code>\n"
-        f"<i>(command : msc, br, ph, mlb, mlp)</i>\n\n"
+        f"<i>(command : msc, br, ph, mlb, mlp)</i>\n"
+        f"<i>Listed packs buy the same pack with any command. Other diamond amounts are combined "
+        f"from the br/ph list of the command (msc: BR, else PH).</i>\n\n"
 
         f"<b>♟️ 𝐌𝐚𝐠𝐢𝐜 𝐂𝐡𝐞𝐬𝐬</b>\n"
         f"<blockquote><code>mcc ID (Zone) Pack</code></blockquote>\n"
@@ -1443,6 +3864,9 @@ async def send_help_message(client, message: Message):
             f"🔸 <code>.add ID/Username</code>    : Add User\n"
             f"🔸 <code>.remove ID/Username</code> : Remove User\n"
             f"🔸 <code>.users</code>              : User List\n"
+            f"🔸 <code>.stats</code>              : Sales Stats\n"
+            f"🔸 <code>.iostats</code>            : I/O Executor Stats\n"
+            f"🔸 <code>.priority ID Weight</code> : Queue Priority\n"
             f"🔸 <code>/setcookie</code>         : Update Cookie\n"
         )
         
@@ -1509,7 +3933,23 @@ if __name__ == '__main__':
     print("နှလုံးသားမပါရင် ဘယ်အရာမှတရားမဝင်.....")
     
     loop = asyncio.get_event_loop()
+    loop.run_until_complete(storage.start())
+    order_archive.load()
+    loop.create_task(order_archive.run())
+    loop.create_task(scraper_pool.warm())
     loop.create_task(keep_cookie_alive())
+    loop.create_task(balance_ledger.run())
+    order_queue.load()
+    order_jobs.load()
+    catalog_watcher.load()
+    loop.create_task(catalog_watcher.run())
+    loop.create_task(order_queue.run())
+    loop.create_task(recover_order_jobs())
 
     print("Bot is successfully running (Official Single Wallet System)...")
     app.run()
+    loop.run_until_complete(http_transport.close())
+    loop.run_until_complete(login_browser.close())
+    loop.run_until_complete(storage.close())
+    http_executor.shutdown()
+    work_executor.shutdown()
@@ -0,0 +1,10 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123:abc')
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'x')
+os.environ.setdefault('OWNER_ID', '42')
+asyncio.set_event_loop(asyncio.new_event_loop())
@@ -0,0 +1,685 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import psp
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_confirm_second_item_after_pay_returned_order_id(monkeypatch):
+    monkeypatch.setattr(psp, 'CONFIRM_FIRST_POLL', 0.01)
+    merchant = psp.SMILE_MERCHANTS['BR']
+    rows = [{'increment_id': '900', 'user_id': '1', 'server_id': '2', 'order_status': 'success'}]
+
+    async def fake_rows(scraper, merchant, headers, page_size):
+        return list(rows)
+    monkeypatch.setattr(psp, 'fetch_order_rows', fake_rows)
+
+    matcher = psp.OrderMatcher(['900'])
+    first = run(psp.confirm_order(None, merchant, {}, '1', '2', 'ign', matcher, (True, '901', None)))
+    assert first == {'status': 'success', 'ig_name': 'ign', 'order_id': '901'}
+
+    # The second pay came back without an id; its row shows up on top of the first one
+    rows[:0] = [{'increment_id': '902', 'user_id': '1', 'server_id': '2', 'order_status': 'success'},
+                {'increment_id': '901', 'user_id': '1', 'server_id': '2', 'order_status': 'success'}]
+    second = run(psp.confirm_order(None, merchant, {}, '1', '2', 'ign', matcher, (True, 'Not found', None)))
+    assert second == {'status': 'success', 'ig_name': 'ign', 'order_id': '902'}
+    assert matcher.unclaimed == 0
+
+
+def test_direct_resolution_follows_command_prefix():
+    catalog = psp.CompiledCatalog(psp.default_catalog_data())
+    assert catalog.resolve_direct('1000', 'BR') is None
+    assert catalog.resolve_direct('258', 'PH') is None
+    assert catalog.resolve_direct('343', 'BR').region == 'BR'
+    assert catalog.resolve_direct('112', 'PH').region == 'PH'
+    # Listed packs ignore the prefix
+    assert catalog.resolve_direct('86', 'PH').items == catalog.explicit['BR']['86'].items
+    assert catalog.resolve_direct('55', 'PH').pids == ('22590',)
+    assert catalog.resolve_direct('55').pids == ('22590',)
+    assert catalog.resolve_direct('pwp', 'BR').region == 'PH'
+    assert catalog.resolve_direct('wp').region == 'BR'
+    # Unlisted amounts are planned in the prefix's wallet
+    assert catalog.resolve_direct('33', 'PH').region == 'PH'
+    assert catalog.resolve_direct('33', 'BR') is None
+    assert catalog.resolve_direct('33').region == 'PH'
+
+
+def test_planner_caps_item_count():
+    catalog = psp.CompiledCatalog(psp.default_catalog_data())
+    assert catalog.resolve_direct('220', 'PH') is None
+    for region in ('BR', 'PH', 'MCC'):
+        for amount in range(1, 3000):
+            entry = catalog.resolve(region, str(amount))
+            assert entry is None or len(entry.items) <= psp.PLANNER_MAX_ITEMS
+
+
+def test_price_lists_show_charged_totals():
+    catalog = psp.CompiledCatalog(psp.default_catalog_data())
+    for region in ('BR', 'PH', 'MCC'):
+        for line in catalog.lists[region].replace('<code>', '\n').replace('</code>', '\n').splitlines():
+            if ' : $' not in line: continue
+            key, price = [part.strip() for part in line.split(' : $')]
+            entry = catalog.resolve_mcc(key) if region == 'MCC' else catalog.resolve_direct(key)
+            assert f"{entry.total:,.2f}" == price
+
+
+class FakeStatus:
+    id = 7
+
+    async def edit(self, text, **kwargs):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, fail_reply=False):
+        self.fail_reply = fail_reply
+        self.chat = type('Chat', (), {'id': 5})()
+        self.from_user = type('User', (), {'username': 'u'})()
+
+    async def reply(self, text, **kwargs):
+        if self.fail_reply:
+            raise RuntimeError('reply failed')
+        return FakeStatus()
+
+
+def use_journal(monkeypatch, tmp_path):
+    journal = psp.OrderJournal(str(tmp_path / 'jobs.journal'))
+    monkeypatch.setattr(psp, 'order_jobs', journal)
+    monkeypatch.setattr(psp, 'order_queue', psp.FairOrderQueue(psp.LANE_LIMITS, str(tmp_path / 'priorities.json')))
+    return journal
+
+
+def test_order_is_journaled_before_it_is_acknowledged(monkeypatch, tmp_path):
+    journal = use_journal(monkeypatch, tmp_path)
+    entry = psp.catalog.resolve_direct('86', 'BR')
+    journaled_at_reply = []
+
+    class CheckingMessage(FakeMessage):
+        async def reply(self, text, **kwargs):
+            journaled_at_reply.append(len(journal.jobs))
+            return await super().reply(text, **kwargs)
+
+    async def scenario():
+        try:
+            await psp.enqueue_order(CheckingMessage(fail_reply=True), 'direct', 'BR', '1', '@u', '1', '2', '86', entry)
+        except RuntimeError:
+            pass
+        # Journaled before the reply; the reply never went out, so the job was finished
+        assert journaled_at_reply == [1] and journal.jobs == {}
+        reloaded = psp.OrderJournal(journal.path)
+        reloaded.load()
+        assert reloaded.jobs == {}
+        await psp.enqueue_order(CheckingMessage(), 'direct', 'BR', '1', '@u', '1', '2', '86', entry)
+        assert journaled_at_reply == [1, 1]
+        assert [job['message_id'] for job in journal.jobs.values()] == [7]
+    run(scenario())
+
+
+def test_recovery_never_rebuys_saved_or_failed_items(monkeypatch, tmp_path):
+    journal = use_journal(monkeypatch, tmp_path)
+    submitted = []
+
+    async def fake_submit(job, reply, username=None):
+        submitted.append(job)
+    monkeypatch.setattr(psp, 'submit_order_job', fake_submit)
+
+    async def fake_save_order(**kwargs):
+        pass
+    monkeypatch.setattr(psp, 'save_order', fake_save_order)
+
+    async def fake_send(*args, **kwargs):
+        pass
+    monkeypatch.setattr(psp.app, 'edit_message_text', fake_send)
+    monkeypatch.setattr(psp.app, 'send_message', fake_send)
+
+    items = [{'pid': '13', 'price': 61.5, 'name': '86 💎'}] * 3
+
+    async def scenario():
+        for state in ({'saved': True}, {'failed': True}, {}):
+            job = journal.new_job('direct', 'BR', '1', '@u', 5, '1', '2', '258', items)
+            job.update(paying=1, paid=[{'order_id': 'A1', 'ig_name': 'n'}], **state)
+            await journal.create(job)
+            await psp.recover_order_job(job)
+        assert journal.jobs == {}
+        assert len(submitted) == 1 and len(submitted[0]['items']) == 2
+    run(scenario())
+
+
+class FakeLocator:
+    first = None
+
+    def __init__(self):
+        self.first = self
+
+    async def wait_for(self, **kwargs):
+        pass
+
+    async def click(self):
+        pass
+
+
+class FakePopupInfo:
+    def __init__(self, popup):
+        fut = asyncio.get_event_loop().create_future()
+        fut.set_result(popup)
+        self.value = fut
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeContext:
+    def __init__(self, popup):
+        self.popup = popup
+
+    def expect_page(self):
+        return FakePopupInfo(self.popup)
+
+
+class FakePopup:
+    def __init__(self, form_error):
+        self.form_error = form_error
+        self.filled = []
+
+    async def wait_for_selector(self, selector, **kwargs):
+        await asyncio.sleep(0)
+        raise self.form_error
+
+    async def fill(self, selector, value):
+        self.filled.append(selector)
+
+
+class FakePage:
+    url = psp.SMILE_LOGIN_URL
+
+    def __init__(self, order_error=None):
+        self.order_error = order_error
+
+    def locator(self, selector):
+        return FakeLocator()
+
+    async def wait_for_url(self, pattern, **kwargs):
+        await asyncio.sleep(0.05)
+        if self.order_error:
+            raise self.order_error
+
+
+def test_remembered_facebook_session_counts_as_login():
+    popup = FakePopup(RuntimeError('Target page, context or browser has been closed'))
+    run(psp.LoginBrowser('unused')._facebook_login(FakeContext(popup), FakePage()))
+    assert popup.filled == []
+
+
+def test_facebook_login_fails_only_when_both_waits_fail():
+    popup = FakePopup(RuntimeError('closed'))
+    with pytest.raises(TimeoutError):
+        run(psp.LoginBrowser('unused')._facebook_login(FakeContext(popup), FakePage(TimeoutError('no order page'))))
+
+
+def test_browser_state_is_never_world_readable(tmp_path):
+    path = tmp_path / 'state.json'
+    psp.write_json_atomic(str(path), {'cookies': []}, 0o600)
+    assert (path.stat().st_mode & 0o777) == 0o600
+
+
+class FakeScraper:
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.closed = False
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+
+    def close(self):
+        self.closed = True
+
+
+def fake_pool(monkeypatch, size=2):
+    pool = psp.ScraperPool(size)
+    pool.cookie = 'old=1'
+    monkeypatch.setattr(psp, 'scraper_pool', pool)
+    monkeypatch.setattr(psp, 'build_scraper', FakeScraper)
+    return pool
+
+
+def test_scraper_pool_drops_sessions_from_old_cookie(monkeypatch):
+    pool = fake_pool(monkeypatch)
+    monkeypatch.setattr(pool, 'warm', lambda: asyncio.sleep(0))
+
+    async def scenario():
+        async with pool.session() as first:
+            async with pool.session() as second:
+                pool.invalidate('new=1')
+        assert first.closed and second.closed and pool._idle == []
+        async with pool.session() as third:
+            assert third.cookie == 'new=1'
+        assert len(pool._idle) == 1
+    run(scenario())
+
+
+def test_scraper_pool_warm_primes_up_to_size(monkeypatch):
+    pool = fake_pool(monkeypatch, size=3)
+
+    async def scenario():
+        async with pool.session():
+            await pool.warm()
+        assert len(pool._idle) == 3
+        assert all(scraper.requests == [psp.SCRAPER_WARM_URL] for _, scraper in pool._idle[:2])
+    run(scenario())
+
+
+class FakeResponse:
+    def __init__(self, payload, url):
+        self.payload = payload
+        self.status_code = 200
+        self.url = url
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self.payload
+
+
+class FakeSmileScraper(FakeScraper):
+    def post(self, url, data=None, **kwargs):
+        self.requests.append(url)
+        if 'query' in url:
+            if self.cookie != 'new=1':
+                return FakeResponse({'msg': 'Please login'}, url)
+            return FakeResponse({'flowid': 'F1'}, url)
+        return FakeResponse({'code': 200, 'data': {'order_id': 'O1'}}, url)
+
+
+def test_package_retries_on_a_fresh_pooled_session_after_renewal(monkeypatch):
+    monkeypatch.setattr(psp, 'HTTP_TRANSPORT', 'cloudscraper')
+    pool = fake_pool(monkeypatch)
+    monkeypatch.setattr(psp, 'build_scraper', FakeSmileScraper)
+    monkeypatch.setattr(pool, 'warm', lambda: asyncio.sleep(0))
+
+    async def fake_csrf(scraper, page_url, headers):
+        return 'tok', None
+
+    async def fake_role(*args, **kwargs):
+        return psp.RoleInfo('ign', 'BR', None, None)
+
+    async def fake_rows(*args, **kwargs):
+        return []
+
+    async def fake_pace(endpoint, region, call):
+        return await call
+
+    async def fake_renew():
+        pool.invalidate('new=1')
+        return True
+
+    monkeypatch.setattr(psp, 'get_csrf_token', fake_csrf)
+    monkeypatch.setattr(psp, 'lookup_role', fake_role)
+    monkeypatch.setattr(psp, 'fetch_order_rows', fake_rows)
+    monkeypatch.setattr(psp.pacer, 'request', fake_pace)
+    monkeypatch.setattr(psp.session_renewal, 'renew', fake_renew)
+
+    results = run(psp.purchase_package('1', '2', ['13'], 'BR'))
+    assert results == [{'status': 'success', 'ig_name': 'ign', 'order_id': 'O1'}]
+    assert pool._busy == 0 and [scraper.cookie for _, scraper in pool._idle] == ['new=1']
+
+
+def test_expired_cookie_behind_a_cached_token_is_renewed_at_checkrole(monkeypatch):
+    monkeypatch.setattr(psp, 'HTTP_TRANSPORT', 'cloudscraper')
+    pool = fake_pool(monkeypatch)
+    monkeypatch.setattr(psp, 'build_scraper', FakeSmileScraper)
+    monkeypatch.setattr(pool, 'warm', lambda: asyncio.sleep(0))
+    monkeypatch.setattr(psp, 'role_cache', psp.RoleCache(10, 60, 60))
+    monkeypatch.setattr(psp, 'csrf_cache', psp.CsrfCache(60))
+    main_url = psp.SMILE_MERCHANTS['BR']['main_url']
+    renewals = []
+
+    class LoggedOutScraper(FakeSmileScraper):
+        def get(self, url, **kwargs):
+            self.requests.append(url)
+            if self.cookie != 'new=1':
+                return FakeResponse({}, 'https://www.smile.one/customer/login')
+            return FakeResponse({}, url)
+
+        def post(self, url, data=None, **kwargs):
+            if 'checkrole' in url:
+                self.requests.append(url)
+                if self.cookie != 'new=1':
+                    return FakeResponse({'msg': 'Please login'}, url)
+                return FakeResponse({'username': 'ign', 'zone': 'BR'}, url)
+            return super().post(url, data=data, **kwargs)
+    monkeypatch.setattr(psp, 'build_scraper', LoggedOutScraper)
+
+    def fake_extract(response):
+        login = 'login' in response.url
+        return psp.PageInfo(200, None if login else 'fresh', None, None, login, False)
+
+    async def fake_rows(*args, **kwargs):
+        return []
+
+    async def fake_pace(endpoint, region, call):
+        return await call
+
+    async def fake_renew():
+        renewals.append(1)
+        pool.invalidate('new=1')
+        return True
+
+    monkeypatch.setattr(psp, 'extract_page', fake_extract)
+    monkeypatch.setattr(psp, 'fetch_order_rows', fake_rows)
+    monkeypatch.setattr(psp.pacer, 'request', fake_pace)
+    monkeypatch.setattr(psp.session_renewal, 'renew', fake_renew)
+
+    async def scenario():
+        await pool.current_cookie()
+        # A token cached before the cookie expired: the page fetch that would show the login is skipped
+        psp.csrf_cache.put(main_url, 'cached')
+        return await psp.purchase_package('1', '2', ['13'], 'BR')
+    results = run(scenario())
+    assert results == [{'status': 'success', 'ig_name': 'ign', 'order_id': 'O1'}]
+    assert renewals == [1]
+
+
+def test_compaction_is_not_mistaken_for_a_hand_edit(monkeypatch, tmp_path):
+    db_file = str(tmp_path / 'database.json')
+    psp.write_json_atomic(db_file, {'users': ['1'], 'cookie': ''})
+    monkeypatch.setattr(psp, 'DB_FILE', db_file)
+    storage = psp.JsonStorage(db_file, db_file + '.journal')
+    storage.load()
+    storage._io_lock = asyncio.Lock()
+
+    write_snapshot = storage._write_snapshot
+
+    def slow_write_snapshot(snapshot):
+        stat = write_snapshot(snapshot)
+        time.sleep(0.2)  # the new file is on disk but compact() hasn't recorded its stat yet
+        return stat
+    monkeypatch.setattr(storage, '_write_snapshot', slow_write_snapshot)
+
+    async def scenario():
+        compaction = asyncio.ensure_future(storage.compact())
+        await asyncio.sleep(0.1)
+        # /add lands after the snapshot was taken, then is_authorized polls for hand edits
+        await storage.add_user('2')
+        await asyncio.gather(compaction, storage.users_version())
+        assert await storage.get_users() == ['1', '2']
+    run(scenario())
+
+
+def test_ledger_reconciles_under_steady_load(monkeypatch):
+    remote = {'BR': 90.0}
+
+    async def fake_fetch(region):
+        return remote[region]
+    monkeypatch.setattr(psp, 'fetch_region_balance', fake_fetch)
+    ledger = psp.BalanceLedger(('BR',))
+
+    async def scenario():
+        await ledger.refresh('BR')
+        remote['BR'] = 80.0
+        reservation = await ledger.reserve('BR', 10.0)
+        with reservation:
+            for _ in range(psp.LEDGER_MAX_SKIPS):
+                await ledger.reconcile()
+                assert ledger.peek('BR') == 90.0
+            await ledger.reconcile()
+            assert ledger.peek('BR') == 80.0
+            assert ledger.available('BR') == 70.0
+    run(scenario())
+
+
+def test_stale_csrf_token_is_refreshed_and_the_post_retried(monkeypatch):
+    page_url = 'https://www.smile.one/merchant/mobilelegends'
+    psp.csrf_cache.put(page_url, 'stale')
+
+    class Session:
+        def __init__(self):
+            self.posted = []
+
+        async def get(self, url, **kwargs):
+            return psp.HttpResponse(200, '<meta name="csrf-token" content="fresh">', url)
+
+        async def post(self, url, data=None, **kwargs):
+            self.posted.append(data['_csrf'])
+            if data['_csrf'] == 'stale':
+                return psp.HttpResponse(200, json.dumps({'msg': 'CSRF token invalid'}), url)
+            return psp.HttpResponse(200, json.dumps({'flowid': 'F1'}), url)
+
+    session = Session()
+    response = run(psp.post_with_csrf(session, page_url, page_url + '/query', {'_csrf': 'stale'}, {}))
+    assert response.json() == {'flowid': 'F1'}
+    assert session.posted == ['stale', 'fresh']
+    assert psp.csrf_cache.get(page_url) == 'fresh'
+
+
+def test_storage_backends_implement_the_whole_interface(tmp_path):
+    psp.JsonStorage(str(tmp_path / 'db.json'), str(tmp_path / 'db.journal'))
+    psp.SqliteStorage(str(tmp_path / 'db.sqlite3'))
+
+    class Partial(psp.Storage):
+        async def get_users(self):
+            return []
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_each_item_is_committed_as_soon_as_it_is_confirmed(monkeypatch):
+    async def fake_fetch(region):
+        return 100.0
+    monkeypatch.setattr(psp, 'fetch_region_balance', fake_fetch)
+    ledger = psp.BalanceLedger(('BR',))
+    items = [{'pid': '13', 'price': 15.0, 'name': '86 💎'}] * 2
+
+    async def scenario():
+        reservation = await ledger.reserve('BR', 30.0)
+        with reservation:
+            progress = psp.PackageProgress(reservation, items)
+            await progress.paying('13')
+            await progress.paid({'status': 'success', 'order_id': 'A', 'ig_name': 'n'})
+            assert ledger.peek('BR') == 85.0 and ledger.reserved['BR'] == 15.0
+            await progress.paying('13')
+            await progress.unpaid({'status': 'error', 'message': 'x'})
+        assert ledger.peek('BR') == 85.0 and ledger.reserved['BR'] == 0.0
+    run(scenario())
+
+
+def test_forced_reconcile_mid_package_does_not_double_debit(monkeypatch):
+    remote = {'BR': 100.0}
+
+    async def fake_fetch(region):
+        return remote[region]
+    monkeypatch.setattr(psp, 'fetch_region_balance', fake_fetch)
+    monkeypatch.setattr(psp, 'LEDGER_MAX_SKIPS', 0)
+    ledger = psp.BalanceLedger(('BR',))
+    items = [{'pid': '13', 'price': 15.0, 'name': '86 💎'}] * 2
+
+    async def scenario():
+        await ledger.refresh('BR')
+        reservation = await ledger.reserve('BR', 30.0)
+        with reservation:
+            progress = psp.PackageProgress(reservation, items)
+            await progress.paying('13')
+            # POST in flight: the remote value can't be trusted yet
+            remote['BR'] = 85.0
+            await ledger.reconcile()
+            assert ledger.peek('BR') == 100.0
+            await progress.pay_sent(True)
+            await ledger.reconcile()
+            assert ledger.peek('BR') == 100.0 and not ledger.drift
+            await progress.paid({'status': 'success', 'order_id': 'A', 'ig_name': 'n'})
+            await progress.paying('13')
+            await progress.pay_sent(True)
+            remote['BR'] = 70.0
+            await progress.paid({'status': 'success', 'order_id': 'B', 'ig_name': 'n'})
+        assert ledger.peek('BR') == 70.0
+        await ledger.reconcile()
+        assert ledger.peek('BR') == 70.0 and not ledger.drift
+    run(scenario())
+
+
+def test_history_export_is_uploaded_as_a_real_file(monkeypatch):
+    orders = [{'game_id': '1', 'zone_id': '2', 'item_name': '86 💎', 'order_id': 'A',
+               'date_str': 'now', 'price': 1.5, 'status': 'success'}]
+    uploads = []
+
+    async def fake_history(tg_id, since=None, until=None, game_id=None):
+        return iter(orders)
+    monkeypatch.setattr(psp, 'iter_user_history', fake_history)
+
+    class HistoryMessage:
+        text = '/history csv gz'
+        from_user = type('User', (), {'id': psp.OWNER_ID, 'username': 'u', 'first_name': 'u'})()
+
+        async def reply_document(self, document, **kwargs):
+            # Pyrogram rejects anything that isn't an io.IOBase as an upload
+            assert isinstance(document, psp.io.IOBase)
+            uploads.append(document.read())
+
+    run(psp.send_order_history(None, HistoryMessage()))
+    assert uploads and psp.gzip.decompress(uploads[0]).decode().splitlines()[1].startswith(',1,2,')
+
+
+def test_threaded_session_never_shares_the_scraper_between_threads():
+    class CountingScraper:
+        def __init__(self):
+            self.active = self.peak = 0
+            self.lock = psp.threading.Lock()
+
+        def get(self, url, **kwargs):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            time.sleep(0.05)
+            with self.lock:
+                self.active -= 1
+            return url
+
+    scraper = CountingScraper()
+    session = psp.ThreadedSession(scraper)
+
+    async def scenario():
+        # A cancelled baseline read must not free the session while its thread is still running
+        baseline = asyncio.ensure_future(session.get('baseline'))
+        await asyncio.sleep(0.01)
+        baseline.cancel()
+        results = await asyncio.gather(session.get('query'), session.get('confirm'), baseline, return_exceptions=True)
+        assert results[:2] == ['query', 'confirm']
+    run(scenario())
+    assert scraper.peak == 1
+
+
+def test_queue_dispatches_per_lane_and_skips_busy_accounts(monkeypatch, tmp_path):
+    monkeypatch.setattr(psp, 'QUEUE_FEEDBACK_INTERVAL', 0.01)
+    queue = psp.FairOrderQueue({'BR': 2, 'PH': 1}, str(tmp_path / 'priorities.json'))
+    started = []
+    release = {}
+
+    def job(name):
+        async def run(status_msg):
+            started.append(name)
+            release[name] = asyncio.Event()
+            await release[name].wait()
+        return run
+
+    async def reply(text):
+        return FakeStatus()
+
+    async def scenario():
+        runner = asyncio.ensure_future(queue.run())
+        # A two-line paste for one account would have parked the second BR worker on the account lock
+        await queue.submit('1', 'BR', ('1', '2'), job('a1'), reply)
+        await queue.submit('1', 'BR', ('1', '2'), job('a2'), reply)
+        await queue.submit('2', 'BR', ('3', '4'), job('b1'), reply)
+        await queue.submit('3', 'PH', ('5', '6'), job('p1'), reply)
+        await asyncio.sleep(0.05)
+        assert sorted(started) == ['a1', 'b1', 'p1']
+        release['a1'].set()
+        await asyncio.sleep(0.05)
+        assert started[-1] == 'a2'
+        for event in release.values(): event.set()
+        runner.cancel()
+    run(scenario())
+
+
+def use_archive(monkeypatch, tmp_path, hot_limit=2):
+    monkeypatch.setattr(psp, 'HOT_ORDER_LIMIT', hot_limit)
+    monkeypatch.setattr(psp, 'ARCHIVE_BATCH_SIZE', 1)
+    db_file = str(tmp_path / 'database.json')
+    storage = psp.JsonStorage(db_file, db_file + '.journal')
+    storage.load()
+    archive = psp.OrderArchive(str(tmp_path / 'archive'))
+    monkeypatch.setattr(psp, 'storage', storage)
+    monkeypatch.setattr(psp, 'order_archive', archive)
+    return storage, archive
+
+
+async def place_orders(*order_ids):
+    for order_id in order_ids:
+        await psp.save_order('1', '100', '200', '86', 1.5, order_id)
+
+
+async def history_ids(limit=None):
+    if limit is not None:
+        return [o['order_id'] for o in await psp.get_user_history('1', limit)]
+    return [o['order_id'] for o in await psp.work_executor.run(list, await psp.iter_user_history('1'))]
+
+
+def test_archive_rerun_after_a_crash_drops_without_duplicating(monkeypatch, tmp_path):
+    storage, archive = use_archive(monkeypatch, tmp_path)
+    drop_orders = storage.drop_orders
+
+    async def crash(tg_id, upto):
+        raise RuntimeError('killed between segment write and drop')
+
+    async def scenario():
+        await place_orders('A', 'B', 'C', 'D')
+        monkeypatch.setattr(storage, 'drop_orders', crash)
+        with pytest.raises(RuntimeError):
+            await archive.archive_overflow()
+        assert [s['count'] for s in archive.index['segments']] == [2]
+        monkeypatch.setattr(storage, 'drop_orders', drop_orders)
+        await archive.archive_overflow()
+        assert [s['count'] for s in archive.index['segments']] == [2]
+        assert await storage.get_overflow() == []
+        assert await history_ids() == ['D', 'C', 'B', 'A']
+    run(scenario())
+
+
+def test_clean_hides_old_orders_but_not_new_ones(monkeypatch, tmp_path):
+    storage, archive = use_archive(monkeypatch, tmp_path)
+
+    async def scenario():
+        await place_orders('A', 'B', 'C')
+        await archive.archive_overflow()
+        assert await psp.clear_user_history('1') == 3
+        assert await history_ids() == []
+        # New orders after /clean show up, in the hot store and once they are archived too
+        await place_orders('D', 'E', 'F')
+        assert await history_ids() == ['F', 'E', 'D']
+        await archive.archive_overflow()
+        assert await history_ids() == ['F', 'E', 'D']
+        assert await history_ids(limit=10) == ['F', 'E', 'D']
+        assert await psp.clear_user_history('1') == 3
+    run(scenario())
+
+
+def test_user_history_spans_hot_and_archived_orders(monkeypatch, tmp_path):
+    storage, archive = use_archive(monkeypatch, tmp_path)
+
+    async def scenario():
+        await place_orders('A', 'B', 'C', 'D', 'E')
+        await archive.archive_overflow()
+        assert [o['order_id'] for o in await storage.get_history('1', 10)] == ['E', 'D']
+        assert await history_ids(limit=4) == ['E', 'D', 'C', 'B']
+        assert await history_ids(limit=10) == ['E', 'D', 'C', 'B', 'A']
+        assert await history_ids() == ['E', 'D', 'C', 'B', 'A']
+    run(scenario())